@@ -0,0 +1,53 @@
+package com.example.agent
+
+import java.io.ByteArrayOutputStream
+import kotlin.math.roundToLong
+
+/**
+ * Encoder for the server's binary fix frame (`application/vnd.tracker.fixes`).
+ *
+ * Layout: "TF", version 1, varint session length, session, varint fix count,
+ * then per fix the change of latitude, longitude (degrees x 1e7) and timestamp
+ * (epoch ms) from the previous fix as zigzag varints.
+ */
+object FixFrame {
+    const val MEDIA_TYPE = "application/vnd.tracker.fixes"
+    private val MAGIC = byteArrayOf('T'.code.toByte(), 'F'.code.toByte(), 1)
+    private const val SCALE = 1e7
+
+    data class Fix(val lat: Double, val lng: Double, val ts: Long)
+
+    fun encode(session: ByteArray, fixes: List<Fix>): ByteArray {
+        val out = ByteArrayOutputStream(16 + session.size + fixes.size * 10)
+        out.write(MAGIC)
+        writeUVarint(out, session.size.toLong())
+        out.write(session)
+        writeUVarint(out, fixes.size.toLong())
+        var lat = 0L
+        var lng = 0L
+        var ts = 0L
+        for (fix in fixes) {
+            val fixLat = (fix.lat * SCALE).roundToLong()
+            val fixLng = (fix.lng * SCALE).roundToLong()
+            writeSVarint(out, fixLat - lat)
+            writeSVarint(out, fixLng - lng)
+            writeSVarint(out, fix.ts - ts)
+            lat = fixLat
+            lng = fixLng
+            ts = fix.ts
+        }
+        return out.toByteArray()
+    }
+
+    private fun writeSVarint(out: ByteArrayOutputStream, value: Long) =
+        writeUVarint(out, (value shl 1) xor (value shr 63))
+
+    private fun writeUVarint(out: ByteArrayOutputStream, value: Long) {
+        var v = value
+        while (v and 0x7FL.inv() != 0L) {
+            out.write(((v and 0x7FL) or 0x80L).toInt())
+            v = v ushr 7
+        }
+        out.write(v.toInt())
+    }
+}
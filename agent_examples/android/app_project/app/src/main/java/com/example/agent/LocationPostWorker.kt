@@ -1,6 +1,8 @@
 package com.example.agent
 
 import android.content.Context
+import android.content.SharedPreferences
+import android.util.Base64
 import android.util.Log
 import androidx.work.*
 import okhttp3.MediaType.Companion.toMediaType
@@ -8,6 +10,7 @@ import okhttp3.OkHttpClient
 import okhttp3.Request
 import okhttp3.RequestBody.Companion.toRequestBody
 import org.json.JSONObject
+import java.util.UUID
 import java.util.concurrent.TimeUnit
 import androidx.security.crypto.EncryptedSharedPreferences
 import androidx.security.crypto.MasterKey
@@ -24,6 +27,9 @@ class LocationPostWorker(
         val serverRoot = inputData.getString("serverRoot") ?: return Result.failure()
         val lat = inputData.getDouble("lat", 0.0)
         val lng = inputData.getDouble("lng", 0.0)
+        val ts = inputData.getLong("ts", System.currentTimeMillis())
+        // Same key on every retry of this fix, so the server stores it once
+        val idempotencyKey = inputData.getString("idempotencyKey") ?: UUID.randomUUID().toString()
 
         // ALWAYS load fresh saved credentials
         val masterKey = MasterKey.Builder(applicationContext)
@@ -38,26 +44,22 @@ class LocationPostWorker(
             EncryptedSharedPreferences.PrefValueEncryptionScheme.AES256_GCM
         )
 
-        val imei = prefs.getString("imei", "") ?: ""
-        val phone = prefs.getString("phone", "") ?: ""
-        val token = prefs.getString("token", "") ?: ""
-
-        val json = JSONObject().apply {
-            put("imei", imei)
-            put("phone", phone)
-            put("lat", lat)
-            put("lng", lng)
-            put("token", token)
-        }
-
-        val url = "$serverRoot/api/location_update"
-        val body = json.toString().toRequestBody("application/json".toMediaType())
-        val request = Request.Builder().url(url).post(body).build()
-
         return try {
+            // A short session replaces IMEI, phone and token on every post
+            val session = loadSession(serverRoot, prefs) ?: return Result.retry()
+            val frame = FixFrame.encode(session, listOf(FixFrame.Fix(lat, lng, ts)))
+            val request = Request.Builder()
+                .url("$serverRoot/api/location_update")
+                .header("Idempotency-Key", idempotencyKey)
+                .post(frame.toRequestBody(FixFrame.MEDIA_TYPE.toMediaType()))
+                .build()
             val response = client.newCall(request).execute()
             val code = response.code
             response.close()
+            if (code == 401) {
+                // Expired, or the device token was regenerated; fetch a new session on retry
+                prefs.edit().remove("session").remove("session_expires").apply()
+            }
             if (code in 200..299) Result.success()
             else Result.retry()
         } catch (e: Exception) {
@@ -66,6 +68,37 @@ class LocationPostWorker(
         }
     }
 
+    /** The cached session credential, or a new one from /api/session when it is missing or about to expire. */
+    private fun loadSession(serverRoot: String, prefs: SharedPreferences): ByteArray? {
+        val cached = prefs.getString("session", null)
+        val expires = prefs.getLong("session_expires", 0L)
+        if (cached != null && expires - 60 > System.currentTimeMillis() / 1000) {
+            return Base64.decode(cached, Base64.URL_SAFE or Base64.NO_PADDING or Base64.NO_WRAP)
+        }
+        val json = JSONObject().apply {
+            put("imei", prefs.getString("imei", "") ?: "")
+            put("phone", prefs.getString("phone", "") ?: "")
+            put("token", prefs.getString("token", "") ?: "")
+        }
+        val request = Request.Builder()
+            .url("$serverRoot/api/session")
+            .post(json.toString().toRequestBody("application/json".toMediaType()))
+            .build()
+        client.newCall(request).execute().use { response ->
+            if (!response.isSuccessful) {
+                Log.w(TAG, "session request failed: ${response.code}")
+                return null
+            }
+            val body = JSONObject(response.body?.string() ?: return null)
+            val session = body.getString("session")
+            prefs.edit()
+                .putString("session", session)
+                .putLong("session_expires", body.getLong("expires_at"))
+                .apply()
+            return Base64.decode(session, Base64.URL_SAFE or Base64.NO_PADDING or Base64.NO_WRAP)
+        }
+    }
+
     companion object {
         fun enqueue(
             context: Context,
@@ -78,6 +111,8 @@ class LocationPostWorker(
                 "serverRoot" to serverRoot,
                 "lat" to lat,
                 "lng" to lng,
+                "ts" to System.currentTimeMillis(),
+                "idempotencyKey" to UUID.randomUUID().toString(),
             )
 
             val request = OneTimeWorkRequestBuilder<LocationPostWorker>()
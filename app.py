@@ -1,30 +1,540 @@
+import time
+
+_BOOT_START = time.perf_counter()
+
+import asyncio
 import json
 import os
 import secrets
-from datetime import datetime
+import sys
+from datetime import datetime, timezone
 import sqlite3
 import base64
+import hashlib
+import hmac
+import threading
+import queue
+import atexit
+import math
+import heapq
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache
 
-from flask import Flask, render_template, request, redirect, url_for, jsonify, flash, session, send_file
+from flask import (
+    Flask, render_template, request, redirect, url_for, jsonify, flash, session, send_file, g,
+    Response, stream_with_context,
+)
+import csv
 import io
+import itertools
 import zipfile
+import zlib
+import gzip
+import tempfile
 
+import click
 import phonenumbers
-from phonenumbers import geocoder, carrier
 from werkzeug.security import generate_password_hash, check_password_hash
-import requests
+
+# The phonenumbers geocoder/carrier datasets and `requests` are imported on first
+# use (or in the gunicorn master, see gunicorn.conf.py) to keep worker boot fast.
+# So is numpy, which only the trip/stop analytics need.
+
+_IMPORTS_DONE = time.perf_counter()
+# (phase, milliseconds) recorded while this process boots; see format_boot_report()
+BOOT_TIMINGS = [("imports", (_IMPORTS_DONE - _BOOT_START) * 1000.0)]
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "change-me-in-production")
-DB_DIR = os.path.join(os.path.dirname(__file__), "data")
+# DATA_DIR relocates the database and everything derived from it (benchmarks, tests, containers)
+DB_DIR = os.environ.get("DATA_DIR") or os.path.join(os.path.dirname(__file__), "data")
 DB_FILE = os.path.join(DB_DIR, "app.db")
+# Per-device history (locations, idempotency keys, retention watermarks) can be split by device id
+# over LOCATION_SHARDS SQLite files in SHARD_DIR, each with its own writer. The layout is recorded in
+# app.db: the variable only picks it for a new database; `flask shards rebalance` moves existing data.
+LOCATION_SHARDS = int(os.environ.get("LOCATION_SHARDS", "0"))
+SHARD_DIR = os.environ.get("SHARD_DIR") or os.path.join(DB_DIR, "shards")
+# Upper bound on fixes accepted by a single /api/location_batch call
+LOCATION_BATCH_MAX = int(os.environ.get("LOCATION_BATCH_MAX", "5000"))
+# Fix timestamps must fall between 2000-01-01 UTC and now plus INGEST_MAX_CLOCK_SKEW seconds
+INGEST_MAX_CLOCK_SKEW = float(os.environ.get("INGEST_MAX_CLOCK_SKEW", "300"))
+# Binary fix frames (see ingest_fix_frame): agent sessions from /api/session last AGENT_SESSION_TTL
+# seconds, and ingest bodies may not exceed INGEST_MAX_BODY bytes once gzip/deflate is undone
+AGENT_SESSION_TTL = int(os.environ.get("AGENT_SESSION_TTL", str(7 * 24 * 3600)))
+INGEST_MAX_BODY = int(os.environ.get("INGEST_MAX_BODY", str(2 * 1024 * 1024)))
+# devices.last_update uses SQLite's CURRENT_TIMESTAMP format; locations.ts is epoch milliseconds
+TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Connection tuning; WAL lets readers proceed while a worker is writing
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL").upper()
+if DB_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    DB_SYNCHRONOUS = "NORMAL"
+DB_BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", "5"))
+DB_STATEMENT_CACHE = int(os.environ.get("DB_STATEMENT_CACHE", "256"))
+# Ingest auth cache: IMEI/phone -> (device_id, api_token)
+DEVICE_CACHE_SIZE = int(os.environ.get("DEVICE_CACHE_SIZE", "10000"))
+DEVICE_CACHE_TTL = float(os.environ.get("DEVICE_CACHE_TTL", "30"))
+# INGEST_MODE=queue acknowledges /api/location_update with 202 and group-commits in the background
+INGEST_MODE = os.environ.get("INGEST_MODE", "sync").lower()
+INGEST_QUEUE_SIZE = int(os.environ.get("INGEST_QUEUE_SIZE", "10000"))
+INGEST_FLUSH_MS = int(os.environ.get("INGEST_FLUSH_MS", "50"))
+INGEST_FLUSH_ROWS = int(os.environ.get("INGEST_FLUSH_ROWS", "500"))
+# Ingest filter: fixes within INGEST_DEDUP_METERS (0 = off) and INGEST_DEDUP_SECONDS of the last stored
+# point are dropped; dropped fixes still refresh last_update every INGEST_TOUCH_SECONDS.
+# Idempotency keys are remembered for INGEST_KEY_TTL seconds.
+INGEST_DEDUP_METERS = float(os.environ.get("INGEST_DEDUP_METERS", "10"))
+INGEST_DEDUP_SECONDS = float(os.environ.get("INGEST_DEDUP_SECONDS", "300"))
+INGEST_TOUCH_SECONDS = float(os.environ.get("INGEST_TOUCH_SECONDS", "60"))
+INGEST_KEY_TTL = float(os.environ.get("INGEST_KEY_TTL", str(24 * 3600)))
+# /import commits after this many device + location rows; errors beyond the cap are only counted
+IMPORT_CHUNK_ROWS = int(os.environ.get("IMPORT_CHUNK_ROWS", "50000"))
+IMPORT_MAX_ERRORS = 100
+# /api/devices/<id>/history: raw rows read per page, vertex budget per response,
+# and how many screen pixels of error simplification may introduce
+HISTORY_PAGE_ROWS = int(os.environ.get("HISTORY_PAGE_ROWS", "50000"))
+HISTORY_MAX_POINTS = int(os.environ.get("HISTORY_MAX_POINTS", "2000"))
+HISTORY_PIXEL_TOLERANCE = float(os.environ.get("HISTORY_PIXEL_TOLERANCE", "1.0"))
+# ASGI mode (asgi_app): agent API calls run their database work on ASYNC_DB_THREADS threads; every
+# other route goes through the Flask app on ASYNC_WSGI_THREADS threads (open /api/live streams hold one each)
+ASYNC_DB_THREADS = int(os.environ.get("ASYNC_DB_THREADS", "8"))
+ASYNC_WSGI_THREADS = int(os.environ.get("ASYNC_WSGI_THREADS", "32"))
+# Trip/stop analytics: a stop is at least ANALYTICS_STOP_SECONDS within ANALYTICS_STOP_RADIUS meters, each
+# step slower than ANALYTICS_STOP_SPEED (m/s). Steps faster than ANALYTICS_MAX_SPEED (m/s) are GPS glitches,
+# silences longer than ANALYTICS_GAP_SECONDS end a trip, and trips under ANALYTICS_TRIP_MIN_METERS are not
+# listed. One request covers at most ANALYTICS_MAX_DAYS days.
+ANALYTICS_STOP_RADIUS = float(os.environ.get("ANALYTICS_STOP_RADIUS", "50"))
+ANALYTICS_STOP_SECONDS = float(os.environ.get("ANALYTICS_STOP_SECONDS", "300"))
+ANALYTICS_STOP_SPEED = float(os.environ.get("ANALYTICS_STOP_SPEED", "1.0"))
+ANALYTICS_MAX_SPEED = float(os.environ.get("ANALYTICS_MAX_SPEED", "70"))
+ANALYTICS_GAP_SECONDS = float(os.environ.get("ANALYTICS_GAP_SECONDS", "900"))
+ANALYTICS_TRIP_MIN_METERS = float(os.environ.get("ANALYTICS_TRIP_MIN_METERS", "200"))
+ANALYTICS_MAX_DAYS = int(os.environ.get("ANALYTICS_MAX_DAYS", "92"))
+# Live (SSE) feed: per-client buffer, subscriber cap per process (further limited to half of the
+# worker's threads, see gunicorn.conf.py), cross-worker poll interval and keepalive (seconds)
+LIVE_CLIENT_BUFFER = int(os.environ.get("LIVE_CLIENT_BUFFER", "256"))
+LIVE_MAX_SUBSCRIBERS = int(os.environ.get("LIVE_MAX_SUBSCRIBERS", "1000"))
+LIVE_POLL_INTERVAL = float(os.environ.get("LIVE_POLL_INTERVAL", "1.0"))
+LIVE_KEEPALIVE = float(os.environ.get("LIVE_KEEPALIVE", "15"))
+# Geofence definitions are cached per process for this many seconds
+GEOFENCE_CACHE_TTL = float(os.environ.get("GEOFENCE_CACHE_TTL", "5"))
+# Largest radius_m accepted by /api/spatial/radius and circular geofences
+SPATIAL_MAX_RADIUS_M = float(os.environ.get("SPATIAL_MAX_RADIUS_M", "1000000"))
+# Device listing (/fleet, /api/devices): page sizes and the default "stale" age in seconds
+FLEET_PAGE_SIZE = int(os.environ.get("FLEET_PAGE_SIZE", "100"))
+FLEET_PAGE_MAX = int(os.environ.get("FLEET_PAGE_MAX", "1000"))
+FLEET_STALE_AFTER = float(os.environ.get("FLEET_STALE_AFTER", str(24 * 3600)))
+# Memoized phonenumbers parse/metadata results
+PHONE_CACHE_SIZE = int(os.environ.get("PHONE_CACHE_SIZE", "50000"))
+# SMS dispatch (2FA and onboarding): provider, worker pool, retries and circuit breaker
+SMS_PROVIDER = os.environ.get("SMS_PROVIDER", "vonage")
+VONAGE_API_URL = os.environ.get("VONAGE_API_URL", "https://rest.nexmo.com/sms/json")
+SMS_WORKERS = int(os.environ.get("SMS_WORKERS", "4"))
+SMS_QUEUE_SIZE = int(os.environ.get("SMS_QUEUE_SIZE", "1000"))
+SMS_TIMEOUT = float(os.environ.get("SMS_TIMEOUT", "10"))
+SMS_MAX_RETRIES = int(os.environ.get("SMS_MAX_RETRIES", "3"))
+SMS_BACKOFF = float(os.environ.get("SMS_BACKOFF", "0.5"))
+SMS_BREAKER_THRESHOLD = int(os.environ.get("SMS_BREAKER_THRESHOLD", "5"))
+SMS_BREAKER_COOLDOWN = float(os.environ.get("SMS_BREAKER_COOLDOWN", "30"))
+SMS_BULK_MAX = int(os.environ.get("SMS_BULK_MAX", "1000"))
+# A login waits up to SMS_2FA_WAIT seconds for its code to be sent, so a failure shows on the form
+SMS_2FA_WAIT = float(os.environ.get("SMS_2FA_WAIT", "3"))
+# /agent/download: prebuilt zip location, whether to leave out IDE/build artifacts,
+# and how often (seconds) to re-check the sources for changes
+AGENT_BUNDLE_DIR = os.environ.get("AGENT_BUNDLE_DIR") or os.path.join(DB_DIR, "bundles")
+AGENT_BUNDLE_EXCLUDE_IDE = os.environ.get("AGENT_BUNDLE_EXCLUDE_IDE", "1") == "1"
+AGENT_BUNDLE_CHECK = float(os.environ.get("AGENT_BUNDLE_CHECK", "5"))
+# /metrics: worker snapshots are shared through METRICS_DIR at most every METRICS_FLUSH seconds;
+# METRICS_TOKEN, if set, must be sent as "Authorization: Bearer <token>"; otherwise only admins may read it
+METRICS_DIR = os.environ.get("METRICS_DIR") or os.path.join(DB_DIR, "metrics")
+METRICS_FLUSH = float(os.environ.get("METRICS_FLUSH", "5"))
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+# Opt-in sampling profiler: requests slower than PROFILE_SLOW_MS (0 = off) are saved as folded stacks
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", "0"))
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "1.0"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "50"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR") or os.path.join(DB_DIR, "profiles")
+# /search/bulk: identifiers per JSON/HTML request (CSV output is streamed and unbounded) and history depth
+SEARCH_BULK_MAX = int(os.environ.get("SEARCH_BULK_MAX", "10000"))
+SEARCH_BULK_HISTORY_MAX = int(os.environ.get("SEARCH_BULK_HISTORY_MAX", "100"))
+# Read-through cache of device views and history responses: "memory" (per worker), "sqlite"
+# (one file shared by every worker on the host), "off", or a "module:factory" path.
+RESPONSE_CACHE_BACKEND = os.environ.get("RESPONSE_CACHE_BACKEND", "memory")
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "5000"))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "30"))
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH") or os.path.join(DB_DIR, "cache.db")
+# Location retention, e.g. "raw:30d,1m:365d" = raw for 30 days, 1-minute averages for a year, then drop.
+# Empty keeps everything. RETENTION_INTERVAL > 0 runs the job in the background every N seconds.
+RETENTION_POLICY = os.environ.get("RETENTION_POLICY", "").strip()
+RETENTION_ARCHIVE = os.environ.get("RETENTION_ARCHIVE", "0") == "1"
+RETENTION_INTERVAL = float(os.environ.get("RETENTION_INTERVAL", "0"))
+RETENTION_CHUNK_MS = int(os.environ.get("RETENTION_CHUNK_MS", str(24 * 3600 * 1000)))
+RETENTION_BATCH_ROWS = int(os.environ.get("RETENTION_BATCH_ROWS", "10000"))
+RETENTION_VACUUM_PAGES = int(os.environ.get("RETENTION_VACUUM_PAGES", "1000"))
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR") or os.path.join(DB_DIR, "archive")
+
+_db_local = threading.local()
+_schema_ready = False
+# Shard count in use, read from storage_layout by ensure_db() (0 = history lives in app.db)
+_location_shards = 0
+
+
+def now_ms():
+    return int(datetime.now(timezone.utc).timestamp() * 1000)
+
+
+FIX_TS_MIN = 946684800000  # 2000-01-01T00:00:00Z
+
+
+def fix_ts_valid(ts, now=None):
+    """True if epoch-ms ``ts`` is a plausible fix time: not before 2000, not ahead of the clock.
+
+    A future fix would hold ``devices.last_update`` ahead of every real one, and
+    a huge value would not even fit an SQLite INTEGER.
+    """
+    limit = (now_ms() if now is None else now) + int(INGEST_MAX_CLOCK_SKEW * 1000)
+    return ts is not None and FIX_TS_MIN <= ts <= limit
+
+
+def ts_to_ms(value):
+    """Convert epoch seconds/milliseconds (numbers or numeric strings) or an ISO-8601
+    string (UTC if naive) to epoch ms.
+
+    Returns None for missing or unparseable values.
+    """
+    if value is None or value == "" or isinstance(value, bool):
+        return None
+    try:
+        if isinstance(value, (int, float)):
+            # Anything past ~1973 in milliseconds is larger than any plausible epoch-seconds value
+            return int(value) if value > 1e11 else int(value * 1000)
+        if isinstance(value, str):
+            value = value.strip()
+            if value.replace(".", "", 1).isdigit():
+                return ts_to_ms(float(value))
+            dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+            return int(dt.timestamp() * 1000)
+    except (ValueError, OverflowError, OSError):
+        return None
+    return None
+
+
+def ms_to_ts_text(ms):
+    return datetime.fromtimestamp(ms / 1000.0, timezone.utc).strftime(TS_FORMAT)
+
+
+def _migrate_locations_timeseries(c):
+    """v1: locations keyed by (device_id, ts) in a WITHOUT ROWID table, ts as epoch ms.
+
+    A device's history becomes one contiguous range of the primary key, so
+    "latest N" and per-device export are index range reads.
+    """
+    c.execute(
+        """
+        CREATE TABLE locations_v1 (
+            device_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            lat REAL NOT NULL,
+            lng REAL NOT NULL,
+            PRIMARY KEY (device_id, ts),
+            FOREIGN KEY(device_id) REFERENCES devices(id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+        """
+    )
+    read = c.connection.cursor()
+    read.execute("SELECT device_id, lat, lng, ts FROM locations ORDER BY device_id, id")
+    skipped = 0
+    current_device = None
+    used = set()
+    while True:
+        chunk = read.fetchmany(10000)
+        if not chunk:
+            break
+        rows = []
+        for device_id, lat, lng, ts in chunk:
+            ms = ts_to_ms(ts)
+            if ms is None:
+                skipped += 1
+                continue
+            if device_id != current_device:
+                current_device = device_id
+                used = set()
+            # Legacy CURRENT_TIMESTAMP values have second resolution; keep every
+            # row by nudging same-second fixes apart by a millisecond
+            while ms in used:
+                ms += 1
+            used.add(ms)
+            rows.append((device_id, ms, lat, lng))
+        c.executemany("INSERT INTO locations_v1 (device_id, ts, lat, lng) VALUES (?, ?, ?, ?)", rows)
+    if skipped:
+        print(f"WARNING: dropped {skipped} location rows with unparseable timestamps during migration")
+    c.execute("DROP TABLE locations")
+    c.execute("ALTER TABLE locations_v1 RENAME TO locations")
+
+
+def _migrate_spatial_index(c):
+    """v2: R*Tree over last-known positions plus geofence tables.
+
+    The R*Tree lives in the database (rather than in one worker's memory) so
+    every gunicorn worker sees positions written by the others.
+    """
+    c.execute("CREATE VIRTUAL TABLE device_positions USING rtree(id, min_lat, max_lat, min_lng, max_lng)")
+    c.execute(
+        """
+        INSERT INTO device_positions (id, min_lat, max_lat, min_lng, max_lng)
+        SELECT id, last_lat, last_lat, last_lng, last_lng FROM devices
+        WHERE last_lat IS NOT NULL AND last_lng IS NOT NULL
+        """
+    )
+    c.execute(
+        """
+        CREATE TABLE geofences (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            kind TEXT NOT NULL CHECK(kind IN ('circle','polygon')),
+            geometry TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+    c.execute(
+        """
+        CREATE TABLE geofence_members (
+            geofence_id INTEGER NOT NULL,
+            device_id INTEGER NOT NULL,
+            since INTEGER NOT NULL,
+            PRIMARY KEY (geofence_id, device_id)
+        ) WITHOUT ROWID
+        """
+    )
+    c.execute(
+        """
+        CREATE TABLE geofence_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            geofence_id INTEGER NOT NULL,
+            device_id INTEGER NOT NULL,
+            event TEXT NOT NULL CHECK(event IN ('enter','exit')),
+            ts INTEGER NOT NULL
+        )
+        """
+    )
+    c.execute("CREATE INDEX idx_geofence_events_ts ON geofence_events(ts)")
+
+
+def _migrate_devices_last_update_index(c):
+    """v3: index devices by last_update so the live feed can poll for recent changes."""
+    c.execute("CREATE INDEX idx_devices_last_update ON devices(last_update)")
+
+
+def _migrate_retention(c):
+    """v4: per-device retention policies and compaction watermarks.
+
+    ``retention_state.done_until`` records, per device and tier resolution, the
+    point before which history has already been downsampled.
+    """
+    c.execute(
+        """
+        CREATE TABLE retention_policies (
+            device_id INTEGER PRIMARY KEY,
+            policy TEXT NOT NULL,
+            FOREIGN KEY(device_id) REFERENCES devices(id) ON DELETE CASCADE
+        )
+        """
+    )
+    c.execute(
+        """
+        CREATE TABLE retention_state (
+            device_id INTEGER NOT NULL,
+            res_ms INTEGER NOT NULL,
+            done_until INTEGER NOT NULL,
+            PRIMARY KEY (device_id, res_ms)
+        ) WITHOUT ROWID
+        """
+    )
+
+
+def _migrate_fleet_aggregates(c):
+    """v5: filter indexes for the device listing and incrementally maintained fleet counters.
+
+    ``fleet_groups`` counts devices per (carrier, region) and ``fleet_last_seen``
+    per last_update hour (``''`` = never reported); triggers keep both exact
+    whatever path writes ``devices``. ``fleet_updates_hourly`` counts ingested
+    fixes per hour of their timestamp and is maintained by ``store_fixes``.
+    """
+    c.execute("CREATE INDEX idx_devices_owner ON devices(owner)")
+    c.execute("CREATE INDEX idx_devices_carrier ON devices(carrier)")
+    c.execute("CREATE INDEX idx_devices_region ON devices(region)")
+    c.execute(
+        """
+        CREATE TABLE fleet_groups (
+            carrier TEXT NOT NULL,
+            region TEXT NOT NULL,
+            devices INTEGER NOT NULL,
+            PRIMARY KEY (carrier, region)
+        ) WITHOUT ROWID
+        """
+    )
+    c.execute("CREATE TABLE fleet_last_seen (hour TEXT PRIMARY KEY, devices INTEGER NOT NULL) WITHOUT ROWID")
+    c.execute("CREATE TABLE fleet_updates_hourly (hour INTEGER PRIMARY KEY, fixes INTEGER NOT NULL)")
+    c.execute(
+        """
+        INSERT INTO fleet_groups (carrier, region, devices)
+        SELECT COALESCE(carrier, ''), COALESCE(region, ''), COUNT(*) FROM devices
+        GROUP BY COALESCE(carrier, ''), COALESCE(region, '')
+        """
+    )
+    c.execute(
+        """
+        INSERT INTO fleet_last_seen (hour, devices)
+        SELECT COALESCE(substr(last_update, 1, 13), ''), COUNT(*) FROM devices
+        GROUP BY COALESCE(substr(last_update, 1, 13), '')
+        """
+    )
+    c.execute(
+        """
+        INSERT INTO fleet_updates_hourly (hour, fixes)
+        SELECT ts / 3600000, COUNT(*) FROM locations GROUP BY ts / 3600000
+        """
+    )
+    add_group = """
+        INSERT INTO fleet_groups (carrier, region, devices)
+        VALUES (COALESCE(NEW.carrier, ''), COALESCE(NEW.region, ''), 1)
+        ON CONFLICT (carrier, region) DO UPDATE SET devices = devices + 1;
+    """
+    drop_group = """
+        UPDATE fleet_groups SET devices = devices - 1
+        WHERE carrier = COALESCE(OLD.carrier, '') AND region = COALESCE(OLD.region, '');
+    """
+    add_seen = """
+        INSERT INTO fleet_last_seen (hour, devices)
+        VALUES (COALESCE(substr(NEW.last_update, 1, 13), ''), 1)
+        ON CONFLICT (hour) DO UPDATE SET devices = devices + 1;
+    """
+    drop_seen = """
+        UPDATE fleet_last_seen SET devices = devices - 1
+        WHERE hour = COALESCE(substr(OLD.last_update, 1, 13), '');
+    """
+    c.execute(f"CREATE TRIGGER fleet_devices_insert AFTER INSERT ON devices BEGIN {add_group} {add_seen} END")
+    c.execute(f"CREATE TRIGGER fleet_devices_delete AFTER DELETE ON devices BEGIN {drop_group} {drop_seen} END")
+    c.execute(
+        f"""
+        CREATE TRIGGER fleet_devices_group AFTER UPDATE OF carrier, region ON devices
+        WHEN OLD.carrier IS NOT NEW.carrier OR OLD.region IS NOT NEW.region
+        BEGIN {drop_group} {add_group} END
+        """
+    )
+    # Fires only when a device crosses into a new hour, not on every fix
+    c.execute(
+        f"""
+        CREATE TRIGGER fleet_devices_seen AFTER UPDATE OF last_update ON devices
+        WHEN substr(OLD.last_update, 1, 13) IS NOT substr(NEW.last_update, 1, 13)
+        BEGIN {drop_seen} {add_seen} END
+        """
+    )
+
+
+def _migrate_ingest_keys(c):
+    """v6: idempotency keys of recent agent posts, so a retried post is stored once."""
+    c.execute(
+        """
+        CREATE TABLE ingest_keys (
+            device_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            PRIMARY KEY (device_id, key)
+        ) WITHOUT ROWID
+        """
+    )
+    c.execute("CREATE INDEX idx_ingest_keys_ts ON ingest_keys(ts)")
+
+
+def _migrate_storage_layout(c):
+    """v7: how many shard files hold per-device history; 0 keeps it in this database."""
+    c.execute(
+        "CREATE TABLE storage_layout (id INTEGER PRIMARY KEY CHECK (id = 1), location_shards INTEGER NOT NULL)"
+    )
+    c.execute("INSERT INTO storage_layout (id, location_shards) VALUES (1, 0)")
+
+
+def _migrate_analytics_daily(c):
+    """v8: per-device, per-day trip/stop analytics, refreshed incrementally (see ``refresh_daily``).
+
+    ``day`` counts UTC days since the epoch. ``fixes``/``last_ts`` describe the
+    rows the entry was computed from and ``anchor_ts`` the fix before the day;
+    ``closed`` holds the part up to ``boundary_ts`` that later fixes cannot
+    change, ``result`` the whole day.
+    """
+    c.execute(
+        """
+        CREATE TABLE analytics_daily (
+            device_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            fixes INTEGER NOT NULL,
+            last_ts INTEGER NOT NULL,
+            anchor_ts INTEGER,
+            boundary_ts INTEGER,
+            closed TEXT,
+            result TEXT NOT NULL,
+            computed_at INTEGER NOT NULL,
+            PRIMARY KEY (device_id, day)
+        ) WITHOUT ROWID
+        """
+    )
+    c.execute("CREATE INDEX idx_analytics_daily_day ON analytics_daily(day, device_id)")
+
+
+# Ordered schema migrations; PRAGMA user_version records how many have been applied
+MIGRATIONS = [
+    _migrate_locations_timeseries,
+    _migrate_spatial_index,
+    _migrate_devices_last_update_index,
+    _migrate_retention,
+    _migrate_fleet_aggregates,
+    _migrate_ingest_keys,
+    _migrate_storage_layout,
+    _migrate_analytics_daily,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def run_migrations(conn):
+    conn.isolation_level = None
+    c = conn.cursor()
+    if c.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return
+    for version, migrate in enumerate(MIGRATIONS, start=1):
+        # IMMEDIATE takes the write lock up front so concurrently booting workers
+        # re-check the version instead of racing through the same migration
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            if c.execute("PRAGMA user_version").fetchone()[0] < version:
+                migrate(c)
+                c.execute(f"PRAGMA user_version = {version}")
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
 
 
 def ensure_db():
+    global _schema_ready
     os.makedirs(DB_DIR, exist_ok=True)
-    conn = sqlite3.connect(DB_FILE)
+    conn = sqlite3.connect(DB_FILE, timeout=DB_BUSY_TIMEOUT)
     try:
         c = conn.cursor()
+        # Fast path for workers: a database at the current version needs no DDL
+        if c.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            _load_storage_layout(conn)
+            _schema_ready = True
+            return
+        # journal_mode is persistent in the file, so set it once alongside the schema
+        # auto_vacuum only takes effect on a brand-new file (and must precede the WAL switch);
+        # existing databases are converted with `flask retention --convert-vacuum`
+        c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        c.execute("PRAGMA journal_mode=WAL")
         c.execute(
             """
             CREATE TABLE IF NOT EXISTS users (
@@ -70,47 +580,807 @@ def ensure_db():
             """
         )
         conn.commit()
+        run_migrations(conn)
+        conn.isolation_level = ""
+        _load_storage_layout(conn)
     finally:
         conn.close()
+    _schema_ready = True
+
+
+def _load_storage_layout(conn):
+    """Read the shard count in use; a new database takes LOCATION_SHARDS."""
+    global _location_shards
+    shards = conn.execute("SELECT location_shards FROM storage_layout").fetchone()[0]
+    if shards != LOCATION_SHARDS:
+        if shards == 0 and LOCATION_SHARDS > 0 and conn.execute("SELECT 1 FROM locations LIMIT 1").fetchone() is None:
+            conn.execute("UPDATE storage_layout SET location_shards = ?", (LOCATION_SHARDS,))
+            conn.commit()
+            shards = LOCATION_SHARDS
+        else:
+            print(
+                f"WARNING: LOCATION_SHARDS={LOCATION_SHARDS} but the database uses {shards} shards; "
+                f"run `flask shards rebalance --shards {LOCATION_SHARDS}` to move it"
+            )
+    _location_shards = shards
+
+
+# Prometheus default latency buckets (seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250, 1000)
+
+
+class MetricsRegistry:
+    """Counters and histograms in Prometheus terms, kept per process.
+
+    Label values are passed as a tuple in the order of the metric's label
+    names. ``snapshot()``/``merge()`` let gunicorn workers publish to files
+    that ``/metrics`` adds up (see ``METRICS_DIR``).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._counters = {}
+        self._histograms = {}
+
+    def counter(self, name, help_text, labels=()):
+        self._meta[name] = ("counter", help_text, tuple(labels), None)
+        self._counters[name] = {}
+
+    def gauge(self, name, help_text, labels=()):
+        self._meta[name] = ("gauge", help_text, tuple(labels), None)
+        self._counters[name] = {}
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self._meta[name] = ("histogram", help_text, tuple(labels), tuple(buckets))
+        self._histograms[name] = {}
+
+    def inc(self, name, labels=(), value=1):
+        series = self._counters[name]
+        with self._lock:
+            series[labels] = series.get(labels, 0) + value
+
+    def set(self, name, labels=(), value=0):
+        """Set a gauge, or a counter whose running total is kept elsewhere."""
+        with self._lock:
+            self._counters[name][labels] = value
+
+    def observe(self, name, labels, value):
+        buckets = self._meta[name][3]
+        series = self._histograms[name]
+        with self._lock:
+            h = series.get(labels)
+            if h is None:
+                h = series[labels] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    h[0][i] += 1
+                    break
+            h[1] += value
+            h[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": {n: [[list(k), v] for k, v in s.items()] for n, s in self._counters.items()},
+                "histograms": {
+                    n: [[list(k), list(h[0]), h[1], h[2]] for k, h in s.items()] for n, s in self._histograms.items()
+                },
+            }
+
+    @staticmethod
+    def merge(snapshots):
+        counters = {}
+        histograms = {}
+        for snap in snapshots:
+            for name, series in snap.get("counters", {}).items():
+                out = counters.setdefault(name, {})
+                for labels, value in series:
+                    out[tuple(labels)] = out.get(tuple(labels), 0) + value
+            for name, series in snap.get("histograms", {}).items():
+                out = histograms.setdefault(name, {})
+                for labels, counts, total, count in series:
+                    h = out.setdefault(tuple(labels), [[0] * len(counts), 0.0, 0])
+                    h[0] = [a + b for a, b in zip(h[0], counts)]
+                    h[1] += total
+                    h[2] += count
+        return counters, histograms
+
+    def render(self, counters, histograms):
+        """Prometheus text exposition format (version 0.0.4)."""
+
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        def fmt(names, values, le=None):
+            pairs = list(zip(names, values))
+            if le is not None:
+                pairs.append(("le", le))
+            return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}" if pairs else ""
+
+        lines = []
+        for name, (kind, help_text, label_names, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind != "histogram":
+                for labels, value in sorted(counters.get(name, {}).items()):
+                    lines.append(f"{name}{fmt(label_names, labels)} {value}")
+                continue
+            for labels, (counts, total, count) in sorted(histograms.get(name, {}).items()):
+                cumulative = 0
+                for bound, n in zip(buckets, counts):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{fmt(label_names, labels, bound)} {cumulative}")
+                lines.append(f"{name}_bucket{fmt(label_names, labels, '+Inf')} {count}")
+                lines.append(f"{name}_sum{fmt(label_names, labels)} {total}")
+                lines.append(f"{name}_count{fmt(label_names, labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+METRICS.counter("http_requests_total", "HTTP requests by endpoint, method and status.", ("endpoint", "method", "status"))
+METRICS.histogram("http_request_duration_seconds", "Time to response headers.", ("endpoint", "method"))
+METRICS.histogram("db_statements_per_request", "SQL statements run by one request.", ("endpoint",), COUNT_BUCKETS)
+METRICS.histogram("db_time_per_request_seconds", "Time spent in SQL by one request.", ("endpoint",))
+METRICS.histogram("db_statement_duration_seconds", "SQL statement execution time by kind.", ("kind",))
+METRICS.histogram("db_connect_seconds", "Time to get this thread's pooled connection (opening it if needed).")
+METRICS.histogram("db_write_lock_wait_seconds", "Time BEGIN IMMEDIATE waited for the database write lock.")
+METRICS.counter("db_connections_opened_total", "SQLite connections opened.")
+METRICS.counter("cache_requests_total", "Cache lookups by cache and result.", ("cache", "result"))
+METRICS.counter("phonenumbers_parses_total", "phonenumbers parses (cache misses of phone_info).")
+METRICS.counter("sms_total", "SMS outcomes by kind and result.", ("kind", "result"))
+METRICS.counter("ingest_fixes_total", "Fixes written by store_fixes.")
+METRICS.counter("ingest_fixes_filtered_total", "Fixes dropped by the movement filter.")
+METRICS.counter("ingest_duplicates_total", "Posts ignored because their idempotency key was already stored.")
+METRICS.counter("ingest_dropped_total", "Queued fixes the ingest writer dropped because they could not be stored.")
+METRICS.counter("analytics_days_total", "Device-days analyzed, by source (cached, incremental, full).", ("source",))
+METRICS.counter("profiles_captured_total", "Slow-request profiles written to disk.")
+METRICS.gauge("ingest_queue_depth", "Fixes waiting in the write-behind ingest queue.")
+METRICS.gauge("sms_queue_depth", "SMS waiting to be sent.")
+METRICS.gauge("sms_circuit_open", "Workers whose SMS circuit breaker is open.")
+METRICS.gauge("live_subscribers", "Open Server-Sent Events streams.")
+
+# Per-thread tally of the SQL run by the current request: [statements, seconds]
+_metrics_local = threading.local()
+_SQL_KINDS = {"SELECT", "INSERT", "UPDATE", "DELETE", "BEGIN", "COMMIT", "PRAGMA", "WITH", "REPLACE"}
+
+
+def _observe_sql(sql, elapsed):
+    word = sql.lstrip()[:7].split(None, 1)
+    kind = word[0].upper() if word else ""
+    kind = kind if kind in _SQL_KINDS else "OTHER"
+    METRICS.observe("db_statement_duration_seconds", (kind,), elapsed)
+    if kind == "BEGIN" and "IMMEDIATE" in sql.upper():
+        METRICS.observe("db_write_lock_wait_seconds", (), elapsed)
+    tally = getattr(_metrics_local, "sql", None)
+    if tally is not None:
+        tally[0] += 1
+        tally[1] += elapsed
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records how long each statement takes to execute."""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _observe_sql(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _observe_sql(sql, time.perf_counter() - started)
+
+
+class PooledConnection(sqlite3.Connection):
+    """Long-lived per-thread connection.
+
+    Handlers keep their ``try/finally: conn.close()`` shape; ``close()`` only
+    discards an unfinished transaction so the connection can be reused.
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+        # Closing the main connection ends the request; drop what it left open in shards too
+        if self is getattr(_db_local, "conn", None):
+            for shard in _thread_shards():
+                if shard.in_transaction:
+                    shard.rollback()
+
+    def dispose(self):
+        super().close()
+
+
+def _open_connection():
+    conn = sqlite3.connect(
+        DB_FILE,
+        timeout=DB_BUSY_TIMEOUT,
+        cached_statements=DB_STATEMENT_CACHE,
+        factory=PooledConnection,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    return conn
 
 
 def db_connect():
-    ensure_db()
-    conn = sqlite3.connect(DB_FILE)
+    """Return this thread's connection, opening it on first use (or after a fork)."""
+    started = time.perf_counter()
+    if not _schema_ready:
+        ensure_db()
+    conn = getattr(_db_local, "conn", None)
+    if conn is None or _db_local.pid != os.getpid():
+        conn = _open_connection()
+        _db_local.conn = conn
+        _db_local.pid = os.getpid()
+        METRICS.inc("db_connections_opened_total")
+    METRICS.observe("db_connect_seconds", (), time.perf_counter() - started)
+    return conn
+
+
+def db_dispose():
+    """Really close this thread's pooled connections (tests, shutdown hooks)."""
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None and _db_local.pid == os.getpid():
+        conn.dispose()
+    _db_local.conn = None
+    for shard in _thread_shards():
+        shard.dispose()
+    _db_local.shards = None
+
+
+# Per-device tables kept in each shard file, with the same layout as in app.db
+SHARD_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS locations (
+        device_id INTEGER NOT NULL,
+        ts INTEGER NOT NULL,
+        lat REAL NOT NULL,
+        lng REAL NOT NULL,
+        PRIMARY KEY (device_id, ts)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS ingest_keys (
+        device_id INTEGER NOT NULL,
+        key TEXT NOT NULL,
+        ts INTEGER NOT NULL,
+        PRIMARY KEY (device_id, key)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_ingest_keys_ts ON ingest_keys(ts)",
+    """
+    CREATE TABLE IF NOT EXISTS retention_state (
+        device_id INTEGER NOT NULL,
+        res_ms INTEGER NOT NULL,
+        done_until INTEGER NOT NULL,
+        PRIMARY KEY (device_id, res_ms)
+    ) WITHOUT ROWID
+    """,
+]
+SHARD_TABLES = ("locations", "ingest_keys", "retention_state")
+
+
+def shard_path(index, shards=None):
+    shards = _location_shards if shards is None else shards
+    return os.path.join(SHARD_DIR, f"locations-{index:03d}-of-{shards:03d}.db")
+
+
+def open_shard(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(
+        path,
+        timeout=DB_BUSY_TIMEOUT,
+        cached_statements=DB_STATEMENT_CACHE,
+        factory=PooledConnection,
+    )
     conn.row_factory = sqlite3.Row
+    # auto_vacuum only sticks on a new file, and must precede the WAL switch
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    for ddl in SHARD_SCHEMA:
+        conn.execute(ddl)
+    conn.commit()
     return conn
 
 
-def lookup_device_db(imei=None, phone=None):
+def _thread_shards():
+    shards = getattr(_db_local, "shards", None)
+    if not shards or _db_local.shards_pid != os.getpid():
+        return []
+    return list(shards.values())
+
+
+def shard_connect(index):
+    """This thread's connection to shard ``index`` of the current layout."""
+    if not _schema_ready:
+        ensure_db()
+    shards = getattr(_db_local, "shards", None)
+    if shards is None or _db_local.shards_pid != os.getpid():
+        shards = _db_local.shards = {}
+        _db_local.shards_pid = os.getpid()
+    path = shard_path(index)
+    conn = shards.get(path)
+    if conn is None:
+        conn = shards[path] = open_shard(path)
+        METRICS.inc("db_connections_opened_total")
+    return conn
+
+
+def shard_of(device_id):
+    return device_id % _location_shards
+
+
+def location_db(device_id):
+    """Connection holding ``device_id``'s locations, idempotency keys and retention state.
+
+    Without shards this is the thread's main connection, so history writes join
+    the caller's transaction; with shards it is the device's shard, which has
+    its own write lock.
+    """
+    if not _schema_ready:
+        ensure_db()
+    if not _location_shards:
+        return db_connect()
+    return shard_connect(shard_of(device_id))
+
+
+def group_by_shard(items, key=lambda item: item[0]):
+    """``{shard_index: [item, ...]}`` for items whose ``key`` is a device id (one group without shards)."""
+    groups = {}
+    for item in items:
+        groups.setdefault(shard_of(key(item)) if _location_shards else 0, []).append(item)
+    return groups
+
+
+def commit_shards():
+    for conn in _thread_shards():
+        if conn.in_transaction:
+            conn.commit()
+
+
+def db_commit(conn):
+    """Commit this thread's shard transactions (e.g. claimed idempotency keys), then ``conn``."""
+    commit_shards()
+    conn.commit()
+
+
+_shard_pool = None
+_shard_pool_pid = None
+
+
+def shard_map(fn, items):
+    """``[fn(item) for item in items]``, run on a thread pool when there are several.
+
+    SQLite releases the GIL while it reads, so per-shard queries overlap. Each
+    pool thread keeps its own pooled shard connections, so ``fn`` must get its
+    connection with ``shard_connect()`` rather than receive one.
+    """
+    global _shard_pool, _shard_pool_pid
+    items = list(items)
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    if _shard_pool is None or _shard_pool_pid != os.getpid():
+        _shard_pool = ThreadPoolExecutor(max_workers=max(_location_shards, 2), thread_name_prefix="shard")
+        _shard_pool_pid = os.getpid()
+    return list(_shard_pool.map(fn, items))
+
+
+def _prefetched_rows(index, sql, params, stop, chunk=2000):
+    """Yield rows of ``sql`` on shard ``index``, read ahead by a background thread."""
+    buf = queue.Queue(4)
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buf.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def produce():
+        conn = None
+        try:
+            # A connection of its own; pooled ones belong to the threads that opened them
+            conn = open_shard(shard_path(index))
+            cur = conn.execute(sql, params)
+            while not stop.is_set():
+                rows = cur.fetchmany(chunk)
+                put(rows)
+                if not rows:
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            if conn is not None:
+                conn.dispose()
+
+    threading.Thread(target=produce, name=f"shard-{index}-reader", daemon=True).start()
+    while True:
+        rows = buf.get()
+        if isinstance(rows, Exception):
+            raise rows
+        if not rows:
+            return
+        yield from rows
+
+
+def merged_shard_rows(sql, params=()):
+    """Rows of ``sql`` from every shard, each read by its own thread, merged on the first two columns.
+
+    ``sql`` must order by those columns (e.g. ``ORDER BY device_id, ts``).
+    """
+    stop = threading.Event()
+    streams = [_prefetched_rows(i, sql, params, stop) for i in range(_location_shards)]
+    try:
+        yield from heapq.merge(*streams, key=lambda row: (row[0], row[1]))
+    finally:
+        stop.set()
+
+
+class TTLCache:
+    """Thread-safe, bounded LRU mapping whose entries expire after ``ttl`` seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_device_auth_cache = TTLCache(DEVICE_CACHE_SIZE, DEVICE_CACHE_TTL)
+
+
+def invalidate_device_auth(imei=None, phone=None, device_id=None):
+    """Drop cached credentials after a device is added or its token changes.
+
+    The cache is per process; other workers pick up the change when their entry
+    expires (``DEVICE_CACHE_TTL``), or immediately for the new token since a
+    mismatch always falls through to the database. Sessions are checked against
+    the token cached under the device id, so they end with the token.
+    """
+    if imei:
+        _device_auth_cache.pop(("imei", imei))
+    if phone:
+        _device_auth_cache.pop(("phone", phone))
+    if device_id is not None:
+        _device_auth_cache.pop(("id", device_id))
+
+
+def token_matches(given, expected):
+    if not isinstance(given, str) or not expected:
+        return False
+    return secrets.compare_digest(given.encode(), expected.encode())
+
+
+def authenticate_device(c, imei, phone, token):
+    """Resolve an agent's credentials to a device id.
+
+    Returns ``(device_id, None)`` on success or ``(None, (error, status))``.
+    """
+    key = ("imei", imei) if imei else ("phone", phone)
+    cached = _device_auth_cache.get(key)
+    if cached is not None and token_matches(token, cached[1]):
+        return cached[0], None
+    # Cache miss, or a token that may have been regenerated since we cached it
+    if imei:
+        c.execute("SELECT id, api_token FROM devices WHERE imei = ?", (imei,))
+    else:
+        c.execute("SELECT id, api_token FROM devices WHERE phone = ?", (phone,))
+    row = c.fetchone()
+    if not row:
+        return None, ("device not found", 404)
+    _device_auth_cache.set(key, (row["id"], row["api_token"]))
+    if not token_matches(token, row["api_token"]):
+        return None, ("invalid token", 401)
+    return row["id"], None
+
+
+class MemoryCacheBackend:
+    """Per-process LRU. Other workers only see an invalidation once their own entry expires."""
+
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize, ttl)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value):
+        self._cache.set(key, value)
+
+    def delete(self, key):
+        self._cache.pop(key)
+
+    def clear(self):
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class SqliteCacheBackend:
+    """LRU cache in a SQLite file that every worker on the host opens.
+
+    Recency is refreshed at most every ``touch`` seconds per entry so most hits
+    stay reads, and every ``PRUNE_EVERY`` writes expired rows are dropped and the
+    least recently used ones trimmed to ``maxsize``. The file is disposable: it
+    runs with ``synchronous=OFF`` and any SQLite error is treated as a miss.
+    """
+
+    PRUNE_EVERY = 100
+
+    def __init__(self, path, maxsize, ttl):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.touch = min(ttl / 10.0, 5.0)
+        self._local = threading.local()
+        self._writes = itertools.count(1)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=0.5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entries "
+                "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL, atime REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_entries_atime ON cache_entries(atime)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        try:
+            conn = self._conn()
+            row = conn.execute("SELECT value, expires, atime FROM cache_entries WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] < now:
+                return None
+            if now - row[2] > self.touch:
+                conn.execute("UPDATE cache_entries SET atime = ? WHERE key = ?", (now, key))
+            return bytes(row[0])
+        except sqlite3.Error as e:
+            print("ERROR in response cache get:", e)
+            return None
+
+    def set(self, key, value):
+        now = time.time()
+        try:
+            conn = self._conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache_entries (key, value, expires, atime) VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl, now),
+            )
+            if next(self._writes) % self.PRUNE_EVERY == 0:
+                self.prune(now)
+        except sqlite3.Error as e:
+            print("ERROR in response cache set:", e)
+
+    def delete(self, key):
+        try:
+            self._conn().execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            print("ERROR in response cache delete:", e)
+
+    def prune(self, now=None):
+        conn = self._conn()
+        conn.execute("DELETE FROM cache_entries WHERE expires < ?", (now or time.time(),))
+        excess = conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0] - self.maxsize
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM cache_entries WHERE key IN (SELECT key FROM cache_entries ORDER BY atime LIMIT ?)",
+                (excess,),
+            )
+
+    def clear(self):
+        try:
+            self._conn().execute("DELETE FROM cache_entries")
+        except sqlite3.Error as e:
+            print("ERROR in response cache clear:", e)
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+
+
+CACHE_BACKENDS = {
+    "memory": lambda: MemoryCacheBackend(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL),
+    "sqlite": lambda: SqliteCacheBackend(RESPONSE_CACHE_PATH, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL),
+}
+
+
+def load_cache_backend(name):
+    if name in ("", "off") or RESPONSE_CACHE_SIZE <= 0:
+        return None
+    factory = CACHE_BACKENDS.get(name)
+    if factory is None:
+        import importlib
+
+        module, _, attr = name.partition(":")
+        factory = getattr(importlib.import_module(module), attr)
+    return factory()
+
+
+class ResponseCache:
+    """Read-through cache of serialized JSON responses, keyed by device.
+
+    Every device has a generation token in the backend. Entries are stored
+    under the generation read *before* the database was queried, and
+    ``invalidate()`` drops the token, so an entry filled by a read that raced
+    a write is never served: the next reader mints a new generation and the
+    old entries age out of the LRU. Backends only need ``get``/``set``/
+    ``delete`` on bytes.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def generation(self, device_id):
+        key = f"gen:{device_id}"
+        gen = self.backend.get(key)
+        if gen is None:
+            gen = secrets.token_hex(8).encode()
+            self.backend.set(key, gen)
+        return gen.decode()
+
+    def fetch(self, kind, device_id, variant, build):
+        """Return ``(body, etag)`` for ``build()``'s payload, or None when it returns None (not cached)."""
+        if self.backend is None:
+            payload = build()
+            return serialize_view(payload) if payload is not None else None
+        key = f"{kind}:{device_id}:{self.generation(device_id)}:{variant}"
+        value = self.backend.get(key)
+        if value is not None:
+            METRICS.inc("cache_requests_total", (kind, "hit"))
+            etag, _, body = value.partition(b" ")
+            return body, etag.decode()
+        METRICS.inc("cache_requests_total", (kind, "miss"))
+        payload = build()
+        if payload is None:
+            return None
+        body, etag = serialize_view(payload)
+        self.backend.set(key, etag.encode() + b" " + body)
+        return body, etag
+
+    def invalidate(self, device_ids):
+        if self.backend is None:
+            return
+        for device_id in device_ids:
+            self.backend.delete(f"gen:{device_id}")
+
+
+response_cache = ResponseCache(load_cache_backend(RESPONSE_CACHE_BACKEND))
+
+
+def serialize_view(payload):
+    body = json.dumps(payload, separators=(",", ":")).encode()
+    return body, hashlib.sha1(body).hexdigest()[:20]
+
+
+def view_response(view):
+    """Serve a cached ``(body, etag)``, answering ``If-None-Match`` with 304."""
+    body, etag = view
+    resp = app.response_class(body, mimetype="application/json")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp.make_conditional(request)
+
+
+def _device_view_payload(device_id):
     conn = db_connect()
     try:
         c = conn.cursor()
-        if imei:
-            c.execute("SELECT * FROM devices WHERE imei = ?", (imei,))
-        elif phone:
-            c.execute("SELECT * FROM devices WHERE phone = ?", (phone,))
-        else:
-            return None
+        c.execute("SELECT * FROM devices WHERE id = ?", (device_id,))
         row = c.fetchone()
         if not row:
             return None
         device = dict(row)
-        c.execute("""
+        device.pop("api_token", None)
+        cur = location_db(device_id).execute("""
             SELECT lat, lng, ts 
             FROM locations 
             WHERE device_id = ? 
             ORDER BY ts DESC 
             LIMIT 30
-        """, (row["id"],))
-        locs = [dict(r) for r in reversed(c.fetchall())]
+        """, (device_id,))
+        locs = [dict(r) for r in reversed(cur.fetchall())]
         device["locations"] = locs
         if device.get("last_lat") is not None and device.get("last_lng") is not None:
             device["last_location"] = {"lat": device["last_lat"], "lng": device["last_lng"]}
         else:
             device["last_location"] = None
-        return device
+        return {"ok": True, "device": device}
+    finally:
+        conn.close()
+
+
+def device_view(device_id):
+    """``(body, etag)`` of the device's JSON view with its 30 most recent fixes, or None."""
+    return response_cache.fetch("device_view", device_id, "", lambda: _device_view_payload(device_id))
+
+
+def resolve_device_id(imei=None, phone=None):
+    """Device id for an IMEI or phone, through the credential cache (ids never change)."""
+    key = ("imei", imei) if imei else ("phone", phone)
+    cached = _device_auth_cache.get(key)
+    if cached is not None:
+        return cached[0]
+    conn = db_connect()
+    try:
+        if imei:
+            row = conn.execute("SELECT id, api_token FROM devices WHERE imei = ?", (imei,)).fetchone()
+        else:
+            row = conn.execute("SELECT id, api_token FROM devices WHERE phone = ?", (phone,)).fetchone()
     finally:
         conn.close()
+    if not row:
+        return None
+    _device_auth_cache.set(key, (row["id"], row["api_token"]))
+    return row["id"]
+
+
+def lookup_device_db(imei=None, phone=None):
+    if not imei and not phone:
+        return None
+    device_id = resolve_device_id(imei, phone)
+    view = device_view(device_id) if device_id is not None else None
+    if view is None:
+        return None
+    return json.loads(view[0])["device"]
 
 
 def get_user_by_username_db(username):
@@ -144,67 +1414,402 @@ def ensure_initial_admin():
         conn.close()
 
 
-def send_2fa_code(phone, code):
-    if not (VONAGE_API_KEY and VONAGE_API_SECRET and VONAGE_FROM_NUMBER):
-        raise RuntimeError("Vonage not configured for 2FA")
-    payload = {
-        "api_key": VONAGE_API_KEY,
-        "api_secret": VONAGE_API_SECRET,
-        "from": (VONAGE_FROM_NUMBER or "").replace(" ", ""),
-        "to": phone,
-        "text": f"Your verification code is: {code}",
-    }
-    r = requests.post("https://rest.nexmo.com/sms/json", data=payload, timeout=10)
-    r.raise_for_status()
-    resp = r.json()
-    messages = resp.get("messages", [])
-    if not messages or messages[0].get("status") != "0":
-        raise Exception(f"Vonage send failed: {messages[0].get('error-text') if messages else 'unknown'}")
+class SmsError(Exception):
+    """A failed SMS send; ``retryable`` marks transient provider or network errors."""
 
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
 
-# Initialize DB and seed admin at import time
-ensure_db()
-ensure_initial_admin()
-AGENT_DOWNLOAD_URL = os.environ.get("AGENT_DOWNLOAD_URL")
-# Hardcoded Vonage credentials per user request; env vars still override if set
-VONAGE_API_KEY = os.environ.get("VONAGE_API_KEY") or "TzjCqBi6z4VtzNOp"
-VONAGE_API_SECRET = os.environ.get("VONAGE_API_SECRET") or "5OAQwcgoX89WG3Q62yc1j8ZtRJ3WPlxzjbvX9kvoBG3kuVR3Yb"
-VONAGE_FROM_NUMBER = os.environ.get("VONAGE_FROM_NUMBER") or "+263 77 111 2812"
 
+class VonageProvider:
+    """Vonage SMS API over one keep-alive ``requests.Session`` shared by the dispatch workers."""
 
-def is_imei(candidate: str) -> bool:
-    s = candidate.strip()
-    if not s.isdigit():
-        return False
-    # IMEI is typically 15 digits and uses Luhn checksum
-    if len(s) != 15:
-        return False
-    return luhn_check(s)
+    # Throttled, internal error, communication failed
+    RETRYABLE_STATUSES = {"1", "5", "13"}
 
+    def __init__(self):
+        self._session = None
+        self._lock = threading.Lock()
 
-def luhn_check(number: str) -> bool:
-    total = 0
-    reverse_digits = number[::-1]
-    for i, ch in enumerate(reverse_digits):
-        d = int(ch)
-        if i % 2 == 1:
-            d *= 2
+    def configured(self):
+        return bool(VONAGE_API_KEY and VONAGE_API_SECRET and VONAGE_FROM_NUMBER)
+
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                self._session = requests.Session()
+                self._session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=SMS_WORKERS))
+                self._session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=SMS_WORKERS))
+            return self._session
+
+    def send(self, to, text):
+        import requests
+
+        payload = {
+            "api_key": VONAGE_API_KEY,
+            "api_secret": VONAGE_API_SECRET,
+            "from": (VONAGE_FROM_NUMBER or "").replace(" ", ""),
+            "to": to,
+            "text": text,
+        }
+        try:
+            r = self.session().post(VONAGE_API_URL, data=payload, timeout=(3.05, SMS_TIMEOUT))
+        except requests.RequestException as e:
+            raise SmsError(f"Vonage request failed: {e}", retryable=True)
+        if r.status_code == 429 or r.status_code >= 500:
+            raise SmsError(f"Vonage HTTP {r.status_code}", retryable=True)
+        if r.status_code >= 400:
+            raise SmsError(f"Vonage HTTP {r.status_code}")
+        try:
+            messages = r.json().get("messages", [])
+        except ValueError:
+            raise SmsError("Vonage returned invalid JSON", retryable=True)
+        if not messages or messages[0].get("status") != "0":
+            status = messages[0].get("status") if messages else None
+            raise SmsError(
+                f"Vonage send failed: {messages[0].get('error-text') if messages else 'unknown'}",
+                retryable=status in self.RETRYABLE_STATUSES,
+            )
+
+
+class LogProvider:
+    """Prints messages instead of sending them (development)."""
+
+    def configured(self):
+        return True
+
+    def send(self, to, text):
+        print(f"SMS to {to}: {text}")
+
+
+# SMS_PROVIDER picks one of these, or names a factory as "module:attribute"
+SMS_PROVIDERS = {"vonage": VonageProvider, "log": LogProvider}
+
+
+def load_sms_provider(name):
+    factory = SMS_PROVIDERS.get(name)
+    if factory is None:
+        import importlib
+
+        module, _, attr = name.partition(":")
+        factory = getattr(importlib.import_module(module), attr)
+    return factory()
+
+
+class CircuitBreaker:
+    """Fails fast after ``threshold`` consecutive failures, letting one trial call through every ``cooldown`` seconds."""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+
+    def is_open(self):
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.cooldown
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                # Half-open: re-arm the timer so only this caller probes the provider
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    self.trips += 1
+                self.opened_at = time.monotonic()
+
+
+class SmsJob:
+    __slots__ = ("to", "text", "kind", "done", "error", "attempts")
+
+    def __init__(self, to, text, kind):
+        self.to = to
+        self.text = text
+        self.kind = kind
+        self.done = threading.Event()
+        self.error = None
+        self.attempts = 0
+
+
+class SmsDispatcher:
+    """Sends SMS from a small pool of background threads.
+
+    Requests enqueue a job and return at once. Transient failures are retried
+    with exponential backoff; after repeated failures a circuit breaker makes
+    new sends fail fast until the provider has had time to recover.
+    """
+
+    def __init__(self, provider, workers, maxsize):
+        self.provider = provider
+        self.workers = workers
+        self.breaker = CircuitBreaker(SMS_BREAKER_THRESHOLD, SMS_BREAKER_COOLDOWN)
+        self._queue = queue.Queue(maxsize)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.rejected = 0
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid() and all(t.is_alive() for t in self._threads):
+                return
+            if self._pid is None:
+                atexit.register(self.stop)
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._threads = [
+                threading.Thread(target=self._run, name=f"sms-{i}", daemon=True) for i in range(self.workers)
+            ]
+            for t in self._threads:
+                t.start()
+
+    def submit(self, to, text, kind="sms"):
+        """Queue a message and return its ``SmsJob``; raises ``SmsError`` if it cannot be accepted."""
+        if not self.provider.configured():
+            raise SmsError("SMS provider is not configured")
+        if self.breaker.is_open():
+            raise SmsError("SMS provider is unavailable, try again shortly")
+        self.start()
+        job = SmsJob(to, text, kind)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            self.rejected += 1
+            METRICS.inc("sms_total", (kind, "rejected"))
+            raise SmsError("SMS queue is full, try again shortly")
+        return job
+
+    def stop(self, timeout=10.0):
+        """Let the workers finish what is queued, then exit."""
+        self._stop.set()
+        if self._pid == os.getpid():
+            deadline = time.monotonic() + timeout
+            for t in self._threads:
+                t.join(max(0.0, deadline - time.monotonic()))
+
+    def _run(self):
+        while True:
+            try:
+                job = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return
+                continue
+            self._deliver(job)
+            job.done.set()
+
+    def _deliver(self, job):
+        delay = SMS_BACKOFF
+        while True:
+            if not self.breaker.allow():
+                job.error = "SMS provider is unavailable"
+                break
+            job.attempts += 1
+            try:
+                self.provider.send(job.to, job.text)
+                job.error = None
+                self.breaker.record(True)
+                self.sent += 1
+                METRICS.inc("sms_total", (job.kind, "sent"))
+                return
+            except SmsError as e:
+                job.error = str(e)
+                retryable = e.retryable
+            except Exception as e:
+                job.error = str(e)
+                retryable = False
+            self.breaker.record(not retryable)
+            if not retryable or job.attempts > SMS_MAX_RETRIES or self._stop.is_set():
+                break
+            self.retries += 1
+            METRICS.inc("sms_total", (job.kind, "retried"))
+            # Full jitter keeps a burst of retries from hitting the provider in lockstep
+            time.sleep(delay * (0.5 + secrets.randbelow(1000) / 1000.0))
+            delay *= 2
+        self.failed += 1
+        METRICS.inc("sms_total", (job.kind, "failed"))
+        print(f"ERROR in SMS dispatch ({job.kind} to {job.to}):", job.error)
+
+    def stats(self):
+        return {
+            "provider": SMS_PROVIDER,
+            "workers": self.workers,
+            "depth": self._queue.qsize(),
+            "capacity": self._queue.maxsize,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "rejected_full": self.rejected,
+            "circuit_open": self.breaker.is_open(),
+            "circuit_trips": self.breaker.trips,
+        }
+
+
+sms_dispatcher = SmsDispatcher(load_sms_provider(SMS_PROVIDER), SMS_WORKERS, SMS_QUEUE_SIZE)
+
+
+def send_2fa_code(phone, code):
+    """Queue a 2FA code and wait up to ``SMS_2FA_WAIT`` seconds for it to go out.
+
+    Raises ``SmsError`` if the code could not be queued or the provider refused
+    it. Returns the ``SmsJob``; ``job.done`` is still clear if sending took longer.
+    """
+    job = sms_dispatcher.submit(phone, f"Your verification code is: {code}", kind="2fa")
+    if job.done.wait(SMS_2FA_WAIT) and job.error:
+        raise SmsError(job.error)
+    return job
+
+
+def issue_2fa_code(user):
+    """Text a fresh code to ``user``'s phone and park the login in the session until it is verified."""
+    normalized = normalize_phone(user.get("phone"))
+    if not normalized:
+        raise RuntimeError("User phone invalid for 2FA")
+    code = f"{secrets.randbelow(1000000):06d}"
+    job = send_2fa_code(normalized, code)
+    now = datetime.utcnow().timestamp()
+    session["pending_user"] = {"username": user["username"], "role": user.get("role", "viewer")}
+    session["twofa_code"] = code
+    session["twofa_expires"] = now + 300  # 5 minutes
+    session["twofa_sent"] = now
+    return job
+
+
+@contextmanager
+def boot_phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        BOOT_TIMINGS.append((name, (time.perf_counter() - started) * 1000.0))
+
+
+def format_boot_report():
+    total = sum(ms for _, ms in BOOT_TIMINGS)
+    lines = [f"boot report (pid {os.getpid()}, {total:.1f} ms total):"]
+    lines += [f"  {name:<24} {ms:9.1f} ms" for name, ms in BOOT_TIMINGS]
+    return "\n".join(lines)
+
+
+def preload_phone_metadata():
+    """Import the geocoder/carrier datasets now, e.g. in a pre-fork master so workers share the pages."""
+    with boot_phase("phone metadata"):
+        from phonenumbers import geocoder, carrier  # noqa: F401
+
+
+def init_app_data():
+    """One-time setup: schema, migrations and admin seeding.
+
+    Run from the gunicorn master (``on_starting``), ``flask init-db`` or
+    ``python app.py``; workers only check the schema version.
+    """
+    global _admin_checked
+    with boot_phase("schema + migrations"):
+        ensure_db()
+    with boot_phase("admin seed"):
+        ensure_initial_admin()
+        _admin_checked = True
+    # Do not carry an open SQLite handle across fork
+    db_dispose()
+
+
+_admin_checked = False
+AGENT_DOWNLOAD_URL = os.environ.get("AGENT_DOWNLOAD_URL")
+# Hardcoded Vonage credentials per user request; env vars still override if set
+VONAGE_API_KEY = os.environ.get("VONAGE_API_KEY") or "TzjCqBi6z4VtzNOp"
+VONAGE_API_SECRET = os.environ.get("VONAGE_API_SECRET") or "5OAQwcgoX89WG3Q62yc1j8ZtRJ3WPlxzjbvX9kvoBG3kuVR3Yb"
+VONAGE_FROM_NUMBER = os.environ.get("VONAGE_FROM_NUMBER") or "+263 77 111 2812"
+
+
+def is_imei(candidate: str) -> bool:
+    s = candidate.strip()
+    if not s.isdigit():
+        return False
+    # IMEI is typically 15 digits and uses Luhn checksum
+    if len(s) != 15:
+        return False
+    return luhn_check(s)
+
+
+def luhn_check(number: str) -> bool:
+    total = 0
+    reverse_digits = number[::-1]
+    for i, ch in enumerate(reverse_digits):
+        d = int(ch)
+        if i % 2 == 1:
+            d *= 2
             if d > 9:
                 d -= 9
         total += d
     return total % 10 == 0
 
 
-def normalize_phone(number_str: str):
+PhoneInfo = namedtuple("PhoneInfo", ["e164", "carrier", "region"])
+
+
+@lru_cache(maxsize=PHONE_CACHE_SIZE)
+def phone_info(number_str: str):
+    """Parse, validate and describe a phone number once; results are memoized.
+
+    Returns a PhoneInfo with the E.164 form and English carrier/region
+    descriptions, or None if the number is not valid.
+    """
+    # Imported lazily; the geocoder data alone takes ~250 ms to load
+    from phonenumbers import geocoder, carrier
     try:
         pn = phonenumbers.parse(number_str, None)
         if not phonenumbers.is_valid_number(pn):
             return None
-        return phonenumbers.format_number(pn, phonenumbers.PhoneNumberFormat.E164)
+        return PhoneInfo(
+            phonenumbers.format_number(pn, phonenumbers.PhoneNumberFormat.E164),
+            carrier.name_for_number(pn, "en"),
+            geocoder.description_for_number(pn, "en"),
+        )
     except Exception:
         return None
 
 
+def normalize_phone(number_str: str):
+    info = phone_info(number_str) if isinstance(number_str, str) else None
+    return info.e164 if info else None
+
+
+def enrich_phones(numbers):
+    """Describe many numbers in one pass, parsing each distinct value once.
+
+    Returns ``{number: PhoneInfo or None}`` for every non-empty string given;
+    other values (numbers, lists from a JSON upload) are skipped, so callers
+    must check the type before looking a number up.
+    """
+    out = {}
+    for number in numbers:
+        if isinstance(number, str) and number and number not in out:
+            out[number] = phone_info(number)
+    return out
+
+
 def require_login():
     if not session.get("user"):
         flash("Please log in.", "error")
@@ -246,12 +1851,13 @@ def add_device():
         if imei:
             if not is_imei(imei):
                 errors.append("IMEI must be a valid 15-digit number.")
+        info = None
         if phone:
-            normalized = normalize_phone(phone)
-            if not normalized:
+            info = phone_info(phone)
+            if not info:
                 errors.append("Phone number must be valid and include country code.")
             else:
-                phone = normalized
+                phone = info.e164
 
         if not imei and not phone:
             errors.append("Provide at least IMEI or phone number.")
@@ -277,14 +1883,15 @@ def add_device():
                     flash("A device with the same phone already exists.", "error")
                     return render_template("add.html", form={"owner": owner, "imei": imei, "phone": phone})
 
-            carrier_name = carrier.name_for_number(phonenumbers.parse(phone), "en") if phone else None
-            region_name = geocoder.description_for_number(phonenumbers.parse(phone), "en") if phone else None
+            carrier_name = info.carrier if info else None
+            region_name = info.region if info else None
             api_token = secrets.token_urlsafe(24)
             c.execute(
                 "INSERT INTO devices (owner, imei, phone, carrier, region, api_token, last_update, last_lat, last_lng) VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, NULL)",
                 (owner or None, imei or None, phone or None, carrier_name, region_name, api_token),
             )
             conn.commit()
+            invalidate_device_auth(imei, phone)
         finally:
             conn.close()
         flash("Device added.", "success")
@@ -310,322 +1917,3572 @@ def search():
         result = lookup_device_db(imei=query)
         context["result"] = result
     else:
-        normalized = normalize_phone(query)
-        if normalized:
-            result = lookup_device_db(phone=normalized)
+        info = phone_info(query)
+        if info:
+            result = lookup_device_db(phone=info.e164)
             context["result"] = result
-            # Coarse region and carrier for phone numbers
-            parsed = phonenumbers.parse(normalized)
-            context["coarse"] = {
-                "region": geocoder.description_for_number(parsed, "en"),
-                "carrier": carrier.name_for_number(parsed, "en"),
-            }
+            # Coarse region and carrier for phone numbers, preferring what was stored with the device
+            if result and result.get("carrier") is not None and result.get("region") is not None:
+                context["coarse"] = {"region": result["region"], "carrier": result["carrier"]}
+            else:
+                context["coarse"] = {"region": info.region, "carrier": info.carrier}
         else:
             flash("Invalid IMEI or phone number.", "error")
             return redirect(url_for("index"))
 
     return render_template("index.html", **context)
 
+
+BULK_COLUMNS = ["query", "kind", "status", "device_id", "owner", "imei", "phone", "carrier", "region",
+                "last_update", "last_lat", "last_lng", "history"]
+BULK_CHUNK = 500
+
+
+def split_queries(text):
+    """Identifiers from pasted text: one per line, or separated by commas, semicolons or tabs."""
+    for line in text.splitlines():
+        for part in line.replace(";", ",").replace("\t", ",").split(","):
+            if part.strip():
+                yield part.strip()
+
+
+def iter_csv_queries(file):
+    """Identifiers from an uploaded CSV, read incrementally.
+
+    With a header row, values of the ``query``, ``imei`` and ``phone`` columns
+    are used; otherwise the first column of every row.
+    """
+    reader = csv.reader(io.TextIOWrapper(file.stream, encoding="utf-8-sig", newline=""))
+    columns = None
+    for i, row in enumerate(reader):
+        if i == 0:
+            names = [cell.strip().lower() for cell in row]
+            picked = [j for j, name in enumerate(names) if name in ("query", "imei", "phone", "identifier")]
+            if picked:
+                columns = picked
+                continue
+        for j in (columns if columns is not None else [0]):
+            if j < len(row) and row[j].strip():
+                yield row[j].strip()
+
+
+def bulk_lookup(c, queries, history=0):
+    """Resolve a chunk of identifiers; returns one result dict per query, in order.
+
+    IMEIs and phones are each matched with one ``IN (...)`` query, and the
+    recent history of every match is read with a single ``UNION ALL`` of
+    per-device index range reads.
+    """
+    phones = enrich_phones(q for q in queries if not is_imei(q))
+    classified = []
+    for q in queries:
+        if is_imei(q):
+            classified.append((q, "imei", q))
+        elif phones.get(q) is not None:
+            classified.append((q, "phone", phones[q].e164))
+        else:
+            classified.append((q, "invalid", None))
+    found = {}
+    for kind in ("imei", "phone"):
+        keys = list({key for _, k, key in classified if k == kind})
+        for start in range(0, len(keys), BULK_CHUNK):
+            chunk = keys[start:start + BULK_CHUNK]
+            c.execute(
+                f"SELECT id, owner, imei, phone, carrier, region, last_update, last_lat, last_lng "
+                f"FROM devices WHERE {kind} IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for row in c.fetchall():
+                found[(kind, row[kind])] = dict(row)
+    tracks = {}
+    if history > 0 and found:
+        ids = list({d["id"] for d in found.values()})
+        for device_id, lat, lng, ts in recent_history(c, ids, history):
+            tracks.setdefault(device_id, []).append({"lat": lat, "lng": lng, "ts": ts})
+    results = []
+    for q, kind, key in classified:
+        device = found.get((kind, key)) if key else None
+        result = {"query": q, "kind": kind, "status": "invalid" if kind == "invalid" else ("found" if device else "not_found")}
+        if device:
+            result.update(device)
+            result["device_id"] = result.pop("id")
+            if history > 0:
+                result["history"] = list(reversed(tracks.get(device["id"], [])))
+        results.append(result)
+    return results
+
+
+def recent_history(c, device_ids, limit):
+    """``(device_id, lat, lng, ts)`` rows of each device's latest ``limit`` fixes, newest first.
+
+    One ``UNION ALL`` of per-device index range reads per 200 devices; with
+    shards each shard's devices are read on their own thread.
+    """
+    branch = "SELECT * FROM (SELECT device_id, lat, lng, ts FROM locations WHERE device_id = ? ORDER BY ts DESC LIMIT ?)"
+
+    def read(cur, ids):
+        rows = []
+        # SQLite caps compound SELECTs at 500 terms
+        for start in range(0, len(ids), 200):
+            chunk = ids[start:start + 200]
+            params = []
+            for device_id in chunk:
+                params += [device_id, limit]
+            rows += cur.execute(" UNION ALL ".join([branch] * len(chunk)), params).fetchall()
+        return rows
+
+    if not _location_shards:
+        return read(c, device_ids)
+    groups = group_by_shard(device_ids, key=lambda device_id: device_id)
+    parts = shard_map(lambda item: read(shard_connect(item[0]).cursor(), item[1]), groups.items())
+    return [row for part in parts for row in part]
+
+
+def _bulk_csv_stream(queries, history):
+    """Yield CSV text, resolving the input ``BULK_CHUNK`` identifiers at a time."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(BULK_COLUMNS)
+    conn = db_connect()
+    try:
+        chunk = []
+        for q in itertools.chain(queries, [None]):
+            if q is not None:
+                chunk.append(q)
+                if len(chunk) < BULK_CHUNK:
+                    continue
+            if not chunk:
+                break
+            for r in bulk_lookup(conn.cursor(), chunk, history):
+                row = [r.get(col) for col in BULK_COLUMNS]
+                if "history" in r:
+                    row[-1] = json.dumps(r["history"], separators=(",", ":"))
+                writer.writerow(row)
+            chunk = []
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    finally:
+        conn.close()
+
+
+@app.route("/search/bulk", methods=["GET", "POST"])
+def bulk_search():
+    """Resolve many IMEIs/phones at once from pasted text, a CSV upload or a JSON list.
+
+    Answers with JSON (JSON body or ``Accept: application/json``), streamed CSV
+    (``format=csv``), or the results page.
+    """
+    gate = require_login()
+    if gate:
+        return gate
+    if request.method == "GET":
+        return render_template("bulk_search.html", results=None)
+    payload = request.get_json(silent=True) if request.is_json else None
+    if payload is not None and not isinstance(payload, dict):
+        return jsonify({"ok": False, "error": "invalid payload"}), 400
+    wants_json = payload is not None or request.accept_mimetypes.best == "application/json"
+    source = payload if payload is not None else request.form
+    try:
+        history = min(max(int(source.get("history") or 0), 0), SEARCH_BULK_HISTORY_MAX)
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "invalid history"}), 400
+    file = request.files.get("file")
+    if payload is not None:
+        raw = payload.get("queries")
+        if not isinstance(raw, list):
+            return jsonify({"ok": False, "error": "queries must be a list"}), 400
+        queries = (str(q).strip() for q in raw if str(q).strip())
+    elif file and file.filename:
+        queries = iter_csv_queries(file)
+    else:
+        queries = split_queries(request.form.get("queries", ""))
+
+    if (request.args.get("format") or source.get("format")) == "csv":
+        return Response(
+            stream_with_context(_bulk_csv_stream(queries, history)),
+            mimetype="text/csv",
+            headers={"Content-Disposition": "attachment; filename=bulk_search.csv"},
+        )
+
+    queries = list(itertools.islice(queries, SEARCH_BULK_MAX + 1))
+    if len(queries) > SEARCH_BULK_MAX:
+        message = f"At most {SEARCH_BULK_MAX} identifiers per request; use format=csv for longer lists."
+        if wants_json:
+            return jsonify({"ok": False, "error": message}), 413
+        flash(message, "error")
+        return render_template("bulk_search.html", results=None)
+    conn = db_connect()
+    try:
+        results = []
+        for start in range(0, len(queries), BULK_CHUNK):
+            results += bulk_lookup(conn.cursor(), queries[start:start + BULK_CHUNK], history)
+    finally:
+        conn.close()
+    if wants_json:
+        found = sum(1 for r in results if r["status"] == "found")
+        return jsonify({"ok": True, "count": len(results), "found": found, "results": results})
+    return render_template("bulk_search.html", results=results, history=history)
+
+
 @app.route("/api/validate_device", methods=["POST"])
 def validate_device():
-    payload = request.get_json(silent=True) or {}
+    return api_reply(check_device(request.get_json(silent=True) or {}))
+
+
+def api_reply(result):
+    """Turn an agent API result, ``(body, status[, headers])``, into a Flask response."""
+    return (jsonify(result[0]),) + tuple(result[1:])
+
+
+def check_device(payload):
+    """Check an agent's credentials; ``(body, status)`` for /api/validate_device (WSGI and ASGI)."""
     imei = payload.get("imei")
     phone = payload.get("phone")
     token = payload.get("token")
 
     # Basic validation
     if not token or (not imei and not phone):
-        return jsonify({"ok": False, "error": "missing parameters"}), 400
+        return {"ok": False, "error": "missing parameters"}, 400
 
     conn = db_connect()
     try:
         c = conn.cursor()
 
-        # Select device by IMEI or phone
-        if imei:
-            c.execute("SELECT api_token FROM devices WHERE imei = ?", (imei,))
-        else:
-            c.execute("SELECT api_token FROM devices WHERE phone = ?", (phone,))
-
-        row = c.fetchone()
-        if not row:
-            return jsonify({"ok": False, "error": "device not found"}), 404
-
-        if token != row["api_token"]:
-            return jsonify({"ok": False, "error": "invalid token"}), 401
+        device_id, err = authenticate_device(c, imei, phone, token)
+        if err:
+            return {"ok": False, "error": err[0]}, err[1]
 
-        return jsonify({"ok": True, "valid": True}), 200
+        return {"ok": True, "valid": True}, 200
 
     except Exception as e:
         print("ERROR in /api/validate_device:", e)
-        return jsonify({"ok": False, "error": "internal error"}), 500
+        return {"ok": False, "error": "internal error"}, 500
     finally:
         conn.close()
 
-@app.route("/api/location_update", methods=["POST"], strict_slashes=False)
-def location_update():
-    payload = request.get_json(silent=True) or {}
-    imei = payload.get("imei")
-    phone = payload.get("phone")
-    lat = payload.get("lat")
-    lng = payload.get("lng")
-    token = payload.get("token")
-
-    # Required fields
-    if not token or (not imei and not phone) or lat is None or lng is None:
-        return jsonify({"ok": False, "error": "missing parameters"}), 400
 
-    conn = db_connect()
+def parse_coords(lat, lng):
+    """Return (lat, lng) as floats if both are valid WGS84 coordinates, else None."""
+    if isinstance(lat, bool) or isinstance(lng, bool):
+        return None
     try:
-        c = conn.cursor()
+        lat = float(lat)
+        lng = float(lng)
+    except (TypeError, ValueError):
+        return None
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
+        return None
+    return lat, lng
 
-        # Fetch device
-        if imei:
-            c.execute("SELECT id, api_token FROM devices WHERE imei = ?", (imei,))
-        else:
-            c.execute("SELECT id, api_token FROM devices WHERE phone = ?", (phone,))
 
-        device = c.fetchone()
-        if not device:
-            return jsonify({"ok": False, "error": "device not found"}), 404
+# What store_fixes wrote: ``latest`` for fixes_committed(), the rows actually stored and how many
+# rows the movement filter dropped; the rest were already stored for their (device_id, ts)
+IngestResult = namedtuple("IngestResult", ["latest", "stored", "filtered"])
 
-        if token != device["api_token"]:
-            return jsonify({"ok": False, "error": "invalid token"}), 401
 
-        device_id = device["id"]
+def store_fixes(c, rows):
+    """Write ``(device_id, lat, lng, ts_ms)`` rows and advance each device's last_* columns.
 
-        # Insert history entry
-        c.execute("""
-            INSERT INTO locations (device_id, lat, lng, ts)
-            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-        """, (device_id, lat, lng))
+    Fixes the movement filter drops only refresh ``last_update``. The caller
+    owns the transaction and passes the result's ``latest`` to
+    ``fixes_committed()``. With shards the fixes are committed to their shards
+    first, before ``c`` takes the main write lock; see ``insert_locations``.
+    """
+    dropped = ()
+    if movement_filter is not None:
+        rows, dropped = movement_filter.apply(rows)
+    rows = insert_locations(c, rows)
+    if dropped:
+        touch_devices(c, dropped)
+    latest = {}
+    for device_id, lat, lng, ts in rows:
+        prev = latest.get(device_id)
+        if prev is None or ts >= prev[2]:
+            latest[device_id] = (lat, lng, ts)
+    # Only move last_* forward; a flushed backlog may be older than what is stored
+    c.executemany(
+        """
+        UPDATE devices
+        SET last_lat = ?, last_lng = ?, last_update = ?
+        WHERE id = ? AND (last_update IS NULL OR last_update <= ?)
+        """,
+        [
+            (lat, lng, ms_to_ts_text(ts), device_id, ms_to_ts_text(ts))
+            for device_id, (lat, lng, ts) in latest.items()
+        ],
+    )
+    # Mirror whatever last_* ended up as into the spatial index
+    c.executemany(
+        """
+        INSERT OR REPLACE INTO device_positions (id, min_lat, max_lat, min_lng, max_lng)
+        SELECT id, last_lat, last_lat, last_lng, last_lng FROM devices
+        WHERE id = ? AND last_lat IS NOT NULL AND last_lng IS NOT NULL
+        """,
+        [(device_id,) for device_id in latest],
+    )
+    evaluate_geofences(c, list(latest))
+    count_fixes_hourly(c, rows)
+    METRICS.inc("ingest_fixes_total", (), len(rows))
+    return IngestResult(latest, rows, len(dropped))
 
-        # Update last known location
-        c.execute("""
-            UPDATE devices
-            SET last_lat = ?, last_lng = ?, last_update = CURRENT_TIMESTAMP
-            WHERE id = ?
-        """, (lat, lng, device_id))
 
-        conn.commit()
+LOCATION_INSERT = "INSERT OR IGNORE INTO locations (device_id, lat, lng, ts) VALUES (?, ?, ?, ?)"
 
-        return jsonify({"ok": True, "updated": True})
 
-    except Exception as e:
-        print("ERROR in /api/location_update:", e)
-        return jsonify({"ok": False, "error": "internal error"}), 500
-    finally:
-        conn.close()
+def insert_locations(c, rows):
+    """Insert ``(device_id, lat, lng, ts_ms)`` rows into the caller's transaction, or into their shards.
 
-@app.route("/device/token", methods=["GET", "POST"])
-def device_token():
-    gate = require_role("admin")
-    if gate:
-        return gate
-    context = {"device": None}
-    if request.method == "POST":
-        query = request.form.get("query", "").strip()
-        conn = db_connect()
-        try:
-            c = conn.cursor()
-            device_row = None
-            if is_imei(query):
-                c.execute("SELECT * FROM devices WHERE imei = ?", (query,))
-                device_row = c.fetchone()
-            else:
-                normalized = normalize_phone(query)
-                if normalized:
-                    c.execute("SELECT * FROM devices WHERE phone = ?", (normalized,))
-                    device_row = c.fetchone()
-            if not device_row:
-                flash("Device not found.", "error")
-            else:
-                if request.form.get("regen") == "1":
-                    new_token = secrets.token_urlsafe(24)
-                    c.execute("UPDATE devices SET api_token = ? WHERE id = ?", (new_token, device_row["id"]))
-                    conn.commit()
-                    device_row = dict(device_row)
-                    device_row["api_token"] = new_token
-                    flash("Token regenerated.", "success")
-                context["device"] = dict(device_row)
-        finally:
-            conn.close()
-    return render_template("device_token.html", **context)
+    Returns the rows that were stored; a row whose ``(device_id, ts)`` is
+    already taken is skipped. Shard writes are committed right away (together
+    with any idempotency key claimed in the same shard), so each shard's write
+    lock is held only for its own rows and workers writing different shards
+    proceed in parallel. If the caller's transaction then fails, the fixes stay
+    stored while ``last_*`` lags until the next fix; inserts are idempotent, so
+    a retry is harmless.
+    """
+    if not _location_shards:
+        return insert_new_rows(c.connection, rows)
+    stored = []
+    for index, shard_rows in group_by_shard(rows).items():
+        stored += insert_new_rows(shard_connect(index), shard_rows)
+    commit_shards()
+    return stored
 
 
-@app.route("/login", methods=["GET", "POST"])
-def login():
-    if request.method == "POST":
-        username = request.form.get("username", "").strip()
-        password = request.form.get("password", "")
-        user = get_user_by_username_db(username)
-        if not user or not check_password_hash(user.get("password_hash", ""), password):
-            flash("Invalid credentials.", "error")
-            return render_template("login.html")
-        # If user has phone configured, require 2FA
-        user_phone = user.get("phone")
-        if user_phone:
-            code = f"{secrets.randbelow(1000000):06d}"
-            try:
-                normalized = normalize_phone(user_phone)
-                if not normalized:
-                    raise RuntimeError("User phone invalid for 2FA")
-                send_2fa_code(normalized, code)
-            except Exception as e:
-                flash(f"2FA SMS failed: {e}", "error")
-                return render_template("login.html")
-            # Store pending user and code in session
-            session["pending_user"] = {"username": user["username"], "role": user.get("role", "viewer")}
-            session["twofa_code"] = code
-            session["twofa_expires"] = (datetime.utcnow().timestamp() + 300)  # 5 minutes
-            return redirect(url_for("login_verify"))
-        # No phone: allow login (viewer) or warn for admin
-        if user.get("role") == "admin":
-            flash("Admin login without 2FA phone configured. Please set your phone.", "warning")
-        session["user"] = {"username": user["username"], "role": user.get("role", "viewer")}
-        flash("Logged in.", "success")
-        next_url = request.args.get("next")
-        return redirect(next_url or url_for("index"))
-    return render_template("login.html")
+def insert_new_rows(conn, rows):
+    """Insert rows one at a time and return those that were new (timed as one statement)."""
+    started = time.perf_counter()
+    cur = conn.cursor(sqlite3.Cursor)
+    stored = [row for row in rows if cur.execute(LOCATION_INSERT, row).rowcount]
+    _observe_sql(LOCATION_INSERT, time.perf_counter() - started)
+    return stored
 
 
-@app.route("/login/verify", methods=["GET", "POST"])
-def login_verify():
-    if request.method == "POST":
-        code = request.form.get("code", "").strip()
-        expected = session.get("twofa_code")
-        expires = session.get("twofa_expires", 0)
-        if not expected or datetime.utcnow().timestamp() > float(expires):
-            flash("Verification code expired. Please log in again.", "error")
-            return redirect(url_for("login"))
-        if code != expected:
-            flash("Invalid verification code.", "error")
-            return render_template("twofa.html")
-        user = session.get("pending_user")
-        if not user:
-            flash("No pending login session.", "error")
-            return redirect(url_for("login"))
-        # finalize login
-        session.pop("pending_user", None)
-        session.pop("twofa_code", None)
-        session.pop("twofa_expires", None)
-        session["user"] = user
+def count_fixes_hourly(c, rows):
+    """Add ``(device_id, lat, lng, ts_ms)`` rows to the per-hour fix counters of the fleet summary."""
+    hours = {}
+    for row in rows:
+        hour = row[3] // 3600000
+        hours[hour] = hours.get(hour, 0) + 1
+    c.executemany(
+        "INSERT INTO fleet_updates_hourly (hour, fixes) VALUES (?, ?) "
+        "ON CONFLICT (hour) DO UPDATE SET fixes = fixes + excluded.fixes",
+        hours.items(),
+    )
+
+
+def fixes_committed(latest):
+    """Post-commit hook for ingest paths; ``latest`` maps device_id -> (lat, lng, ts_ms)."""
+    if movement_filter is not None:
+        movement_filter.commit(latest)
+    response_cache.invalidate(latest)
+    live_broker.publish(latest)
+
+
+class MovementFilter:
+    """Drops fixes that add nothing to a device's track.
+
+    A fix is dropped when it lies within ``meters`` of the device's last
+    accepted point and less than ``seconds`` after it, so a stationary device
+    still stores one point per window. The last accepted point per device is
+    kept in memory (per worker), so the check costs no query. Fixes older than
+    the last accepted one are backfill and always kept.
+    """
+
+    def __init__(self, meters, seconds, maxsize):
+        self.meters = meters
+        self.window_ms = seconds * 1000.0
+        self._last = TTLCache(maxsize, seconds)
+        self.dropped = 0
+
+    def apply(self, rows):
+        """Split ``(device_id, lat, lng, ts_ms)`` rows into ``(kept, dropped)``.
+
+        Later fixes in the same batch are compared with the earlier kept ones;
+        the remembered points only move once ``commit()`` is called after the
+        transaction succeeded.
+        """
+        kept = []
+        dropped = []
+        pending = {}
+        for row in sorted(rows, key=lambda r: (r[0], r[3])):
+            device_id, lat, lng, ts = row
+            last = pending.get(device_id) or self._last.get(device_id)
+            if last is not None and 0 <= ts - last[2] < self.window_ms \
+                    and haversine_m(last[0], last[1], lat, lng) < self.meters:
+                dropped.append(row)
+                continue
+            kept.append(row)
+            if last is None or ts >= last[2]:
+                pending[device_id] = (lat, lng, ts)
+        if dropped:
+            self.dropped += len(dropped)
+            METRICS.inc("ingest_fixes_filtered_total", (), len(dropped))
+        return kept, dropped
+
+    def commit(self, latest):
+        """Remember ``{device_id: (lat, lng, ts_ms)}`` as the last stored points (never moving backwards)."""
+        for device_id, point in latest.items():
+            last = self._last.get(device_id)
+            if last is None or point[2] >= last[2]:
+                self._last.set(device_id, point)
+
+    def forget(self, device_id):
+        self._last.pop(device_id)
+
+
+movement_filter = MovementFilter(INGEST_DEDUP_METERS, INGEST_DEDUP_SECONDS, DEVICE_CACHE_SIZE) \
+    if INGEST_DEDUP_METERS > 0 else None
+
+
+def touch_devices(c, dropped):
+    """Advance last_update for devices whose fixes were all filtered, so they do not look stale.
+
+    Position columns are left alone; the last stored point is still within the filter radius.
+    """
+    latest = {}
+    for device_id, _, _, ts in dropped:
+        latest[device_id] = max(ts, latest.get(device_id, 0))
+    c.executemany(
+        "UPDATE devices SET last_update = ? WHERE id = ? AND last_update < ?",
+        [(ms_to_ts_text(ts), device_id, ms_to_ts_text(ts - INGEST_TOUCH_SECONDS * 1000)) for device_id, ts in latest.items()],
+    )
+
+
+def claim_idempotency_key(c, device_id, key):
+    """Record ``key`` for the device; False means a post with this key was already stored.
+
+    Runs in the caller's transaction, or with shards in the device's shard
+    transaction, which ``store_fixes``/``db_commit`` commit. Either way the key
+    and the fix commit together.
+    """
+    if _location_shards:
+        c = location_db(device_id).cursor()
+    now = now_ms()
+    c.execute("INSERT OR IGNORE INTO ingest_keys (device_id, key, ts) VALUES (?, ?, ?)", (device_id, key, now))
+    if c.rowcount == 0:
+        METRICS.inc("ingest_duplicates_total")
+        return False
+    # Expire old keys now and then; about one claim in a thousand pays for it
+    if secrets.randbelow(1000) == 0:
+        c.execute("DELETE FROM ingest_keys WHERE ts < ?", (now - int(INGEST_KEY_TTL * 1000),))
+    return True
+
+
+def idempotency_key_used(c, device_id, key):
+    """True if ``key`` was already recorded for the device (a read-only ``claim_idempotency_key``)."""
+    if _location_shards:
+        c = location_db(device_id).cursor()
+    row = c.execute("SELECT 1 FROM ingest_keys WHERE device_id = ? AND key = ?", (device_id, key)).fetchone()
+    if row is not None:
+        METRICS.inc("ingest_duplicates_total")
+    return row is not None
+
+
+def idempotency_key(header, payload):
+    """The client's idempotency key from the header or JSON body; '' if absent, None if invalid."""
+    key = header or (payload.get("idempotency_key") if payload else None) or ""
+    if not isinstance(key, str) or len(key) > 128:
+        return None
+    return key.strip()
+
+
+FIXES_MIMETYPE = "application/vnd.tracker.fixes"
+FRAME_MAGIC = b"TF\x01"
+FIX_SCALE = 10 ** 7
+SESSION_MAC_BYTES = 10
+
+
+def request_body():
+    """Raw request body with a gzip/deflate ``Content-Encoding`` undone.
+
+    Returns ``(bytes, None)`` or ``(None, (error, status))``. A declared or sent
+    body over ``INGEST_MAX_BODY`` bytes is refused before it is buffered, and
+    decompression stops at the same size, so a small compressed body cannot
+    balloon either.
+    """
+    if request.content_length is not None and request.content_length > INGEST_MAX_BODY:
+        return None, ("body too large", 413)
+    # Chunked uploads declare no length; stop reading once past the limit
+    chunks = []
+    size = 0
+    while size <= INGEST_MAX_BODY:
+        chunk = request.stream.read(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+    if size > INGEST_MAX_BODY:
+        return None, ("body too large", 413)
+    return decode_body(b"".join(chunks), request.headers.get("Content-Encoding"))
+
+
+def decode_body(data, encoding):
+    """``request_body()`` for a body already read, e.g. by the ASGI front end."""
+    encoding = (encoding or "identity").strip().lower()
+    if encoding == "identity":
+        if len(data) > INGEST_MAX_BODY:
+            return None, ("body too large", 413)
+        return data, None
+    if encoding not in ("gzip", "x-gzip", "deflate"):
+        return None, (f"unsupported content encoding {encoding!r}", 415)
+    # wbits=47 accepts gzip and zlib framing; some clients send raw deflate for "deflate"
+    for wbits in (47, -15):
+        d = zlib.decompressobj(wbits)
+        try:
+            body = d.decompress(data, INGEST_MAX_BODY + 1)
+        except zlib.error:
+            continue
+        if len(body) > INGEST_MAX_BODY:
+            return None, ("body too large", 413)
+        if d.eof:
+            return body, None
+    return None, ("invalid compressed body", 400)
+
+
+def json_payload():
+    """The request's JSON (None if absent or malformed) and an error tuple for undecodable bodies."""
+    if not request.is_json:
+        return None, None
+    body, err = request_body()
+    if err:
+        return None, err
+    try:
+        return json.loads(body), None
+    except ValueError:
+        return None, None
+
+
+def encode_uvarint(value):
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def read_uvarint(buf, pos):
+    """Decode an LEB128 varint at ``buf[pos]``; returns ``(value, next_pos)``."""
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise ValueError("truncated varint")
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError("varint too long")
+
+
+def encode_fix_frame(session, fixes):
+    """Encode ``[(lat, lng, ts_ms), ...]`` for ``session`` (bytes); the reference encoder for agents."""
+    out = bytearray(FRAME_MAGIC)
+    out += encode_uvarint(len(session)) + session + encode_uvarint(len(fixes))
+    prev = (0, 0, 0)
+    for lat, lng, ts in fixes:
+        cur = (round(lat * FIX_SCALE), round(lng * FIX_SCALE), int(ts))
+        for a, b in zip(cur, prev):
+            d = a - b
+            out += encode_uvarint((d << 1) ^ (d >> 63))
+        prev = cur
+    return bytes(out)
+
+
+def decode_frame_header(buf):
+    """Split off a fix frame's header; returns ``(session, count, pos)`` or raises ValueError."""
+    if buf[:len(FRAME_MAGIC)] != FRAME_MAGIC:
+        raise ValueError("bad magic or version")
+    size, pos = read_uvarint(buf, len(FRAME_MAGIC))
+    session = bytes(buf[pos:pos + size])
+    if len(session) != size:
+        raise ValueError("truncated session")
+    count, pos = read_uvarint(buf, pos + size)
+    return session, count, pos
+
+
+def decode_frame_fixes(buf, pos, count, device_id):
+    """Decode a frame's fixes straight into ``(device_id, lat, lng, ts_ms)`` rows.
+
+    Returns ``(rows, rejected)`` where ``rejected`` holds the indices of fixes with
+    coordinates or timestamps out of range (see ``fix_ts_valid``). Truncated or
+    trailing bytes raise ValueError.
+    """
+    rows = []
+    rejected = []
+    now = now_ms()
+    lat_max = 90 * FIX_SCALE
+    lng_max = 180 * FIX_SCALE
+    lat = lng = ts = 0
+    for i in range(count):
+        v, pos = read_uvarint(buf, pos)
+        lat += (v >> 1) ^ -(v & 1)
+        v, pos = read_uvarint(buf, pos)
+        lng += (v >> 1) ^ -(v & 1)
+        v, pos = read_uvarint(buf, pos)
+        ts += (v >> 1) ^ -(v & 1)
+        if -lat_max <= lat <= lat_max and -lng_max <= lng <= lng_max and fix_ts_valid(ts, now):
+            rows.append((device_id, lat / FIX_SCALE, lng / FIX_SCALE, ts))
+        else:
+            rejected.append(i)
+    if pos != len(buf):
+        raise ValueError("trailing bytes")
+    return rows, rejected
+
+
+def _session_mac(body, api_token):
+    return hmac.new(app.secret_key.encode(), body + api_token.encode(), hashlib.sha256).digest()[:SESSION_MAC_BYTES]
+
+
+def issue_session(device_id, api_token, now=None):
+    """A short credential for ``device_id``: varint id, varint expiry and a MAC keyed with its token."""
+    expires = int(time.time() if now is None else now) + AGENT_SESSION_TTL
+    body = encode_uvarint(device_id) + encode_uvarint(expires)
+    return body + _session_mac(body, api_token), expires
+
+
+def authenticate_session(c, session):
+    """Resolve a session credential to a device id, like ``authenticate_device``.
+
+    Regenerating the device token changes the MAC key, which ends its sessions.
+    """
+    try:
+        device_id, pos = read_uvarint(session, 0)
+        expires, pos = read_uvarint(session, pos)
+    except ValueError:
+        return None, ("invalid session", 401)
+    mac = session[pos:]
+    if len(mac) != SESSION_MAC_BYTES:
+        return None, ("invalid session", 401)
+    if expires < time.time():
+        return None, ("session expired", 401)
+    key = ("id", device_id)
+    cached = _device_auth_cache.get(key)
+    if cached is not None and hmac.compare_digest(mac, _session_mac(session[:pos], cached[1])):
+        return device_id, None
+    c.execute("SELECT api_token FROM devices WHERE id = ?", (device_id,))
+    row = c.fetchone()
+    if not row:
+        return None, ("device not found", 404)
+    _device_auth_cache.set(key, (device_id, row["api_token"]))
+    if not hmac.compare_digest(mac, _session_mac(session[:pos], row["api_token"])):
+        return None, ("invalid session", 401)
+    return device_id, None
+
+
+def transient_db_error(e):
+    """True for SQLite errors worth retrying as is: another connection holds the lock."""
+    if not isinstance(e, sqlite3.OperationalError):
+        return False
+    code = getattr(e, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    message = str(e)
+    return "locked" in message or "busy" in message
+
+
+class IngestQueue:
+    """Write-behind buffer for /api/location_update with group commit.
+
+    Requests enqueue validated fixes and return immediately; one writer thread
+    per process commits them every ``flush_ms`` or ``flush_rows``, whichever
+    comes first. Queued fixes were already acknowledged, so a batch that fails
+    to commit because the database is busy or locked is retried with backoff
+    rather than dropped, and ``submit`` refuses new fixes until a commit
+    succeeds again. Any other error is retried one fix at a time, and a fix
+    that still fails is logged and dropped so it cannot stall ingest. A fix's
+    idempotency key travels with it and is claimed in the flush transaction,
+    so the key is recorded only once the fix is.
+    """
+
+    RETRY_MIN = 0.05
+    RETRY_MAX = 5.0
+
+    def __init__(self, maxsize, flush_ms, flush_rows):
+        self.flush_interval = flush_ms / 1000.0
+        self.flush_rows = flush_rows
+        self._queue = queue.Queue(maxsize)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.flushes = 0
+        self.rows_written = 0
+        self.rejected = 0
+        self.rejected_unhealthy = 0
+        self.errors = 0
+        self.dropped = 0
+        self.healthy = True
+        self.last_flush_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    def start(self):
+        with self._lock:
+            # Threads do not survive fork; each gunicorn worker starts its own writer
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            if self._pid is None:
+                atexit.register(self.stop)
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="ingest-writer", daemon=True)
+            self._thread.start()
+
+    def submit(self, row, key=""):
+        """Queue one ``(device_id, lat, lng, ts_ms)`` row; False means the queue is full or the writer is failing."""
+        self.start()
+        if not self.healthy:
+            self.rejected_unhealthy += 1
+            return False
+        try:
+            self._queue.put_nowait((row, key))
+            return True
+        except queue.Full:
+            self.rejected += 1
+            return False
+
+    def stop(self, timeout=10.0):
+        """Signal the writer and wait for it to drain what is already queued."""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive() and self._pid == os.getpid():
+            thread.join(timeout)
+            if thread.is_alive():
+                print(f"WARNING: ingest writer stopped with about {self._queue.qsize()} queued fixes unwritten")
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return
+                continue
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.flush_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        """Commit ``batch``, waiting out busy/locked errors; isolate fixes that fail for other reasons."""
+        delay = self.RETRY_MIN
+        while True:
+            try:
+                self._flush(batch)
+            except Exception as e:
+                self.errors += 1
+                if transient_db_error(e):
+                    print("ERROR in ingest writer (will retry):", e)
+                    self.healthy = False
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.RETRY_MAX)
+                    continue
+                if len(batch) > 1:
+                    # Something in the batch cannot be stored; find it without holding back the rest
+                    for item in batch:
+                        self._write([item])
+                    return
+                (device_id, lat, lng, ts), _ = batch[0]
+                self.dropped += 1
+                METRICS.inc("ingest_dropped_total")
+                print(f"ERROR in ingest writer, dropping fix ({device_id}, {lat}, {lng}, {ts}):", e)
+            self.healthy = True
+            return
+
+    def _flush(self, batch):
+        """Commit one batch in one transaction; on error roll back and re-raise (inserts are idempotent)."""
+        started = time.perf_counter()
+        conn = db_connect()
+        try:
+            c = conn.cursor()
+            # A key claimed by an earlier queued post means this one is a retry of it
+            rows = [row for row, key in batch if not key or claim_idempotency_key(c, row[0], key)]
+            result = store_fixes(c, rows)
+            db_commit(conn)
+            self.rows_written += len(result.stored)
+            fixes_committed(result.latest)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        elapsed = (time.perf_counter() - started) * 1000.0
+        self.flushes += 1
+        self.last_flush_size = len(batch)
+        self.last_flush_ms = elapsed
+        self.max_flush_ms = max(self.max_flush_ms, elapsed)
+
+    def stats(self):
+        return {
+            "enabled": True,
+            "healthy": self.healthy,
+            "depth": self._queue.qsize(),
+            "capacity": self._queue.maxsize,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "rejected_full": self.rejected,
+            "rejected_unhealthy": self.rejected_unhealthy,
+            "errors": self.errors,
+            "dropped": self.dropped,
+            "last_flush_size": self.last_flush_size,
+            "avg_flush_size": (self.rows_written / self.flushes) if self.flushes else 0,
+            "last_flush_ms": round(self.last_flush_ms, 3),
+            "max_flush_ms": round(self.max_flush_ms, 3),
+        }
+
+
+ingest_queue = IngestQueue(INGEST_QUEUE_SIZE, INGEST_FLUSH_MS, INGEST_FLUSH_ROWS) if INGEST_MODE == "queue" else None
+
+
+@app.route("/api/session", methods=["POST"])
+def agent_session():
+    """Trade ``{"imei"|"phone", "token"}`` for a short session credential used by binary fix frames."""
+    payload, err = json_payload()
+    if err:
+        return jsonify({"ok": False, "error": err[0]}), err[1]
+    payload = payload or {}
+    imei = payload.get("imei")
+    phone = payload.get("phone")
+    token = payload.get("token")
+    if not token or (not imei and not phone):
+        return jsonify({"ok": False, "error": "missing parameters"}), 400
+    conn = db_connect()
+    try:
+        c = conn.cursor()
+        device_id, err = authenticate_device(c, imei, phone, token)
+        if err:
+            return jsonify({"ok": False, "error": err[0]}), err[1]
+        session, expires = issue_session(device_id, token)
+    finally:
+        conn.close()
+    return jsonify({
+        "ok": True,
+        "session": base64.urlsafe_b64encode(session).rstrip(b"=").decode(),
+        "expires_at": expires,
+    })
+
+
+def ingest_fix_frame():
+    """Store a binary fix frame (``Content-Type: application/vnd.tracker.fixes``).
+
+    Layout, with LEB128 varints and zigzag-encoded signed values::
+
+        b"TF\\x01" | uvarint len | session | uvarint count | count x (dlat, dlng, dts)
+
+    Coordinates are degrees x 1e7 and ``ts`` epoch milliseconds, each a delta
+    from the previous fix (the first from zero). The body may be gzip/deflate
+    compressed and the ``Idempotency-Key`` header applies as for JSON posts.
+    """
+    body, err = request_body()
+    if err:
+        return jsonify({"ok": False, "error": err[0]}), err[1]
+    return api_reply(store_fix_frame(body, request.headers.get("Idempotency-Key")))
+
+
+def store_fix_frame(body, key_header):
+    """Authenticate and store a decoded fix frame body; ``(body, status)`` (see ``ingest_fix_frame``)."""
+    try:
+        session, count, pos = decode_frame_header(body)
+    except ValueError as e:
+        return {"ok": False, "error": f"invalid frame: {e}"}, 400
+    if count > LOCATION_BATCH_MAX:
+        return {"ok": False, "error": f"batch too large (max {LOCATION_BATCH_MAX} fixes)"}, 413
+    key = idempotency_key(key_header, None)
+    if key is None:
+        return {"ok": False, "error": "invalid idempotency key"}, 400
+
+    conn = db_connect()
+    try:
+        c = conn.cursor()
+        device_id, err = authenticate_session(c, session)
+        if err:
+            return {"ok": False, "error": err[0]}, err[1]
+        try:
+            rows, rejected = decode_frame_fixes(body, pos, count, device_id)
+        except ValueError as e:
+            return {"ok": False, "error": f"invalid frame: {e}"}, 400
+        if key and not claim_idempotency_key(c, device_id, key):
+            return {"ok": True, "duplicate": True}, 200
+        result = IngestResult({}, [], 0)
+        if rows:
+            result = store_fixes(c, rows)
+            conn.commit()
+            fixes_committed(result.latest)
+        # Nothing stored: leave the key unclaimed (close() rolls it back) so a corrected retry is not a "duplicate"
+        return {
+            "ok": True,
+            "accepted": len(result.stored),
+            "filtered": result.filtered,
+            "duplicates": len(rows) - len(result.stored) - result.filtered,
+            "rejected": rejected,
+        }, 200
+    except Exception as e:
+        conn.rollback()
+        print("ERROR in fix frame ingest:", e)
+        return {"ok": False, "error": "internal error"}, 500
+    finally:
+        conn.close()
+
+
+@app.route("/api/location_update", methods=["POST"], strict_slashes=False)
+def location_update():
+    if request.mimetype == FIXES_MIMETYPE:
+        return ingest_fix_frame()
+    payload, err = json_payload()
+    if err:
+        return jsonify({"ok": False, "error": err[0]}), err[1]
+    return api_reply(store_location_update(payload or {}, request.headers.get("Idempotency-Key")))
+
+
+def store_location_update(payload, key_header):
+    """Validate and store one JSON fix; ``(body, status[, headers])`` for /api/location_update."""
+    imei = payload.get("imei")
+    phone = payload.get("phone")
+    lat = payload.get("lat")
+    lng = payload.get("lng")
+    token = payload.get("token")
+
+    # Required fields
+    if not token or (not imei and not phone) or lat is None or lng is None:
+        return {"ok": False, "error": "missing parameters"}, 400
+    coords = parse_coords(lat, lng)
+    if coords is None:
+        return {"ok": False, "error": "invalid coordinates"}, 400
+    key = idempotency_key(key_header, payload)
+    if key is None:
+        return {"ok": False, "error": "invalid idempotency key"}, 400
+
+    conn = db_connect()
+    try:
+        c = conn.cursor()
+
+        device_id, err = authenticate_device(c, imei, phone, token)
+        if err:
+            return {"ok": False, "error": err[0]}, err[1]
+
+        row = (device_id, coords[0], coords[1], now_ms())
+        if ingest_queue is not None:
+            # The writer claims the key when it commits the fix; here only look for a stored one
+            if key and idempotency_key_used(c, device_id, key):
+                return {"ok": True, "duplicate": True}, 200
+            if not ingest_queue.submit(row, key):
+                if not ingest_queue.healthy:
+                    return {"ok": False, "error": "ingest writer unavailable"}, 503, {"Retry-After": "5"}
+                return {"ok": False, "error": "ingest queue full"}, 429, {"Retry-After": "1"}
+            return {"ok": True, "queued": True}, 202
+
+        # A retried post with a known key was already stored; acknowledge it again
+        if key and not claim_idempotency_key(c, device_id, key):
+            return {"ok": True, "duplicate": True}, 200
+
+        # Insert history entry and update last known location
+        result = store_fixes(c, [row])
+        conn.commit()
+        fixes_committed(result.latest)
+
+        return {"ok": True, "updated": bool(result.stored)}, 200
+
+    except Exception as e:
+        print("ERROR in /api/location_update:", e)
+        return {"ok": False, "error": "internal error"}, 500
+    finally:
+        conn.close()
+
+
+class LiveSubscriber:
+    def __init__(self, device_ids):
+        self.device_ids = device_ids
+        self.queue = queue.Queue(LIVE_CLIENT_BUFFER)
+        self.dropped = False
+
+
+class LiveBroker:
+    """Fans committed fixes out to Server-Sent Events subscribers.
+
+    Fixes committed by this process are published immediately. A poller thread,
+    running only while someone is subscribed, picks up positions written by other
+    workers from ``devices.last_update``. Each subscriber has a bounded buffer;
+    one that falls behind is dropped rather than slowing ingest down.
+
+    Every open stream holds a server thread, so ``max_subscribers`` is lowered
+    to fit the worker model at startup (see gunicorn.conf.py and ``AsgiApp``);
+    0 turns the stream off.
+    """
+
+    def __init__(self, max_subscribers):
+        self.max_subscribers = max_subscribers
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._last_sent = {}
+        self._poller = None
+        self._pid = None
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, device_ids=None):
+        sub = LiveSubscriber(frozenset(device_ids) if device_ids else None)
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            self._subscribers.add(sub)
+            if self._poller is None or not self._poller.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._poller = threading.Thread(target=self._poll, name="live-poller", daemon=True)
+                self._poller.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def publish(self, latest):
+        """Deliver ``{device_id: (lat, lng, ts_ms)}`` to interested subscribers."""
+        if not self._subscribers:
+            return
+        with self._lock:
+            subscribers = list(self._subscribers)
+            for device_id, (lat, lng, ts) in latest.items():
+                self._last_sent[device_id] = max(ts, self._last_sent.get(device_id, 0))
+        for device_id, (lat, lng, ts) in latest.items():
+            event = {"device_id": device_id, "lat": lat, "lng": lng, "ts": ts}
+            for sub in subscribers:
+                if sub.dropped or (sub.device_ids is not None and device_id not in sub.device_ids):
+                    continue
+                try:
+                    sub.queue.put_nowait(event)
+                    self.published += 1
+                except queue.Full:
+                    sub.dropped = True
+                    self.dropped += 1
+                    self.unsubscribe(sub)
+
+    def _keep_polling(self):
+        """False once nobody is subscribed; decided under the lock so ``subscribe`` starts a new poller."""
+        with self._lock:
+            if self._subscribers:
+                return True
+            self._poller = None
+            self._last_sent.clear()
+            return False
+
+    def _poll(self):
+        conn = db_connect()
+        try:
+            c = conn.cursor()
+            c.execute("SELECT MAX(last_update) FROM devices")
+            since = c.fetchone()[0] or ms_to_ts_text(now_ms())
+            while self._keep_polling():
+                time.sleep(LIVE_POLL_INTERVAL)
+                # last_update has one-second resolution, so re-read the boundary second
+                c.execute(
+                    "SELECT id, last_lat, last_lng, last_update FROM devices WHERE last_update >= ? ORDER BY last_update",
+                    (since,),
+                )
+                rows = c.fetchall()
+                found = {}
+                for row in rows:
+                    since = max(since, row["last_update"])
+                    ts = ts_to_ms(row["last_update"])
+                    # Skip anything this process already published for that second or later
+                    if ts is None or self._last_sent.get(row["id"], 0) // 1000 >= ts // 1000:
+                        continue
+                    found[row["id"]] = (row["last_lat"], row["last_lng"], ts)
+                if found:
+                    self.publish(found)
+                # Entries before the boundary second can no longer suppress anything
+                horizon = (ts_to_ms(since) or 0) // 1000
+                with self._lock:
+                    for device_id in [d for d, ts in self._last_sent.items() if ts // 1000 < horizon]:
+                        del self._last_sent[device_id]
+        except Exception as e:
+            print("ERROR in live poller:", e)
+        finally:
+            conn.close()
+            with self._lock:
+                # A poller started after this one gave up must keep running
+                if self._poller is threading.current_thread():
+                    self._poller = None
+
+
+live_broker = LiveBroker(LIVE_MAX_SUBSCRIBERS)
+
+
+@app.route("/api/live")
+def live_updates():
+    """Server-Sent Events stream of new fixes; repeat ``device_id`` to filter.
+
+    Each open stream holds a worker thread; gunicorn.conf.py runs gthread
+    workers and lets streams take at most half of their threads. Under sync
+    workers the stream is off and this answers 503.
+    """
+    gate = require_login()
+    if gate:
+        return gate
+    try:
+        device_ids = [int(v) for v in request.args.getlist("device_id")]
+    except ValueError:
+        return jsonify({"ok": False, "error": "device_id must be an integer"}), 400
+    if live_broker.max_subscribers <= 0:
+        return jsonify({"ok": False, "error": "live updates need threaded workers"}), 503
+    sub = live_broker.subscribe(device_ids)
+    if sub is None:
+        return jsonify({"ok": False, "error": "too many live subscribers"}), 503
+
+    def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event = sub.queue.get(timeout=LIVE_KEEPALIVE)
+                except queue.Empty:
+                    if sub.dropped:
+                        yield "event: dropped\ndata: {}\n\n"
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: fix\ndata: {json.dumps(event)}\n\n"
+        finally:
+            live_broker.unsubscribe(sub)
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/ingest/stats")
+def ingest_stats():
+    gate = require_login()
+    if gate:
+        return gate
+    if ingest_queue is None:
+        return jsonify({"enabled": False})
+    return jsonify(ingest_queue.stats())
+
+
+@app.route("/api/location_batch", methods=["POST"], strict_slashes=False)
+def location_batch():
+    """Accept many timestamped fixes for one or more devices in a single transaction.
+
+    Body is either a single device ``{"imei"|"phone", "token", "fixes": [...]}`` or
+    ``{"devices": [<device>, ...]}``. Each fix is ``{"lat", "lng", "ts"?}``.
+    Binary fix frames are accepted too, see ``ingest_fix_frame``.
+    """
+    if request.mimetype == FIXES_MIMETYPE:
+        return ingest_fix_frame()
+    payload, err = json_payload()
+    if err:
+        return jsonify({"ok": False, "error": err[0]}), err[1]
+    if not isinstance(payload, dict):
+        return jsonify({"ok": False, "error": "invalid payload"}), 400
+    groups = payload.get("devices")
+    if groups is None:
+        groups = [payload]
+    if not isinstance(groups, list) or not groups:
+        return jsonify({"ok": False, "error": "missing parameters"}), 400
+
+    total = sum(len(g.get("fixes") or []) for g in groups if isinstance(g, dict) and isinstance(g.get("fixes"), list))
+    if total > LOCATION_BATCH_MAX:
+        return jsonify({"ok": False, "error": f"batch too large (max {LOCATION_BATCH_MAX} fixes)"}), 413
+    key = idempotency_key(request.headers.get("Idempotency-Key"), payload)
+    if key is None:
+        return jsonify({"ok": False, "error": "invalid idempotency key"}), 400
+
+    conn = db_connect()
+    try:
+        c = conn.cursor()
+        rows = []
+        results = []
+        rejected = 0
+        seen = set()
+
+        for gi, group in enumerate(groups):
+            result = {"device": gi, "accepted": 0, "rejected": []}
+            results.append(result)
+            if not isinstance(group, dict):
+                result["error"] = "invalid entry"
+                continue
+            imei = group.get("imei")
+            phone = group.get("phone")
+            token = group.get("token")
+            fixes = group.get("fixes")
+            if not token or (not imei and not phone) or not isinstance(fixes, list):
+                result["error"] = "missing parameters"
+                rejected += len(fixes) if isinstance(fixes, list) else 0
+                continue
+
+            # One token check per group, not per fix
+            device_id, err = authenticate_device(c, imei, phone, token)
+            if err:
+                result["error"] = err[0]
+                rejected += len(fixes)
+                continue
+            # The key covers the whole batch and is recorded per device it names
+            if key and not claim_idempotency_key(c, device_id, key):
+                result["duplicate"] = True
+                continue
+            result["device_id"] = device_id
+            # Fixes without ts get distinct, increasing timestamps ending now, in batch order
+            undated = sum(1 for fix in fixes if isinstance(fix, dict) and fix.get("ts") in (None, ""))
+            next_undated = now_ms() - undated + 1
+            for fi, fix in enumerate(fixes):
+                if not isinstance(fix, dict):
+                    result["rejected"].append({"index": fi, "error": "invalid fix"})
+                    continue
+                coords = parse_coords(fix.get("lat"), fix.get("lng"))
+                if coords is None:
+                    result["rejected"].append({"index": fi, "error": "invalid coordinates"})
+                    continue
+                if fix.get("ts") in (None, ""):
+                    ts = next_undated
+                    next_undated += 1
+                else:
+                    ts = ts_to_ms(fix.get("ts"))
+                if not fix_ts_valid(ts):
+                    result["rejected"].append({"index": fi, "error": "invalid timestamp"})
+                    continue
+                if (device_id, ts) in seen:
+                    result["rejected"].append({"index": fi, "error": "duplicate timestamp"})
+                    continue
+                seen.add((device_id, ts))
+                rows.append((device_id, coords[0], coords[1], ts))
+            rejected += len(result["rejected"])
+
+        stored = IngestResult({}, [], 0)
+        if rows:
+            stored = store_fixes(c, rows)
+            conn.commit()
+            fixes_committed(stored.latest)
+        # Nothing stored: leave the key unclaimed (close() rolls it back) so a corrected retry is not a "duplicate"
+
+        # Report what was written, not what was valid
+        per_device = {}
+        for row in stored.stored:
+            per_device[row[0]] = per_device.get(row[0], 0) + 1
+        for result in results:
+            result["accepted"] = per_device.pop(result.pop("device_id", None), 0)
+        return jsonify({
+            "ok": True,
+            "accepted": len(stored.stored),
+            "filtered": stored.filtered,
+            "duplicates": len(rows) - len(stored.stored) - stored.filtered,
+            "rejected": rejected,
+            "results": results,
+        })
+
+    except Exception as e:
+        conn.rollback()
+        print("ERROR in /api/location_batch:", e)
+        return jsonify({"ok": False, "error": "internal error"}), 500
+    finally:
+        conn.close()
+
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lng2 - lng1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def haversine_np(lat1, lng1, lat2, lng2):
+    """``haversine_m`` over NumPy arrays (broadcasting), in meters."""
+    import numpy as np
+
+    p1 = np.radians(lat1)
+    p2 = np.radians(lat2)
+    a = np.sin((p2 - p1) / 2) ** 2 + np.cos(p1) * np.cos(p2) * np.sin(np.radians(lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def circle_bbox(lat, lng, radius_m):
+    """(min_lat, max_lat, min_lng, max_lng) enclosing a circle; clamped at the poles."""
+    dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+    coslat = math.cos(math.radians(lat))
+    dlng = 180.0 if coslat < 1e-9 else min(180.0, math.degrees(radius_m / (EARTH_RADIUS_M * coslat)))
+    return max(-90.0, lat - dlat), min(90.0, lat + dlat), lng - dlng, lng + dlng
+
+
+def point_in_polygon(lat, lng, ring):
+    """Even-odd test of a point against a ring of ``[lat, lng]`` vertices."""
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        yi, xi = ring[i]
+        yj, xj = ring[j]
+        if (yi > lat) != (yj > lat) and lng < (xj - xi) * (lat - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+def parse_polygon(value):
+    """Validate a list of ``[lat, lng]`` pairs (at least three); returns the ring or None."""
+    if not isinstance(value, list) or len(value) < 3:
+        return None
+    ring = []
+    for vertex in value:
+        if not isinstance(vertex, (list, tuple)) or len(vertex) != 2:
+            return None
+        coords = parse_coords(vertex[0], vertex[1])
+        if coords is None:
+            return None
+        ring.append(coords)
+    return ring
+
+
+def polygon_bbox(ring):
+    lats = [v[0] for v in ring]
+    lngs = [v[1] for v in ring]
+    return min(lats), max(lats), min(lngs), max(lngs)
+
+
+def query_positions(c, min_lat, max_lat, min_lng, max_lng, limit=None):
+    """Devices whose last-known position falls in a bounding box, via the R*Tree."""
+    sql = """
+        SELECT d.id, d.owner, d.imei, d.phone, d.last_lat, d.last_lng, d.last_update
+        FROM device_positions p
+        JOIN devices d ON d.id = p.id
+        WHERE p.max_lat >= ? AND p.min_lat <= ? AND p.max_lng >= ? AND p.min_lng <= ?
+    """
+    params = [min_lat, max_lat, min_lng, max_lng]
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit)
+    c.execute(sql, params)
+    # The R*Tree stores 32-bit floats rounded outward; re-check against the exact columns
+    return [
+        dict(r) for r in c.fetchall()
+        if min_lat <= r["last_lat"] <= max_lat and min_lng <= r["last_lng"] <= max_lng
+    ]
+
+
+def devices_within_radius(c, lat, lng, radius_m, limit=None):
+    min_lat, max_lat, min_lng, max_lng = circle_bbox(lat, lng, radius_m)
+    found = []
+    for d in query_positions(c, min_lat, max_lat, min_lng, max_lng):
+        d["distance_m"] = haversine_m(lat, lng, d["last_lat"], d["last_lng"])
+        if d["distance_m"] <= radius_m:
+            found.append(d)
+    found.sort(key=lambda d: d["distance_m"])
+    return found[:limit] if limit else found
+
+
+def devices_in_polygon(c, ring):
+    return [d for d in query_positions(c, *polygon_bbox(ring)) if point_in_polygon(d["last_lat"], d["last_lng"], ring)]
+
+
+_geofence_cache = {"loaded_at": 0.0, "fences": []}
+
+
+def invalidate_geofences():
+    _geofence_cache["loaded_at"] = 0.0
+
+
+def load_geofences(c):
+    """Geofence definitions, cached per process for GEOFENCE_CACHE_TTL seconds."""
+    if time.monotonic() - _geofence_cache["loaded_at"] < GEOFENCE_CACHE_TTL:
+        METRICS.inc("cache_requests_total", ("geofences", "hit"))
+        return _geofence_cache["fences"]
+    METRICS.inc("cache_requests_total", ("geofences", "miss"))
+    c.execute("SELECT id, name, kind, geometry FROM geofences")
+    fences = []
+    for row in c.fetchall():
+        geometry = json.loads(row["geometry"])
+        fence = {"id": row["id"], "name": row["name"], "kind": row["kind"], "geometry": geometry}
+        if row["kind"] == "circle":
+            fence["bbox"] = circle_bbox(geometry["lat"], geometry["lng"], geometry["radius_m"])
+        else:
+            fence["bbox"] = polygon_bbox(geometry["polygon"])
+        fences.append(fence)
+    _geofence_cache["fences"] = fences
+    _geofence_cache["loaded_at"] = time.monotonic()
+    return fences
+
+
+def fence_contains(fence, lat, lng):
+    min_lat, max_lat, min_lng, max_lng = fence["bbox"]
+    if not (min_lat <= lat <= max_lat and min_lng <= lng <= max_lng):
+        return False
+    g = fence["geometry"]
+    if fence["kind"] == "circle":
+        return haversine_m(g["lat"], g["lng"], lat, lng) <= g["radius_m"]
+    return point_in_polygon(lat, lng, g["polygon"])
+
+
+def evaluate_geofences(c, device_ids):
+    """Record enter/exit events for devices whose position just changed.
+
+    Runs inside the ingest transaction; a no-op when no geofences exist.
+    """
+    fences = load_geofences(c)
+    if not fences or not device_ids:
+        return
+    now = now_ms()
+    events = []
+    for start in range(0, len(device_ids), 500):
+        chunk = device_ids[start:start + 500]
+        marks = ",".join("?" * len(chunk))
+        c.execute(f"SELECT id, last_lat, last_lng FROM devices WHERE id IN ({marks})", chunk)
+        positions = {r["id"]: (r["last_lat"], r["last_lng"]) for r in c.fetchall() if r["last_lat"] is not None}
+        c.execute(f"SELECT geofence_id, device_id FROM geofence_members WHERE device_id IN ({marks})", chunk)
+        members = {(r["geofence_id"], r["device_id"]) for r in c.fetchall()}
+        for device_id, (lat, lng) in positions.items():
+            for fence in fences:
+                inside = fence_contains(fence, lat, lng)
+                was_inside = (fence["id"], device_id) in members
+                if inside and not was_inside:
+                    events.append((fence["id"], device_id, "enter", now))
+                elif was_inside and not inside:
+                    events.append((fence["id"], device_id, "exit", now))
+    if events:
+        c.executemany("INSERT INTO geofence_events (geofence_id, device_id, event, ts) VALUES (?, ?, ?, ?)", events)
+        c.executemany(
+            "INSERT OR REPLACE INTO geofence_members (geofence_id, device_id, since) VALUES (?, ?, ?)",
+            [(f, d, ts) for f, d, e, ts in events if e == "enter"],
+        )
+        c.executemany(
+            "DELETE FROM geofence_members WHERE geofence_id = ? AND device_id = ?",
+            [(f, d) for f, d, e, ts in events if e == "exit"],
+        )
+
+
+def _float_arg(name, default=None):
+    value = request.args.get(name)
+    if value is None or value == "":
+        return default
+    # float() takes "nan" and "inf", which slip past every range comparison
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f"{name} must be finite")
+    return number
+
+
+@app.route("/api/spatial/radius")
+def spatial_radius():
+    """Devices whose last-known position is within ``radius_m`` of ``lat``/``lng``, nearest first."""
+    gate = require_login()
+    if gate:
+        return gate
+    try:
+        lat = _float_arg("lat")
+        lng = _float_arg("lng")
+        radius = _float_arg("radius_m")
+        limit = int(request.args.get("limit", 0)) or None
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid parameters"}), 400
+    if parse_coords(lat, lng) is None or radius is None or radius <= 0:
+        return jsonify({"ok": False, "error": "lat, lng and a positive radius_m are required"}), 400
+    if radius > SPATIAL_MAX_RADIUS_M:
+        return jsonify({"ok": False, "error": f"radius_m may not exceed {SPATIAL_MAX_RADIUS_M:g}"}), 400
+    conn = db_connect()
+    try:
+        devices = devices_within_radius(conn.cursor(), lat, lng, radius, limit)
+    finally:
+        conn.close()
+    return jsonify({"ok": True, "count": len(devices), "devices": devices})
+
+
+@app.route("/api/spatial/bbox")
+def spatial_bbox():
+    gate = require_login()
+    if gate:
+        return gate
+    try:
+        box = [_float_arg(k) for k in ("min_lat", "max_lat", "min_lng", "max_lng")]
+        limit = int(request.args.get("limit", 0)) or None
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid parameters"}), 400
+    if None in box or box[0] > box[1] or box[2] > box[3]:
+        return jsonify({"ok": False, "error": "min_lat, max_lat, min_lng and max_lng are required"}), 400
+    if parse_coords(box[0], box[2]) is None or parse_coords(box[1], box[3]) is None:
+        return jsonify({"ok": False, "error": "invalid coordinates"}), 400
+    conn = db_connect()
+    try:
+        devices = query_positions(conn.cursor(), *box, limit=limit)
+    finally:
+        conn.close()
+    return jsonify({"ok": True, "count": len(devices), "devices": devices})
+
+
+@app.route("/api/spatial/polygon", methods=["POST"])
+def spatial_polygon():
+    """Devices inside ``{"polygon": [[lat, lng], ...]}``."""
+    gate = require_login()
+    if gate:
+        return gate
+    payload = request.get_json(silent=True) or {}
+    ring = parse_polygon(payload.get("polygon"))
+    if ring is None:
+        return jsonify({"ok": False, "error": "polygon must be a list of at least three [lat, lng] pairs"}), 400
+    conn = db_connect()
+    try:
+        devices = devices_in_polygon(conn.cursor(), ring)
+    finally:
+        conn.close()
+    return jsonify({"ok": True, "count": len(devices), "devices": devices})
+
+
+@app.route("/api/geofences", methods=["GET", "POST"])
+def geofences():
+    """List geofences, or create one (admin) from
+    ``{"name", "lat", "lng", "radius_m"}`` or ``{"name", "polygon": [[lat, lng], ...]}``.
+    """
+    if request.method == "GET":
+        gate = require_login()
+        if gate:
+            return gate
+        conn = db_connect()
+        try:
+            c = conn.cursor()
+            c.execute(
+                """
+                SELECT g.id, g.name, g.kind, g.geometry, g.created_at,
+                       (SELECT COUNT(1) FROM geofence_members m WHERE m.geofence_id = g.id) AS members
+                FROM geofences g ORDER BY g.id
+                """
+            )
+            fences = [dict(r, geometry=json.loads(r["geometry"])) for r in c.fetchall()]
+        finally:
+            conn.close()
+        return jsonify({"ok": True, "geofences": fences})
+
+    gate = require_role("admin")
+    if gate:
+        return gate
+    payload = request.get_json(silent=True) or {}
+    name = (payload.get("name") or "").strip()
+    if not name:
+        return jsonify({"ok": False, "error": "name is required"}), 400
+    if "polygon" in payload:
+        ring = parse_polygon(payload.get("polygon"))
+        if ring is None:
+            return jsonify({"ok": False, "error": "polygon must be a list of at least three [lat, lng] pairs"}), 400
+        kind, geometry = "polygon", {"polygon": [list(v) for v in ring]}
+    else:
+        coords = parse_coords(payload.get("lat"), payload.get("lng"))
+        try:
+            radius = float(payload.get("radius_m"))
+        except (TypeError, ValueError):
+            radius = 0
+        if coords is None or not math.isfinite(radius) or radius <= 0:
+            return jsonify({"ok": False, "error": "lat, lng and a positive radius_m are required"}), 400
+        if radius > SPATIAL_MAX_RADIUS_M:
+            return jsonify({"ok": False, "error": f"radius_m may not exceed {SPATIAL_MAX_RADIUS_M:g}"}), 400
+        kind, geometry = "circle", {"lat": coords[0], "lng": coords[1], "radius_m": radius}
+
+    conn = db_connect()
+    try:
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO geofences (name, kind, geometry, created_at) VALUES (?, ?, ?, ?)",
+            (name, kind, json.dumps(geometry), datetime.utcnow().isoformat()),
+        )
+        fence_id = c.lastrowid
+        # Seed membership from current positions so only later moves raise events
+        if kind == "circle":
+            inside = devices_within_radius(c, geometry["lat"], geometry["lng"], geometry["radius_m"])
+        else:
+            inside = devices_in_polygon(c, ring)
+        now = now_ms()
+        c.executemany(
+            "INSERT INTO geofence_members (geofence_id, device_id, since) VALUES (?, ?, ?)",
+            [(fence_id, d["id"], now) for d in inside],
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    invalidate_geofences()
+    return jsonify({"ok": True, "id": fence_id, "members": len(inside)}), 201
+
+
+@app.route("/api/geofences/<int:fence_id>", methods=["DELETE"])
+def delete_geofence(fence_id):
+    gate = require_role("admin")
+    if gate:
+        return gate
+    conn = db_connect()
+    try:
+        c = conn.cursor()
+        c.execute("DELETE FROM geofences WHERE id = ?", (fence_id,))
+        deleted = c.rowcount
+        c.execute("DELETE FROM geofence_members WHERE geofence_id = ?", (fence_id,))
+        conn.commit()
+    finally:
+        conn.close()
+    invalidate_geofences()
+    if not deleted:
+        return jsonify({"ok": False, "error": "geofence not found"}), 404
+    return jsonify({"ok": True})
+
+
+@app.route("/api/geofences/events")
+def geofence_events():
+    """Enter/exit events, oldest first; page with ``after`` (last event id) and ``limit``."""
+    gate = require_login()
+    if gate:
+        return gate
+    try:
+        after = int(request.args.get("after", 0))
+        limit = min(int(request.args.get("limit", 500)), 5000)
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid parameters"}), 400
+    params = [after]
+    sql = "SELECT id, geofence_id, device_id, event, ts FROM geofence_events WHERE id > ?"
+    if request.args.get("geofence_id"):
+        sql += " AND geofence_id = ?"
+        params.append(request.args.get("geofence_id"))
+    sql += " ORDER BY id LIMIT ?"
+    params.append(limit)
+    conn = db_connect()
+    try:
+        c = conn.cursor()
+        c.execute(sql, params)
+        events = [dict(r) for r in c.fetchall()]
+    finally:
+        conn.close()
+    return jsonify({"ok": True, "events": events, "next_after": events[-1]["id"] if events else after})
+
+
+FLEET_COLUMNS = "id, owner, imei, phone, carrier, region, last_update, last_lat, last_lng"
+
+
+def list_devices(c, owner=None, carrier=None, region=None, stale=None, active=None, never=False,
+                 cursor=None, limit=FLEET_PAGE_SIZE):
+    """Return one page of devices and the cursor of the next page (or None).
+
+    Without an age filter devices are listed by id. ``stale``/``active``
+    (seconds since last_update) list by ``(last_update, id)`` instead, so every
+    page is a range read of an index; ``never`` lists devices that have never
+    reported. The cursor is the last row's id, or ``"<last_update>|<id>"``.
+    """
+    where = []
+    params = []
+    for column, value in (("owner", owner), ("carrier", carrier), ("region", region)):
+        if value is not None:
+            where.append(f"{column} = ?")
+            params.append(value)
+    by_time = stale is not None or active is not None
+    if never:
+        where.append("last_update IS NULL")
+    elif by_time:
+        now = now_ms()
+        where.append("last_update IS NOT NULL")
+        if stale is not None:
+            where.append("last_update < ?")
+            params.append(ms_to_ts_text(now - int(stale * 1000)))
+        if active is not None:
+            where.append("last_update >= ?")
+            params.append(ms_to_ts_text(now - int(active * 1000)))
+    if cursor:
+        if by_time:
+            last_update, _, last_id = cursor.rpartition("|")
+            # The range bound keeps the index seek; the OR only skips ties on last_update
+            where.append("last_update >= ? AND (last_update > ? OR id > ?)")
+            params += [last_update, last_update, int(last_id)]
+        else:
+            where.append("id > ?")
+            params.append(int(cursor))
+    sql = f"SELECT {FLEET_COLUMNS} FROM devices"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY last_update, id" if by_time else " ORDER BY id"
+    c.execute(sql + " LIMIT ?", params + [limit + 1])
+    rows = [dict(r) for r in c.fetchall()]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = f"{last['last_update']}|{last['id']}" if by_time else str(last["id"])
+    return rows, next_cursor
+
+
+def fleet_summary(c, stale=FLEET_STALE_AFTER, hours=24):
+    """Fleet totals from the incrementally maintained counters (no scan of ``devices``)."""
+    groups = [
+        {"carrier": carrier or None, "region": region or None, "devices": n}
+        for carrier, region, n in c.execute(
+            "SELECT carrier, region, devices FROM fleet_groups WHERE devices > 0 ORDER BY devices DESC"
+        )
+    ]
+    cutoff = ms_to_ts_text(now_ms() - int(stale * 1000))
+    never = c.execute("SELECT COALESCE(SUM(devices), 0) FROM fleet_last_seen WHERE hour = ''").fetchone()[0]
+    # Whole hours come from the counters; only the hour containing the cutoff is read from the index
+    stale_count = c.execute(
+        "SELECT COALESCE(SUM(devices), 0) FROM fleet_last_seen WHERE hour > '' AND hour < ?", (cutoff[:13],)
+    ).fetchone()[0]
+    stale_count += c.execute(
+        "SELECT COUNT(*) FROM devices WHERE last_update >= ? AND last_update < ?", (cutoff[:13], cutoff)
+    ).fetchone()[0]
+    current = now_ms() // 3600000
+    counts = dict(c.execute(
+        "SELECT hour, fixes FROM fleet_updates_hourly WHERE hour > ? AND hour <= ?", (current - hours, current)
+    ).fetchall())
+    by_carrier = {}
+    by_region = {}
+    for g in groups:
+        by_carrier[g["carrier"]] = by_carrier.get(g["carrier"], 0) + g["devices"]
+        by_region[g["region"]] = by_region.get(g["region"], 0) + g["devices"]
+    return {
+        "devices": sum(g["devices"] for g in groups),
+        "never_reported": never,
+        "stale": stale_count,
+        "stale_after_s": stale,
+        "by_carrier": [{"carrier": k, "devices": v} for k, v in sorted(by_carrier.items(), key=lambda kv: -kv[1])],
+        "by_region": [{"region": k, "devices": v} for k, v in sorted(by_region.items(), key=lambda kv: -kv[1])],
+        "groups": groups,
+        "updates_per_hour": [
+            {"hour": h * 3600000, "fixes": counts.get(h, 0)} for h in range(current - hours + 1, current + 1)
+        ],
+    }
+
+
+def _fleet_args():
+    """Parse the listing filters shared by the API and the page; raises ValueError."""
+    args = request.args
+    limit = int(args.get("limit", FLEET_PAGE_SIZE))
+    if not 0 < limit <= FLEET_PAGE_MAX:
+        raise ValueError("limit out of range")
+    stale = float(args["stale"]) if args.get("stale") else None
+    active = float(args["active"]) if args.get("active") else None
+    cursor = args.get("cursor") or None
+    if cursor and (stale is not None or active is not None):
+        int(cursor.rpartition("|")[2])
+    elif cursor:
+        int(cursor)
+    return {
+        "owner": args.get("owner") or None,
+        "carrier": args.get("carrier") or None,
+        "region": args.get("region") or None,
+        "stale": stale,
+        "active": active,
+        "never": args.get("never") == "1",
+        "cursor": cursor,
+        "limit": limit,
+    }
+
+
+@app.route("/api/devices")
+def api_devices():
+    gate = require_login()
+    if gate:
+        return gate
+    try:
+        filters = _fleet_args()
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid parameters"}), 400
+    conn = db_connect()
+    try:
+        rows, next_cursor = list_devices(conn.cursor(), **filters)
+    finally:
+        conn.close()
+    return jsonify({"ok": True, "devices": rows, "next_cursor": next_cursor})
+
+
+@app.route("/api/fleet/summary")
+def api_fleet_summary():
+    gate = require_login()
+    if gate:
+        return gate
+    try:
+        stale = float(request.args.get("stale", FLEET_STALE_AFTER))
+        hours = min(int(request.args.get("hours", 24)), 24 * 31)
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid parameters"}), 400
+    conn = db_connect()
+    try:
+        summary = fleet_summary(conn.cursor(), stale, max(hours, 1))
+    finally:
+        conn.close()
+    return jsonify({"ok": True, **summary})
+
+
+@app.route("/fleet")
+def fleet():
+    gate = require_login()
+    if gate:
+        return gate
+    try:
+        filters = _fleet_args()
+    except ValueError:
+        flash("Invalid filter.", "error")
+        return redirect(url_for("fleet"))
+    conn = db_connect()
+    try:
+        c = conn.cursor()
+        rows, next_cursor = list_devices(c, **filters)
+        summary = fleet_summary(c, filters["stale"] or FLEET_STALE_AFTER)
+    finally:
+        conn.close()
+    next_args = {k: v for k, v in request.args.items() if k != "cursor"}
+    return render_template(
+        "fleet.html", devices=rows, summary=summary, filters=request.args,
+        next_url=url_for("fleet", cursor=next_cursor, **next_args) if next_cursor else None,
+    )
+
+
+@app.route("/device/token", methods=["GET", "POST"])
+def device_token():
+    gate = require_role("admin")
+    if gate:
+        return gate
+    context = {"device": None}
+    if request.method == "POST":
+        query = request.form.get("query", "").strip()
+        conn = db_connect()
+        try:
+            c = conn.cursor()
+            device_row = None
+            if is_imei(query):
+                c.execute("SELECT * FROM devices WHERE imei = ?", (query,))
+                device_row = c.fetchone()
+            else:
+                normalized = normalize_phone(query)
+                if normalized:
+                    c.execute("SELECT * FROM devices WHERE phone = ?", (normalized,))
+                    device_row = c.fetchone()
+            if not device_row:
+                flash("Device not found.", "error")
+            else:
+                if request.form.get("regen") == "1":
+                    new_token = secrets.token_urlsafe(24)
+                    c.execute("UPDATE devices SET api_token = ? WHERE id = ?", (new_token, device_row["id"]))
+                    conn.commit()
+                    invalidate_device_auth(device_row["imei"], device_row["phone"], device_row["id"])
+                    response_cache.invalidate([device_row["id"]])
+                    device_row = dict(device_row)
+                    device_row["api_token"] = new_token
+                    flash("Token regenerated.", "success")
+                context["device"] = dict(device_row)
+        finally:
+            conn.close()
+    return render_template("device_token.html", **context)
+
+
+@app.route("/login", methods=["GET", "POST"])
+def login():
+    global _admin_checked
+    if request.method == "POST":
+        if not _admin_checked:
+            # Fallback when the app was started without init_app_data()
+            ensure_initial_admin()
+            _admin_checked = True
+        username = request.form.get("username", "").strip()
+        password = request.form.get("password", "")
+        user = get_user_by_username_db(username)
+        if not user or not check_password_hash(user.get("password_hash", ""), password):
+            flash("Invalid credentials.", "error")
+            return render_template("login.html")
+        # If user has phone configured, require 2FA
+        user_phone = user.get("phone")
+        if user_phone:
+            try:
+                job = issue_2fa_code(user)
+            except Exception as e:
+                flash(f"Could not send the verification code ({e}). Please try again.", "error")
+                return render_template("login.html")
+            if not job.done.is_set():
+                flash("The verification code is still being sent. If it does not arrive, resend it.", "warning")
+            return redirect(url_for("login_verify"))
+        # No phone: allow login (viewer) or warn for admin
+        if user.get("role") == "admin":
+            flash("Admin login without 2FA phone configured. Please set your phone.", "warning")
+        session["user"] = {"username": user["username"], "role": user.get("role", "viewer")}
+        flash("Logged in.", "success")
+        next_url = request.args.get("next")
+        return redirect(next_url or url_for("index"))
+    return render_template("login.html")
+
+
+@app.route("/login/verify", methods=["GET", "POST"])
+def login_verify():
+    if request.method == "POST":
+        code = request.form.get("code", "").strip()
+        expected = session.get("twofa_code")
+        expires = session.get("twofa_expires", 0)
+        if not expected or datetime.utcnow().timestamp() > float(expires):
+            flash("Verification code expired. Please log in again.", "error")
+            return redirect(url_for("login"))
+        if code != expected:
+            flash("Invalid verification code.", "error")
+            return render_template("twofa.html")
+        user = session.get("pending_user")
+        if not user:
+            flash("No pending login session.", "error")
+            return redirect(url_for("login"))
+        # finalize login
+        session.pop("pending_user", None)
+        session.pop("twofa_code", None)
+        session.pop("twofa_expires", None)
+        session.pop("twofa_sent", None)
+        session["user"] = user
         flash("Logged in.", "success")
         return redirect(url_for("index"))
     return render_template("twofa.html")
 
 
-@app.route("/logout")
-def logout():
-    session.pop("user", None)
-    flash("Logged out.", "success")
-    return redirect(url_for("index"))
+@app.route("/login/resend", methods=["POST"])
+def login_resend():
+    """Send a new code for the pending login, e.g. after the first SMS failed or never arrived."""
+    pending = session.get("pending_user")
+    if not pending:
+        flash("No pending login session.", "error")
+        return redirect(url_for("login"))
+    if datetime.utcnow().timestamp() - float(session.get("twofa_sent", 0)) < 30:
+        flash("A code was sent moments ago. Please wait before requesting another.", "warning")
+        return redirect(url_for("login_verify"))
+    user = get_user_by_username_db(pending["username"])
+    if not user or not user.get("phone"):
+        flash("No pending login session.", "error")
+        return redirect(url_for("login"))
+    try:
+        job = issue_2fa_code(user)
+    except Exception as e:
+        flash(f"Could not send the verification code ({e}). Please try again.", "error")
+        return redirect(url_for("login_verify"))
+    if job.done.is_set():
+        flash("A new verification code was sent.", "success")
+    else:
+        flash("The verification code is still being sent. If it does not arrive, resend it.", "warning")
+    return redirect(url_for("login_verify"))
+
+
+@app.route("/logout")
+def logout():
+    session.pop("user", None)
+    flash("Logged out.", "success")
+    return redirect(url_for("index"))
+
+
+@app.route("/users/create", methods=["GET", "POST"])
+def create_user():
+    gate = require_role("admin")
+    if gate:
+        return gate
+    if request.method == "POST":
+        username = request.form.get("username", "").strip()
+        password = request.form.get("password", "")
+        role = request.form.get("role", "viewer")
+        phone = request.form.get("phone", "").strip() or None
+        conn = db_connect()
+        try:
+            c = conn.cursor()
+            c.execute("SELECT 1 FROM users WHERE username = ?", (username,))
+            if c.fetchone():
+                flash("User already exists.", "error")
+                return render_template("user_create.html")
+            c.execute(
+                "INSERT INTO users (username, password_hash, role, phone, created_at) VALUES (?, ?, ?, ?, ?)",
+                (username, generate_password_hash(password), role, phone, datetime.utcnow().isoformat()),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        flash("User created.", "success")
+        return redirect(url_for("index"))
+    return render_template("user_create.html")
+
+
+@app.route("/onboard/sms", methods=["GET", "POST"])
+def onboard_sms():
+    """Queue install-link SMS for one or more numbers (comma- or newline-separated)."""
+    gate = require_login()
+    if gate:
+        return gate
+    agent_link = (AGENT_DOWNLOAD_URL or (request.url_root.rstrip('/') + url_for('agent_download')))
+    if request.method == "POST":
+        raw = request.form.get("phones") or request.form.get("phone", "")
+        numbers = [n.strip() for n in raw.replace(",", "\n").splitlines() if n.strip()]
+        if not numbers:
+            flash("Enter a valid phone number including country code.", "error")
+            return render_template("onboard.html", agent_url=agent_link)
+        if len(numbers) > SMS_BULK_MAX:
+            flash(f"At most {SMS_BULK_MAX} numbers can be onboarded at once.", "error")
+            return render_template("onboard.html", agent_url=agent_link)
+        phones = enrich_phones(numbers)
+        invalid = [n for n in numbers if phones.get(n) is None]
+        recipients = list(dict.fromkeys(phones[n].e164 for n in numbers if phones.get(n) is not None))
+        body = f"Install the tracking companion app: {agent_link}"
+        queued = 0
+        failed = None
+        for to in recipients:
+            try:
+                sms_dispatcher.submit(to, body, kind="onboard")
+                queued += 1
+            except SmsError as e:
+                failed = e
+                break
+        if queued:
+            flash(f"Onboarding SMS queued for {queued} number{'s' if queued != 1 else ''}.", "success")
+        if failed is not None:
+            flash(f"Failed to send SMS: {failed} ({len(recipients) - queued} not sent)", "error")
+        if invalid:
+            flash(f"Skipped {len(invalid)} invalid numbers: {', '.join(invalid[:5])}", "warning")
+        return redirect(url_for("onboard_sms"))
+    return render_template("onboard.html", agent_url=agent_link)
+
+
+@app.route("/sms/stats")
+def sms_stats():
+    gate = require_login()
+    if gate:
+        return gate
+    return jsonify(sms_dispatcher.stats())
+
+
+# Already-compressed formats gain nothing from DEFLATE; store them as-is
+ZIP_STORED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif", ".jar", ".aar", ".apk", ".zip", ".gz", ".mp3", ".mp4"}
+# IDE and build artifacts left out of the bundle when AGENT_BUNDLE_EXCLUDE_IDE=1
+IDE_ARTIFACT_DIRS = {".idea", ".gradle", "build", ".vscode", "captures"}
+IDE_ARTIFACT_FILES = {"local.properties", ".DS_Store"}
+IDE_ARTIFACT_EXTENSIONS = {".iml"}
+
+_agent_bundle_lock = threading.Lock()
+_agent_bundle = {"checked": 0.0, "path": None, "etag": None}
+
+
+def agent_bundle_files(base_dir, exclude_ide=AGENT_BUNDLE_EXCLUDE_IDE):
+    """Return sorted ``(arcname, full_path, stat)`` for the files that go into the bundle."""
+    out = []
+    for root, dirs, files in os.walk(base_dir):
+        if exclude_ide:
+            dirs[:] = [d for d in dirs if d not in IDE_ARTIFACT_DIRS]
+        for fname in files:
+            if exclude_ide and (fname in IDE_ARTIFACT_FILES or os.path.splitext(fname)[1] in IDE_ARTIFACT_EXTENSIONS):
+                continue
+            full_path = os.path.join(root, fname)
+            out.append((os.path.relpath(full_path, base_dir).replace(os.sep, "/"), full_path, os.stat(full_path)))
+    out.sort()
+    return out
+
+
+def build_agent_bundle(files, path):
+    """Write the zip to a temporary file next to ``path`` and move it into place atomically."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with zipfile.ZipFile(tmp, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for arcname, full_path, st in files:
+            stored = os.path.splitext(arcname)[1].lower() in ZIP_STORED_EXTENSIONS
+            zf.write(full_path, arcname, compress_type=zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED)
+    os.replace(tmp, path)
+
+
+def agent_bundle():
+    """Return ``(path, etag)`` of the prebuilt agent zip, rebuilding it when the sources change.
+
+    The fingerprint covers every included file's name, size and mtime, so an
+    unchanged tree is only re-walked (at most every ``AGENT_BUNDLE_CHECK``
+    seconds) and never re-zipped. Bundles are shared by all workers on disk.
+    """
+    with _agent_bundle_lock:
+        if _agent_bundle["path"] and time.monotonic() - _agent_bundle["checked"] < AGENT_BUNDLE_CHECK \
+                and os.path.exists(_agent_bundle["path"]):
+            return _agent_bundle["path"], _agent_bundle["etag"]
+        base_dir = os.path.join(os.path.dirname(__file__), "agent_examples", "android")
+        files = agent_bundle_files(base_dir)
+        digest = hashlib.sha256(f"exclude_ide={AGENT_BUNDLE_EXCLUDE_IDE}\n".encode())
+        for arcname, _, st in files:
+            digest.update(f"{arcname}\0{st.st_size}\0{st.st_mtime_ns}\0{st.st_mode}\n".encode())
+        etag = digest.hexdigest()[:32]
+        path = os.path.join(AGENT_BUNDLE_DIR, f"android_agent-{etag}.zip")
+        if not os.path.exists(path):
+            os.makedirs(AGENT_BUNDLE_DIR, exist_ok=True)
+            build_agent_bundle(files, path)
+            for name in os.listdir(AGENT_BUNDLE_DIR):
+                if name.startswith("android_agent-") and name.endswith(".zip") and name != os.path.basename(path):
+                    try:
+                        os.remove(os.path.join(AGENT_BUNDLE_DIR, name))
+                    except OSError:
+                        pass
+        _agent_bundle.update(checked=time.monotonic(), path=path, etag=etag)
+        return path, etag
+
+
+@app.route("/agent/download")
+def agent_download():
+    # Serve the prebuilt zip; send_file answers If-None-Match/If-Modified-Since and Range requests
+    path, etag = agent_bundle()
+    return send_file(
+        path,
+        as_attachment=True,
+        download_name="android_agent_example.zip",
+        etag=etag,
+        conditional=True,
+        max_age=AGENT_BUNDLE_CHECK,
+    )
+
+
+def _export_rows(c, since=None, until=None, device_ids=None, imeis=None, phones=None):
+    """Yield ``(device_row, location_or_None)`` pairs for the export, ordered by device then time.
+
+    One query joins devices to their history; the (device_id, ts) primary key
+    on locations supplies each device's rows already sorted. With shards,
+    see ``_export_rows_sharded``.
+    """
+    loc_cond = ""
+    loc_params = []
+    if since is not None:
+        loc_cond += " AND l.ts >= ?"
+        loc_params.append(since)
+    if until is not None:
+        loc_cond += " AND l.ts <= ?"
+        loc_params.append(until)
+    subset = []
+    subset_params = []
+    for column, values in (("d.id", device_ids), ("d.imei", imeis), ("d.phone", phones)):
+        if values:
+            subset.append(f"{column} IN ({','.join('?' * len(values))})")
+            subset_params.extend(values)
+    where = f"WHERE {' OR '.join(subset)}" if subset else ""
+    if _location_shards:
+        yield from _export_rows_sharded(c, where, subset_params, loc_cond.replace("l.ts", "ts"), loc_params)
+        return
+    c.execute(
+        f"""
+        SELECT d.*, l.lat AS loc_lat, l.lng AS loc_lng, l.ts AS loc_ts
+        FROM devices d
+        LEFT JOIN locations l ON l.device_id = d.id{loc_cond}
+        {where}
+        ORDER BY d.id, l.ts
+        """,
+        loc_params + subset_params,
+    )
+    for row in c:
+        loc = None
+        if row["loc_ts"] is not None:
+            loc = {"lat": row["loc_lat"], "lng": row["loc_lng"], "ts": row["loc_ts"]}
+        yield row, loc
+
+
+def _export_rows_sharded(c, where, subset_params, loc_cond, loc_params):
+    """Merge-join devices (ordered by id) with every shard's history, read in parallel."""
+    c.execute(f"SELECT d.* FROM devices d {where} ORDER BY d.id", subset_params)
+    devices = c
+    if subset_params:
+        # Pass a filtered export's device ids on so shards only read those ranges
+        devices = c.fetchall()
+        ids = [row["id"] for row in devices]
+        if not ids:
+            return
+        loc_cond += f" AND device_id IN ({','.join('?' * len(ids))})"
+        loc_params = loc_params + ids
+    locs = merged_shard_rows(
+        f"SELECT device_id, ts, lat, lng FROM locations WHERE 1 = 1{loc_cond} ORDER BY device_id, ts", loc_params
+    )
+    try:
+        pending = next(locs, None)
+        for row in devices:
+            # Skip history of devices that are filtered out or no longer exist
+            while pending is not None and pending[0] < row["id"]:
+                pending = next(locs, None)
+            if pending is None or pending[0] != row["id"]:
+                yield row, None
+                continue
+            while pending is not None and pending[0] == row["id"]:
+                yield row, {"lat": pending[2], "lng": pending[3], "ts": pending[1]}
+                pending = next(locs, None)
+    finally:
+        locs.close()
+
+
+def _export_device_head(row):
+    d = {k: row[k] for k in row.keys() if not k.startswith("loc_")}
+    d["last_location"] = {"lat": d["last_lat"], "lng": d["last_lng"]} if d.get(
+        "last_lat") is not None and d.get("last_lng") is not None else None
+    # Leave the object open so locations can be streamed into it
+    return json.dumps(d)[:-1] + ', "locations": ['
+
+
+def _export_stream(rows, ndjson):
+    """Serialize export rows incrementally, yielding ~64 KiB text chunks."""
+    buf = []
+    size = 0
+    current = None
+    first_loc = True
+    if not ndjson:
+        buf.append('{"devices": [')
+    for row, loc in rows:
+        if row["id"] != current:
+            if current is not None:
+                buf.append("]}\n" if ndjson else "]}, ")
+            current = row["id"]
+            first_loc = True
+            head = _export_device_head(row)
+            buf.append(head)
+            size += len(head)
+        if loc is not None:
+            piece = json.dumps(loc) if first_loc else ", " + json.dumps(loc)
+            first_loc = False
+            buf.append(piece)
+            size += len(piece)
+        if size >= 65536:
+            yield "".join(buf)
+            buf = []
+            size = 0
+    if current is not None:
+        buf.append("]}\n" if ndjson else "]}")
+    if not ndjson:
+        buf.append("]}")
+    yield "".join(buf)
+
+
+def _gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@app.route("/export")
+def export():
+    """Stream devices and their history.
+
+    Query parameters: ``format`` (``json`` or ``ndjson``), ``gzip=1``, ``since``/``until``
+    (epoch seconds/ms or ISO-8601) and repeatable ``device_id``/``imei``/``phone`` filters.
+    """
+    gate = require_login()
+    if gate:
+        return gate
+    fmt = request.args.get("format", "json").lower()
+    if fmt not in ("json", "ndjson"):
+        return jsonify({"ok": False, "error": "format must be json or ndjson"}), 400
+    since = ts_to_ms(request.args.get("since"))
+    until = ts_to_ms(request.args.get("until"))
+    # An unreadable bound would otherwise be dropped and export the whole history
+    if (request.args.get("since") and since is None) or (request.args.get("until") and until is None):
+        return jsonify({"ok": False, "error": "since/until must be epoch seconds/ms or ISO-8601"}), 400
+    try:
+        device_ids = [int(v) for v in request.args.getlist("device_id")]
+    except ValueError:
+        return jsonify({"ok": False, "error": "device_id must be an integer"}), 400
+    imeis = request.args.getlist("imei")
+    phones = request.args.getlist("phone")
+    ndjson = fmt == "ndjson"
+
+    def generate():
+        conn = db_connect()
+        try:
+            rows = _export_rows(conn.cursor(), since, until, device_ids, imeis, phones)
+            yield from _export_stream(rows, ndjson)
+        finally:
+            conn.close()
+
+    mimetype = "application/x-ndjson" if ndjson else "application/json"
+    filename = "export.ndjson" if ndjson else "export.json"
+    if request.args.get("gzip") in ("1", "true", "yes"):
+        body = _gzip_stream(generate())
+        mimetype = "application/gzip"
+        filename += ".gz"
+    else:
+        body = generate()
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+
+
+def simplify_track(points, tolerance_m):
+    """Douglas-Peucker simplification of ``(lat, lng, ts)`` points with a tolerance in meters.
+
+    Uses an equirectangular projection around the track's mean latitude, which
+    is accurate enough at map scales; endpoints are always kept.
+    """
+    n = len(points)
+    if n < 3 or tolerance_m <= 0:
+        return list(points)
+    lat0 = math.radians(sum(p[0] for p in points) / n)
+    kx = 111320.0 * math.cos(lat0)
+    ky = 110540.0
+    xs = [p[1] * kx for p in points]
+    ys = [p[0] * ky for p in points]
+    tol2 = tolerance_m * tolerance_m
+    keep = bytearray(n)
+    keep[0] = keep[-1] = 1
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = xs[first], ys[first]
+        dx, dy = xs[last] - x1, ys[last] - y1
+        seg2 = dx * dx + dy * dy
+        max_d2 = -1.0
+        index = -1
+        for i in range(first + 1, last):
+            px, py = xs[i] - x1, ys[i] - y1
+            if seg2 > 0:
+                t = (px * dx + py * dy) / seg2
+                t = 0.0 if t < 0 else (1.0 if t > 1 else t)
+                px -= t * dx
+                py -= t * dy
+            d2 = px * px + py * py
+            if d2 > max_d2:
+                max_d2 = d2
+                index = i
+        if max_d2 > tol2:
+            keep[index] = 1
+            stack.append((first, index))
+            stack.append((index, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+def zoom_tolerance(zoom, lat):
+    """Meters covered by HISTORY_PIXEL_TOLERANCE screen pixels at a web-map zoom level."""
+    return 156543.03392 * math.cos(math.radians(lat)) / (2 ** zoom) * HISTORY_PIXEL_TOLERANCE
+
+
+@app.route("/api/devices/<int:device_id>")
+def device_detail(device_id):
+    """Device record with its 30 most recent fixes; cached, with ETag revalidation."""
+    gate = require_login()
+    if gate:
+        return gate
+    view = device_view(device_id)
+    if view is None:
+        return jsonify({"ok": False, "error": "device not found"}), 404
+    return view_response(view)
+
+
+@app.route("/api/devices/<int:device_id>/history")
+def device_history(device_id):
+    """Time-windowed, paginated and optionally simplified location history for maps.
+
+    Query parameters: ``since``/``until`` (epoch seconds/ms or ISO-8601), ``cursor``
+    (``next_cursor`` of the previous page), ``limit`` (raw rows per page),
+    ``bucket`` (seconds; averages fixes into fixed intervals), ``zoom`` or
+    ``tolerance`` (meters) for Douglas-Peucker simplification, ``max_points``, and
+    ``include_archive=1`` to also read rows moved to the retention archive.
+    """
+    gate = require_login()
+    if gate:
+        return gate
+    args = request.args
+    try:
+        cursor = int(args["cursor"]) if args.get("cursor") else None
+        limit = min(int(args.get("limit", HISTORY_PAGE_ROWS)), HISTORY_PAGE_ROWS)
+        bucket = int(args["bucket"]) if args.get("bucket") else None
+        zoom = float(args["zoom"]) if args.get("zoom") else None
+        tolerance = float(args["tolerance"]) if args.get("tolerance") else None
+        max_points = min(int(args.get("max_points", HISTORY_MAX_POINTS)), HISTORY_MAX_POINTS)
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid parameters"}), 400
+    if limit <= 0 or max_points <= 1 or (bucket is not None and bucket <= 0):
+        return jsonify({"ok": False, "error": "invalid parameters"}), 400
+    include_archive = args.get("include_archive") == "1"
+    if include_archive and bucket:
+        return jsonify({"ok": False, "error": "include_archive cannot be combined with bucket"}), 400
+    since = ts_to_ms(args.get("since"))
+    until = ts_to_ms(args.get("until"))
+    if (args.get("since") and since is None) or (args.get("until") and until is None):
+        return jsonify({"ok": False, "error": "invalid parameters"}), 400
+    lower = since if since is not None else 0
+    if cursor is not None:
+        lower = max(lower, cursor + 1)
+    upper = until if until is not None else 2 ** 62
+
+    variant = f"{lower}:{upper}:{limit}:{bucket}:{zoom}:{tolerance}:{max_points}:{int(include_archive)}"
+    view = response_cache.fetch("history", device_id, variant, lambda: history_payload(
+        device_id, lower, upper, limit, bucket, zoom, tolerance, max_points, include_archive,
+    ))
+    if view is None:
+        return jsonify({"ok": False, "error": "device not found"}), 404
+    return view_response(view)
+
+
+def history_payload(device_id, lower, upper, limit, bucket, zoom, tolerance, max_points, include_archive):
+    """Build the ``device_history`` response body, or None when the device does not exist."""
+    conn = db_connect()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT 1 FROM devices WHERE id = ?", (device_id,))
+        if not c.fetchone():
+            return None
+        c = location_db(device_id).cursor()
+        if bucket:
+            width = bucket * 1000
+            c.execute(
+                """
+                SELECT AVG(lat), AVG(lng), (ts / ?) * ? AS bucket_ts
+                FROM locations
+                WHERE device_id = ? AND ts >= ? AND ts <= ?
+                GROUP BY ts / ?
+                ORDER BY bucket_ts
+                LIMIT ?
+                """,
+                (width, width, device_id, lower, upper, width, limit + 1),
+            )
+        else:
+            c.execute(
+                """
+                SELECT lat, lng, ts
+                FROM locations
+                WHERE device_id = ? AND ts >= ? AND ts <= ?
+                ORDER BY ts
+                LIMIT ?
+                """,
+                (device_id, lower, upper, limit + 1),
+            )
+        points = [tuple(r) for r in c.fetchall()]
+    finally:
+        conn.close()
+    if include_archive:
+        # Archived rows are older than anything left in the table, but merge by ts to be safe
+        merged = {ts: (lat, lng, ts) for lat, lng, ts in read_archive(device_id, lower, upper, limit + 1)}
+        merged.update((p[2], p) for p in points)
+        points = [merged[ts] for ts in sorted(merged)][:limit + 1]
+
+    next_cursor = None
+    if len(points) > limit:
+        points = points[:limit]
+        # Continue after the last row, or after the whole last bucket
+        next_cursor = points[-1][2] + (bucket * 1000 - 1 if bucket else 0)
+    raw_count = len(points)
+
+    if points and (zoom is not None or tolerance is not None or len(points) > max_points):
+        if tolerance is None:
+            tolerance = zoom_tolerance(zoom if zoom is not None else 18, points[-1][0])
+        simplified = simplify_track(points, tolerance)
+        # Coarsen until the map's vertex budget is met
+        while len(simplified) > max_points:
+            tolerance = max(tolerance * 2, 1.0)
+            simplified = simplify_track(simplified, tolerance)
+        points = simplified
+
+    return {
+        "ok": True,
+        "device_id": device_id,
+        "raw_count": raw_count,
+        "count": len(points),
+        "tolerance_m": tolerance,
+        "points": [{"lat": lat, "lng": lng, "ts": ts} for lat, lng, ts in points],
+        "next_cursor": next_cursor,
+    }
+
+
+DAY_MS = 86400000
+ANALYTICS_STILL_WINDOW_MS = 60000
+
+
+def true_runs(mask):
+    """``(starts, ends)`` of the runs of True in a boolean array; ends are exclusive."""
+    import numpy as np
+
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.astype(np.int8), [0]))))
+    return edges[0::2], edges[1::2]
+
+
+def track_steps(ts, lat, lng):
+    """Distance (m), duration (s) and speed (m/s) of each step between consecutive fixes."""
+    import numpy as np
+
+    d = haversine_np(lat[:-1], lng[:-1], lat[1:], lng[1:])
+    dt = np.diff(ts) / 1000.0
+    return d, dt, d / np.maximum(dt, 1.0)
+
+
+def load_track(c, device_id, lower, upper, anchor=False):
+    """Fixes of ``device_id`` in ``[lower, upper)`` as columnar float arrays.
+
+    Returns ``(ts, lat, lng, anchored)``. With ``anchor`` the device's last fix
+    before ``lower`` is prepended, if there is one, and ``anchored`` says so.
+    """
+    import numpy as np
+
+    rows = []
+    if anchor:
+        rows = c.execute(
+            "SELECT ts, lat, lng FROM locations WHERE device_id = ? AND ts < ? ORDER BY ts DESC LIMIT 1",
+            (device_id, lower),
+        ).fetchall()
+    cur = c.execute(
+        "SELECT ts, lat, lng FROM locations WHERE device_id = ? AND ts >= ? AND ts < ? ORDER BY ts",
+        (device_id, lower, upper),
+    )
+    flat = np.fromiter(itertools.chain.from_iterable(itertools.chain(rows, cur)), dtype=np.float64)
+    ts, lat, lng = np.ascontiguousarray(flat.reshape(-1, 3).T)
+    return ts, lat, lng, bool(rows)
+
+
+def empty_part(fixes=0):
+    return {
+        "fixes": fixes, "distance_m": 0.0, "moving_m": 0.0, "moving_s": 0.0, "max_speed_ms": 0.0,
+        "stopped_s": 0.0, "stops": [], "trips": [],
+    }
+
+
+def merge_parts(*parts):
+    """Combine consecutive analysis parts of one track (None parts are skipped)."""
+    merged = empty_part()
+    for part in parts:
+        if part is None:
+            continue
+        for key in ("fixes", "distance_m", "moving_m", "moving_s", "stopped_s"):
+            merged[key] += part[key]
+        merged["max_speed_ms"] = max(merged["max_speed_ms"], part["max_speed_ms"])
+        merged["stops"] += part["stops"]
+        merged["trips"] += part["trips"]
+    return merged
+
+
+def analyze_track(ts, lat, lng, context=0):
+    """Distance, speed, stops and trips of one time-ordered track, in array operations.
+
+    The first ``context`` fixes come from before the window: they are not
+    counted, but the step out of the last of them is. Returns ``(closed, open,
+    boundary_ts)``. ``closed`` covers the track up to the end of the last stop
+    that at least three later fixes and a minute confirm (None if there is
+    none), ``open`` the rest. Appending fixes can only change ``open``, so a
+    caller re-analyzes from ``boundary_ts`` onward, with a minute of context.
+    """
+    import numpy as np
+
+    total = len(ts) - context
+    if len(ts) < 2:
+        return None, empty_part(total), None
+    orig = np.arange(len(ts))
+    d, dt, speed = track_steps(ts, lat, lng)
+    glitch = speed > ANALYTICS_MAX_SPEED
+    # A fix that jumps away and straight back is a GPS spike: drop it
+    spike = np.concatenate(([False], glitch[:-1] & glitch[1:], [False]))
+    if spike.any():
+        keep = ~spike
+        ts, lat, lng, orig = ts[keep], lat[keep], lng[keep], orig[keep]
+        d, dt, speed = track_steps(ts, lat, lng)
+        glitch = speed > ANALYTICS_MAX_SPEED
+    n = len(ts)
+    lo = max(int(np.searchsorted(orig, context)) - 1, 0)
+    # Stillness is judged over at least a minute before and after each step, so jitter between
+    # dense fixes does not read as movement and a stop does not start before the device arrived
+    ahead = np.minimum(np.searchsorted(ts, ts[:-1] + ANALYTICS_STILL_WINDOW_MS), n - 1)
+    behind = np.maximum(np.searchsorted(ts, ts[1:] - ANALYTICS_STILL_WINDOW_MS, side="right") - 1, 0)
+    drift = np.maximum(
+        haversine_np(lat[:-1], lng[:-1], lat[ahead], lng[ahead]) / np.maximum((ts[ahead] - ts[:-1]) / 1000.0, 1.0),
+        haversine_np(lat[behind], lng[behind], lat[1:], lng[1:]) / np.maximum((ts[1:] - ts[behind]) / 1000.0, 1.0),
+    )
+    stationary = ~glitch & (d <= ANALYTICS_STOP_RADIUS) & (drift < ANALYTICS_STOP_SPEED)
+    gap = ~stationary & (dt > ANALYTICS_GAP_SECONDS)
+    moving = ~glitch & ~stationary & ~gap
+
+    # Runs of stationary steps [s, e) cover fixes s..e; they are stops when long and compact enough
+    s, e = true_runs(stationary)
+    clat = clng = np.zeros(0)
+    if len(s):
+        lengths = e - s + 1
+        offsets = np.cumsum(lengths) - lengths
+        fix = np.repeat(s - offsets, lengths) + np.arange(lengths.sum())
+        run = np.repeat(np.arange(len(s)), lengths)
+        clat = np.add.reduceat(lat[fix], offsets) / lengths
+        clng = np.add.reduceat(lng[fix], offsets) / lengths
+        spread = np.maximum.reduceat(haversine_np(lat[fix], lng[fix], clat[run], clng[run]), offsets)
+        is_stop = (ts[e] - ts[s] >= ANALYTICS_STOP_SECONDS * 1000) & (spread <= ANALYTICS_STOP_RADIUS)
+        s, e, clat, clng = s[is_stop], e[is_stop], clat[is_stop], clng[is_stop]
+    marks = np.zeros(n, dtype=np.int8)
+    marks[s] = 1
+    marks[e] -= 1
+    in_stop = np.cumsum(marks[:-1]) > 0
+
+    # Trips are the runs of steps [a, b) between stops and silences, from the first counted step
+    travel = ~in_stop & ~gap
+    travel[:lo] = False
+    a, b = true_runs(travel)
+    cum_d = np.concatenate(([0.0], np.cumsum(np.where(glitch | in_stop, 0.0, d))))
+    cum_md = np.concatenate(([0.0], np.cumsum(np.where(moving, d, 0.0))))
+    cum_mt = np.concatenate(([0.0], np.cumsum(np.where(moving, dt, 0.0))))
+    moving_speed = np.where(moving, speed, 0.0)
+    # Steps between trips are not moving, so each reduceat window only sees its own trip
+    trip_max = np.maximum.reduceat(moving_speed, a) if len(a) else np.zeros(0)
+    trip_d = cum_d[b] - cum_d[a]
+    trip_md = cum_md[b] - cum_md[a]
+    trip_mt = cum_mt[b] - cum_mt[a]
+
+    def part(lo, hi, fixes):
+        """Totals, stops and trips of steps ``lo..hi-1``."""
+        stops = (s >= lo) & (e <= hi)
+        trips = (a >= lo) & (b <= hi) & (trip_d >= ANALYTICS_TRIP_MIN_METERS)
+        ss, se = s[stops], e[stops]
+        ta, tb = a[trips], b[trips]
+        tmt = trip_mt[trips]
+        avg = np.divide(trip_md[trips], tmt, out=np.zeros(len(tmt)), where=tmt > 0)
+        return {
+            "fixes": fixes,
+            "distance_m": float(cum_d[hi] - cum_d[lo]),
+            "moving_m": float(cum_md[hi] - cum_md[lo]),
+            "moving_s": float(cum_mt[hi] - cum_mt[lo]),
+            "max_speed_ms": float(moving_speed[lo:hi].max()) if hi > lo else 0.0,
+            "stopped_s": float((ts[se] - ts[ss]).sum() / 1000.0),
+            "stops": [
+                {"start": int(t0), "end": int(t1), "duration_s": round((t1 - t0) / 1000.0, 1),
+                 "lat": round(y, 6), "lng": round(x, 6), "fixes": int(k)}
+                for t0, t1, y, x, k in zip(
+                    ts[ss].tolist(), ts[se].tolist(), clat[stops].tolist(), clng[stops].tolist(),
+                    (se - ss + 1).tolist(),
+                )
+            ],
+            "trips": [
+                {"start": int(t0), "end": int(t1), "duration_s": round((t1 - t0) / 1000.0, 1),
+                 "distance_m": round(dist, 1), "moving_s": round(mt, 1), "max_speed_ms": round(vmax, 2),
+                 "avg_speed_ms": round(vavg, 2), "from": {"lat": y0, "lng": x0}, "to": {"lat": y1, "lng": x1}}
+                for t0, t1, dist, mt, vmax, vavg, y0, x0, y1, x1 in zip(
+                    ts[ta].tolist(), ts[tb].tolist(), trip_d[trips].tolist(), tmt.tolist(),
+                    trip_max[trips].tolist(), avg.tolist(), lat[ta].tolist(), lng[ta].tolist(),
+                    lat[tb].tolist(), lng[tb].tolist(),
+                )
+            ],
+        }
+
+    confirmed = np.flatnonzero((s >= lo) & (e <= n - 4) & (ts[e] + ANALYTICS_STILL_WINDOW_MS <= ts[-1]))
+    if not len(confirmed):
+        return None, part(lo, n - 1, total), None
+    boundary = int(e[confirmed[-1]])
+    closed_fixes = int(orig[boundary]) + 1 - context
+    closed = part(lo, boundary, closed_fixes)
+    return closed, part(boundary, n - 1, total - closed_fixes), int(ts[boundary])
+
+
+def refresh_daily(conn, device_id, first_day, last_day):
+    """Analytics of ``device_id`` for days ``first_day..last_day`` (UTC days since the epoch).
+
+    Returns ``(days, rows, stale)``: ``{day: part}`` for the days that have
+    fixes, the ``analytics_daily`` rows to write and the ``(device_id, day)``
+    entries to delete (see ``save_daily``). A cached day whose fixes are
+    unchanged is reused as is. A day that only gained newer fixes is re-analyzed
+    from its last confirmed stop, so only the new fixes and the trip in progress
+    are read again. Anything else (late fixes, retention rewrites) recomputes the day.
+    """
+    cached = {
+        row["day"]: row for row in conn.execute(
+            "SELECT * FROM analytics_daily WHERE device_id = ? AND day >= ? AND day <= ?",
+            (device_id, first_day, last_day),
+        )
+    }
+    c = location_db(device_id).cursor()
+    # The day before the range tells whether a cached day's anchor fix is still the latest one
+    stats = {
+        day: (fixes, last_ts) for day, fixes, last_ts in c.execute(
+            """
+            SELECT ts / ?, COUNT(*), MAX(ts) FROM locations
+            WHERE device_id = ? AND ts >= ? AND ts < ?
+            GROUP BY ts / ?
+            """,
+            (DAY_MS, device_id, (first_day - 1) * DAY_MS, (last_day + 1) * DAY_MS, DAY_MS),
+        )
+    }
+    days, rows, stale = {}, [], []
+    for day in range(first_day, last_day + 1):
+        fixes, last_ts = stats.get(day, (0, None))
+        row = cached.get(day)
+        if not fixes:
+            if row is not None:
+                stale.append((device_id, day))
+            continue
+        previous = stats.get(day - 1)
+        anchor_moved = row is not None and previous is not None and previous[1] > (row["anchor_ts"] or -1)
+        if row is not None and not anchor_moved and (row["fixes"], row["last_ts"]) == (fixes, last_ts):
+            METRICS.inc("analytics_days_total", ("cached",))
+            days[day] = json.loads(row["result"])
+            continue
+        # Stop at last_ts so the stored counts describe exactly the rows analyzed
+        upper = last_ts + 1
+        appended = (
+            row is not None and not anchor_moved and row["boundary_ts"] is not None and last_ts > row["last_ts"]
+            and c.execute(
+                "SELECT COUNT(*) FROM locations WHERE device_id = ? AND ts >= ? AND ts <= ?",
+                (device_id, day * DAY_MS, row["last_ts"]),
+            ).fetchone()[0] == row["fixes"]
+        )
+        if appended:
+            METRICS.inc("analytics_days_total", ("incremental",))
+            # The minute before the boundary is context for judging stillness, as in a full pass
+            lower = max(row["boundary_ts"] - ANALYTICS_STILL_WINDOW_MS, day * DAY_MS)
+            ts, lat, lng, _ = load_track(c, device_id, lower, upper, anchor=True)
+            closed, tail, boundary_ts = analyze_track(ts, lat, lng, int((ts <= row["boundary_ts"]).sum()))
+            closed = merge_parts(json.loads(row["closed"]), closed)
+            boundary_ts = boundary_ts or row["boundary_ts"]
+            anchor_ts = row["anchor_ts"]
+        else:
+            METRICS.inc("analytics_days_total", ("full",))
+            ts, lat, lng, anchored = load_track(c, device_id, day * DAY_MS, upper, anchor=True)
+            closed, tail, boundary_ts = analyze_track(ts, lat, lng, int(anchored))
+            anchor_ts = int(ts[0]) if anchored else None
+        result = merge_parts(closed, tail)
+        days[day] = result
+        rows.append((
+            device_id, day, fixes, last_ts, anchor_ts, boundary_ts,
+            json.dumps(closed) if closed is not None else None, json.dumps(result), now_ms(),
+        ))
+    return days, rows, stale
+
+
+def save_daily(conn, rows, stale):
+    c = conn.cursor()
+    c.executemany(
+        """
+        INSERT OR REPLACE INTO analytics_daily
+            (device_id, day, fixes, last_ts, anchor_ts, boundary_ts, closed, result, computed_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        rows,
+    )
+    c.executemany("DELETE FROM analytics_daily WHERE device_id = ? AND day = ?", stale)
+    conn.commit()
+
+
+def day_text(day):
+    return datetime.fromtimestamp(day * 86400, timezone.utc).strftime("%Y-%m-%d")
+
+
+def parse_day(text):
+    """UTC day number of ``YYYY-MM-DD``; raises ValueError."""
+    return int(datetime.strptime(text, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()) // 86400
+
+
+def day_summary(day, part, detail=False):
+    """Public JSON of one day's analysis; stop and trip lists only with ``detail``."""
+    summary = {
+        "day": day_text(day),
+        "fixes": part["fixes"],
+        "distance_m": round(part["distance_m"], 1),
+        "moving_s": round(part["moving_s"], 1),
+        "stopped_s": round(part["stopped_s"], 1),
+        "max_speed_ms": round(part["max_speed_ms"], 2),
+        "avg_speed_ms": round(part["moving_m"] / part["moving_s"], 2) if part["moving_s"] else 0.0,
+        "stop_count": len(part["stops"]),
+        "trip_count": len(part["trips"]),
+    }
+    if detail:
+        summary["stops"] = part["stops"]
+        summary["trips"] = part["trips"]
+    return summary
+
+
+def analytics_payload(device_id, first_day, last_day, detail=False):
+    """Build the analytics response body, or None when the device does not exist."""
+    conn = db_connect()
+    try:
+        if not conn.execute("SELECT 1 FROM devices WHERE id = ?", (device_id,)).fetchone():
+            return None
+        days, rows, stale = refresh_daily(conn, device_id, first_day, last_day)
+        if rows or stale:
+            save_daily(conn, rows, stale)
+    finally:
+        conn.close()
+    summaries = [day_summary(day, days[day], detail) for day in sorted(days)]
+    totals = merge_parts(*(days[day] for day in sorted(days)))
+    return {
+        "ok": True,
+        "device_id": device_id,
+        "from": day_text(first_day),
+        "to": day_text(last_day),
+        "days": summaries,
+        "totals": {k: v for k, v in day_summary(first_day, totals).items() if k != "day"},
+    }
+
+
+@app.route("/api/devices/<int:device_id>/analytics")
+def device_analytics(device_id):
+    """Daily distance, moving time, speeds and stop/trip counts over ``since``..``until`` (UTC days).
+
+    ``since``/``until`` take the same formats as the history API and default to
+    the last seven days; ``detail=1`` adds the stop and trip lists.
+    """
+    gate = require_login()
+    if gate:
+        return gate
+    args = request.args
+    until = ts_to_ms(args.get("until"))
+    since = ts_to_ms(args.get("since"))
+    if (args.get("until") and until is None) or (args.get("since") and since is None):
+        return jsonify({"ok": False, "error": "invalid parameters"}), 400
+    last_day = (until if until is not None else now_ms()) // DAY_MS
+    first_day = since // DAY_MS if since is not None else last_day - 6
+    if first_day > last_day or last_day - first_day >= ANALYTICS_MAX_DAYS:
+        return jsonify({"ok": False, "error": f"the range must cover 1 to {ANALYTICS_MAX_DAYS} days"}), 400
+    detail = args.get("detail") == "1"
+    view = response_cache.fetch("analytics", device_id, f"{first_day}:{last_day}:{int(detail)}", lambda: (
+        analytics_payload(device_id, first_day, last_day, detail)
+    ))
+    if view is None:
+        return jsonify({"ok": False, "error": "device not found"}), 404
+    return view_response(view)
+
+
+@app.route("/api/devices/<int:device_id>/analytics/<day>")
+def device_analytics_day(device_id, day):
+    """One day (``YYYY-MM-DD``, UTC) with its stops and trips."""
+    gate = require_login()
+    if gate:
+        return gate
+    try:
+        number = parse_day(day)
+    except ValueError:
+        return jsonify({"ok": False, "error": "day must be YYYY-MM-DD"}), 400
+    view = response_cache.fetch("analytics", device_id, f"{number}:{number}:1", lambda: (
+        analytics_payload(device_id, number, number, detail=True)
+    ))
+    if view is None:
+        return jsonify({"ok": False, "error": "device not found"}), 404
+    return view_response(view)
+
+
+@app.route("/api/analytics/fleet")
+def fleet_analytics():
+    """Stored daily analytics of every device for ``day`` (default today), by device id.
+
+    Reads what ``flask analytics`` and the per-device endpoints have computed;
+    paginated with ``cursor``/``limit`` like ``/api/devices``.
+    """
+    gate = require_login()
+    if gate:
+        return gate
+    try:
+        day = parse_day(request.args["day"]) if request.args.get("day") else now_ms() // DAY_MS
+        limit = int(request.args.get("limit", FLEET_PAGE_SIZE))
+        cursor = int(request.args.get("cursor") or 0)
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid parameters"}), 400
+    if not 0 < limit <= FLEET_PAGE_MAX:
+        return jsonify({"ok": False, "error": "invalid parameters"}), 400
+    conn = db_connect()
+    try:
+        rows = conn.execute(
+            "SELECT device_id, result FROM analytics_daily WHERE day = ? AND device_id > ? ORDER BY device_id LIMIT ?",
+            (day, cursor, limit + 1),
+        ).fetchall()
+    finally:
+        conn.close()
+    next_cursor = str(rows[limit - 1]["device_id"]) if len(rows) > limit else None
+    devices = [
+        dict(device_id=row["device_id"], **day_summary(day, json.loads(row["result"])))
+        for row in rows[:limit]
+    ]
+    return jsonify({"ok": True, "day": day_text(day), "devices": devices, "next_cursor": next_cursor})
+
+
+def analytics_chunk(device_ids, first_day, last_day):
+    """``flask analytics`` task, run in a worker process: ``(rows, stale, days_reused)`` for some devices."""
+    conn = db_connect()
+    rows, stale, reused = [], [], 0
+    try:
+        for device_id in device_ids:
+            days, device_rows, device_stale = refresh_daily(conn, device_id, first_day, last_day)
+            rows += device_rows
+            stale += device_stale
+            reused += len(days) - len(device_rows)
+    finally:
+        conn.close()
+    return rows, stale, reused
+
+
+DURATION_UNITS = {"s": 1000, "m": 60000, "h": 3600000, "d": 86400000, "w": 7 * 86400000, "y": 365 * 86400000}
+
+
+def parse_duration(text):
+    """Parse ``"30s"``, ``"1m"``, ``"12h"``, ``"30d"``, ``"2w"`` or ``"1y"`` to milliseconds."""
+    text = (text or "").strip().lower()
+    unit = DURATION_UNITS.get(text[-1:])
+    if unit is None or not text[:-1].isdigit() or int(text[:-1]) <= 0:
+        raise ValueError(f"invalid duration {text!r}")
+    return int(text[:-1]) * unit
 
 
-@app.route("/users/create", methods=["GET", "POST"])
-def create_user():
-    gate = require_role("admin")
-    if gate:
-        return gate
-    if request.method == "POST":
-        username = request.form.get("username", "").strip()
-        password = request.form.get("password", "")
-        role = request.form.get("role", "viewer")
-        phone = request.form.get("phone", "").strip() or None
-        conn = db_connect()
+def parse_retention_policy(text):
+    """Parse ``"raw:30d,1m:365d"`` into ``[(res_ms, age_ms), ...]``.
+
+    Each tier keeps rows younger than ``age`` at resolution ``res`` (0 = raw);
+    rows older than the last tier's age are dropped unless it is ``inf``.
+    An empty policy returns an empty list (keep everything).
+    """
+    tiers = []
+    for part in (text or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        res, sep, age = part.partition(":")
+        if not sep:
+            raise ValueError(f"invalid retention tier {part!r}")
+        res_ms = 0 if res.strip().lower() == "raw" else parse_duration(res)
+        age_ms = None if age.strip().lower() == "inf" else parse_duration(age)
+        tiers.append((res_ms, age_ms))
+    if not tiers:
+        return []
+    if tiers[0][0] != 0:
+        raise ValueError("the first retention tier must be raw")
+    for (res_a, age_a), (res_b, age_b) in zip(tiers, tiers[1:]):
+        if age_a is None:
+            raise ValueError("only the last retention tier may be inf")
+        if res_b <= res_a or (age_b is not None and age_b <= age_a):
+            raise ValueError("retention tiers must get coarser and older")
+    return tiers
+
+
+def archive_rows(rows):
+    """Append ``(device_id, ts, lat, lng)`` rows to per-month gzip CSV files."""
+    by_month = {}
+    for row in rows:
+        month = datetime.fromtimestamp(row[1] / 1000.0, timezone.utc).strftime("%Y-%m")
+        by_month.setdefault(month, []).append(row)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    for month, month_rows in by_month.items():
+        # Each append is its own gzip member; readers see one concatenated stream
+        with gzip.open(os.path.join(ARCHIVE_DIR, f"locations-{month}.csv.gz"), "at", encoding="utf-8") as f:
+            f.writelines(f"{d},{ts},{lat!r},{lng!r}\n" for d, ts, lat, lng in month_rows)
+
+
+def read_archive(device_id, since=0, until=2 ** 62, limit=None):
+    """Return archived ``(lat, lng, ts)`` points of one device in ``[since, until]``, oldest first.
+
+    Only the month files overlapping the range are read, oldest first, stopping
+    once ``limit`` points have been collected.
+    """
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    first = datetime.fromtimestamp(max(since, 0) / 1000.0, timezone.utc).strftime("%Y-%m")
+    last = datetime.fromtimestamp(min(until, 253402300799000) / 1000.0, timezone.utc).strftime("%Y-%m")
+    prefix = f"{device_id},"
+    points = {}
+    for name in sorted(os.listdir(ARCHIVE_DIR)):
+        if not (name.startswith("locations-") and name.endswith(".csv.gz")):
+            continue
+        month = name[len("locations-"):-len(".csv.gz")]
+        if month < first or month > last:
+            continue
+        if limit is not None and len(points) >= limit:
+            break
+        with gzip.open(os.path.join(ARCHIVE_DIR, name), "rt", encoding="utf-8") as f:
+            for line in f:
+                if not line.startswith(prefix):
+                    continue
+                _, ts, lat, lng = line.rstrip("\n").split(",")
+                ts = int(ts)
+                if since <= ts <= until:
+                    # A batch archived just before a failed delete may appear twice
+                    points[ts] = (float(lat), float(lng), ts)
+    return [points[ts] for ts in sorted(points)][:limit]
+
+
+def _compact_tier(conn, device_id, res_ms, cutoff, summary):
+    """Average rows before ``cutoff`` into ``res_ms`` buckets, one short transaction per chunk."""
+    c = conn.cursor()
+    cutoff -= cutoff % res_ms
+    row = c.execute(
+        "SELECT done_until FROM retention_state WHERE device_id = ? AND res_ms = ?", (device_id, res_ms)
+    ).fetchone()
+    start = row[0] if row else 0
+    chunk = max(res_ms, RETENTION_CHUNK_MS - RETENTION_CHUNK_MS % res_ms)
+    while start < cutoff:
+        # Skip straight over gaps in the device's history
+        first = c.execute(
+            "SELECT MIN(ts) FROM locations WHERE device_id = ? AND ts >= ? AND ts < ?", (device_id, start, cutoff)
+        ).fetchone()[0]
+        if first is None:
+            start = cutoff
+        else:
+            start = first - first % res_ms
+        end = min(start + chunk, cutoff)
+        # IMMEDIATE keeps the read-then-rewrite atomic; ingest waits at most one chunk
+        c.execute("BEGIN IMMEDIATE")
         try:
-            c = conn.cursor()
-            c.execute("SELECT 1 FROM users WHERE username = ?", (username,))
-            if c.fetchone():
-                flash("User already exists.", "error")
-                return render_template("user_create.html")
+            buckets = c.execute(
+                """
+                SELECT ts / ? AS b, AVG(lat), AVG(lng), COUNT(*)
+                FROM locations
+                WHERE device_id = ? AND ts >= ? AND ts < ?
+                GROUP BY b
+                HAVING COUNT(*) > 1
+                """,
+                (res_ms, device_id, start, end),
+            ).fetchall()
+            if buckets:
+                c.executemany(
+                    "DELETE FROM locations WHERE device_id = ? AND ts >= ? AND ts < ?",
+                    [(device_id, b * res_ms, (b + 1) * res_ms) for b, _, _, _ in buckets],
+                )
+                c.executemany(
+                    "INSERT INTO locations (device_id, lat, lng, ts) VALUES (?, ?, ?, ?)",
+                    [(device_id, lat, lng, b * res_ms) for b, lat, lng, _ in buckets],
+                )
+                summary["rows_compacted"] += sum(n for _, _, _, n in buckets)
+                summary["rows_written"] += len(buckets)
             c.execute(
-                "INSERT INTO users (username, password_hash, role, phone, created_at) VALUES (?, ?, ?, ?, ?)",
-                (username, generate_password_hash(password), role, phone, datetime.utcnow().isoformat()),
+                "INSERT OR REPLACE INTO retention_state (device_id, res_ms, done_until) VALUES (?, ?, ?)",
+                (device_id, res_ms, end),
             )
-            conn.commit()
-        finally:
-            conn.close()
-        flash("User created.", "success")
-        return redirect(url_for("index"))
-    return render_template("user_create.html")
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        start = end
 
 
-@app.route("/onboard/sms", methods=["GET", "POST"])
-def onboard_sms():
-    gate = require_login()
-    if gate:
-        return gate
-    if request.method == "POST":
-        phone = request.form.get("phone", "").strip()
-        normalized = normalize_phone(phone)
-        if not normalized:
-            flash("Enter a valid phone number including country code.", "error")
-            # Fallback agent URL
-            fallback_url = (AGENT_DOWNLOAD_URL or (request.url_root.rstrip('/') + url_for('agent_download')))
-            return render_template("onboard.html", agent_url=fallback_url)
-        if not (VONAGE_API_KEY and VONAGE_API_SECRET and VONAGE_FROM_NUMBER):
-            flash("Vonage is not configured. Set environment variables.", "error")
-            fallback_url = (AGENT_DOWNLOAD_URL or (request.url_root.rstrip('/') + url_for('agent_download')))
-            return render_template("onboard.html", agent_url=fallback_url)
-        try:
-            agent_link = (AGENT_DOWNLOAD_URL or (request.url_root.rstrip('/') + url_for('agent_download')))
-            body = f"Install the tracking companion app: {agent_link}"
-            payload = {
-                "api_key": VONAGE_API_KEY,
-                "api_secret": VONAGE_API_SECRET,
-                "from": (VONAGE_FROM_NUMBER or "").replace(" ", ""),
-                "to": normalized,
-                "text": body,
-            }
-            r = requests.post("https://rest.nexmo.com/sms/json", data=payload, timeout=10)
-            r.raise_for_status()
-            resp = r.json()
-            messages = resp.get("messages", [])
-            if not messages or messages[0].get("status") != "0":
-                raise Exception(f"Vonage send failed: {messages[0].get('error-text') if messages else 'unknown'}")
-            flash("Onboarding SMS sent.", "success")
-        except Exception as e:
-            flash(f"Failed to send SMS: {e}", "error")
-        return redirect(url_for("onboard_sms"))
-    fallback_url = (AGENT_DOWNLOAD_URL or (request.url_root.rstrip('/') + url_for('agent_download')))
-    return render_template("onboard.html", agent_url=fallback_url)
+def _expire_rows(conn, device_id, cutoff, archive, summary):
+    """Delete (and optionally archive) rows older than ``cutoff`` in bounded batches."""
+    c = conn.cursor()
+    while True:
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            rows = c.execute(
+                "SELECT device_id, ts, lat, lng FROM locations WHERE device_id = ? AND ts < ? ORDER BY ts LIMIT ?",
+                (device_id, cutoff, RETENTION_BATCH_ROWS),
+            ).fetchall()
+            if not rows:
+                c.execute("COMMIT")
+                return
+            if archive:
+                archive_rows(rows)
+                summary["rows_archived"] += len(rows)
+            c.execute(
+                "DELETE FROM locations WHERE device_id = ? AND ts <= ?", (device_id, rows[-1][1])
+            )
+            summary["rows_dropped"] += len(rows)
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
 
 
-@app.route("/agent/download")
-def agent_download():
-    # Zip the Android agent example directory and return as attachment
-    base_dir = os.path.join(os.path.dirname(__file__), "agent_examples", "android")
-    mem_zip = io.BytesIO()
-    with zipfile.ZipFile(mem_zip, mode='w', compression=zipfile.ZIP_DEFLATED) as zf:
-        for root, dirs, files in os.walk(base_dir):
-            for fname in files:
-                full_path = os.path.join(root, fname)
-                arcname = os.path.relpath(full_path, base_dir)
-                zf.write(full_path, arcname)
-    mem_zip.seek(0)
-    return send_file(mem_zip, as_attachment=True, download_name="android_agent_example.zip")
+def incremental_vacuum(conn, pages=RETENTION_VACUUM_PAGES):
+    """Return free pages to the filesystem a slice at a time; a no-op unless auto_vacuum=INCREMENTAL."""
+    c = conn.cursor()
+    if c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    start = free = c.execute("PRAGMA freelist_count").fetchone()[0]
+    while free:
+        # Each call is its own short write transaction, so ingest can interleave
+        c.execute(f"PRAGMA incremental_vacuum({pages})").fetchall()
+        remaining = c.execute("PRAGMA freelist_count").fetchone()[0]
+        if remaining >= free:
+            break
+        free = remaining
+    return start - free
 
 
-@app.route("/export")
-def export():
-    gate = require_login()
+# Columns copied per shard table by rebalance_locations()
+SHARD_COLUMNS = {
+    "locations": ("device_id", "ts", "lat", "lng"),
+    "ingest_keys": ("device_id", "key", "ts"),
+    "retention_state": ("device_id", "res_ms", "done_until"),
+}
+
+
+def rebalance_locations(target, batch_rows=50000, progress=None):
+    """Move per-device history to ``target`` shard files (0 = back into app.db) and return a summary.
+
+    Every table is copied with ``INSERT OR IGNORE`` before the recorded layout
+    switches, and only then is the old copy removed; an interrupted run leaves
+    the old layout in use and can simply be run again. Stop the app first:
+    fixes written while copying would be left behind in the old files.
+    """
+    global _location_shards
+    ensure_db()
+    source = _location_shards
+    summary = {"from": source, "to": target, "rows": {table: 0 for table in SHARD_COLUMNS}}
+    if target == source:
+        return summary
+    catalog = _open_connection()
+    sources = [catalog] if source == 0 else [open_shard(shard_path(i, source)) for i in range(source)]
+    targets = [catalog] if target == 0 else [open_shard(shard_path(i, target)) for i in range(target)]
+    try:
+        for src in sources:
+            for table, columns in SHARD_COLUMNS.items():
+                insert = (
+                    f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) "
+                    f"VALUES ({', '.join('?' * len(columns))})"
+                )
+                read = src.execute(f"SELECT {', '.join(columns)} FROM {table}")
+                while True:
+                    rows = read.fetchmany(batch_rows)
+                    if not rows:
+                        break
+                    groups = {}
+                    for row in rows:
+                        groups.setdefault(row[0] % target if target else 0, []).append(tuple(row))
+                    for index, group in groups.items():
+                        targets[index].executemany(insert, group)
+                    for conn in targets:
+                        conn.commit()
+                    summary["rows"][table] += len(rows)
+                    if progress:
+                        progress(summary)
+        catalog.execute("UPDATE storage_layout SET location_shards = ?", (target,))
+        catalog.commit()
+        _location_shards = target
+        if source == 0:
+            for table in SHARD_COLUMNS:
+                catalog.execute(f"DELETE FROM {table}")
+            catalog.commit()
+            catalog.isolation_level = None
+            summary["pages_freed"] = incremental_vacuum(catalog)
+    finally:
+        for conn in set(sources + targets):
+            conn.dispose()
+    if source:
+        for i in range(source):
+            for suffix in ("", "-wal", "-shm"):
+                path = shard_path(i, source) + suffix
+                if os.path.exists(path):
+                    os.remove(path)
+    return summary
+
+
+def run_retention(conn, now=None, archive=None):
+    """Apply the global and per-device retention policies once and return a summary.
+
+    Work is split into short per-device, per-chunk transactions so concurrent
+    ingest is only ever delayed by one chunk. Tiers are compacted oldest-last,
+    so a coarser tier re-averages what the previous tier already produced.
+    """
+    now = now_ms() if now is None else now
+    archive = RETENTION_ARCHIVE if archive is None else archive
+    summary = {"devices": 0, "rows_compacted": 0, "rows_written": 0, "rows_dropped": 0, "rows_archived": 0}
+    default = parse_retention_policy(RETENTION_POLICY)
+    conn.isolation_level = None
+    c = conn.cursor()
+    overrides = {}
+    for device_id, text in c.execute("SELECT device_id, policy FROM retention_policies").fetchall():
+        try:
+            overrides[device_id] = parse_retention_policy(text)
+        except ValueError as e:
+            print(f"ERROR in retention policy of device {device_id}:", e)
+    # History (and its watermarks) may live in shard files; each is driven the same way
+    stores = [conn] + [shard_connect(i) for i in range(_location_shards)]
+    for store in stores:
+        store.isolation_level = None
+    try:
+        for (device_id,) in c.execute("SELECT id FROM devices ORDER BY id").fetchall():
+            tiers = overrides.get(device_id, default)
+            if not tiers:
+                continue
+            summary["devices"] += 1
+            store = stores[1 + shard_of(device_id)] if _location_shards else conn
+            before = summary["rows_compacted"] + summary["rows_dropped"]
+            for (_, younger), (res_ms, _) in zip(tiers, tiers[1:]):
+                _compact_tier(store, device_id, res_ms, now - younger, summary)
+            if tiers[-1][1] is not None:
+                _expire_rows(store, device_id, now - tiers[-1][1], archive, summary)
+            if summary["rows_compacted"] + summary["rows_dropped"] != before:
+                response_cache.invalidate([device_id])
+        summary["pages_freed"] = sum(incremental_vacuum(store) for store in stores)
+    finally:
+        for store in stores:
+            store.isolation_level = ""
+    return summary
+
+
+@contextmanager
+def retention_lock():
+    """Non-blocking ``flock`` on ``retention.lock`` next to the database; yields False if another pass holds it."""
+    import fcntl
+
+    with open(os.path.join(DB_DIR, "retention.lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+
+
+class RetentionJob:
+    """Runs ``run_retention`` every ``interval`` seconds in a background thread.
+
+    Every gunicorn worker starts one, but a non-blocking ``flock`` on a lock file
+    next to the database lets only one of them work on a given pass.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.runs = 0
+        self.errors = 0
+        self.last_summary = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            if self._pid is None:
+                atexit.register(self._stop.set)
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def run_once(self):
+        with retention_lock() as locked:
+            if not locked:
+                return None
+            # The job uses its own connection so it never shares a transaction with a request
+            conn = _open_connection()
+            try:
+                self.last_summary = run_retention(conn)
+                self.runs += 1
+            except Exception as e:
+                self.errors += 1
+                print("ERROR in retention job:", e)
+            finally:
+                conn.dispose()
+        return self.last_summary
+
+
+retention_job = RetentionJob(RETENTION_INTERVAL) if RETENTION_INTERVAL > 0 else None
+
+
+@app.before_request
+def start_background_jobs():
+    if retention_job is not None:
+        retention_job.start()
+
+
+@app.route("/api/devices/<int:device_id>/retention", methods=["GET", "PUT"])
+def device_retention(device_id):
+    """Read or set a device's retention policy; ``{"policy": null}`` falls back to the global one."""
+    gate = require_role("admin") if request.method == "PUT" else require_login()
     if gate:
         return gate
     conn = db_connect()
     try:
         c = conn.cursor()
-        c.execute("SELECT * FROM devices")
-        devices = [dict(r) for r in c.fetchall()]
-        for d in devices:
-            c.execute("SELECT lat, lng, ts FROM locations WHERE device_id = ? ORDER BY ts ASC", (d["id"],))
-            d["locations"] = [dict(r) for r in c.fetchall()]
-            d["last_location"] = {"lat": d["last_lat"], "lng": d["last_lng"]} if d.get(
-                "last_lat") is not None and d.get("last_lng") is not None else None
-        export_data = {"devices": devices}
-        return jsonify(export_data)
+        c.execute("SELECT 1 FROM devices WHERE id = ?", (device_id,))
+        if not c.fetchone():
+            return jsonify({"ok": False, "error": "device not found"}), 404
+        if request.method == "PUT":
+            payload = request.get_json(silent=True) or {}
+            policy = (payload.get("policy") or "").strip()
+            if policy:
+                try:
+                    parse_retention_policy(policy)
+                except ValueError as e:
+                    return jsonify({"ok": False, "error": str(e)}), 400
+                c.execute(
+                    "INSERT OR REPLACE INTO retention_policies (device_id, policy) VALUES (?, ?)", (device_id, policy)
+                )
+            else:
+                c.execute("DELETE FROM retention_policies WHERE device_id = ?", (device_id,))
+            conn.commit()
+        c.execute("SELECT policy FROM retention_policies WHERE device_id = ?", (device_id,))
+        row = c.fetchone()
     finally:
         conn.close()
+    return jsonify({
+        "ok": True,
+        "device_id": device_id,
+        "policy": row["policy"] if row else RETENTION_POLICY,
+        "override": row is not None,
+    })
+
+
+def iter_json_devices(text, chunk_size=65536):
+    """Yield the elements of the top-level ``"devices"`` array of an export document.
+
+    The document is read ``chunk_size`` characters at a time and only one device
+    object is materialized at once; other top-level keys are parsed and dropped.
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buf, pos, eof
+        data = text.read(max(chunk_size, len(buf) - pos))
+        if not data:
+            eof = True
+        buf = buf[pos:] + data
+        pos = 0
+
+    def peek():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf[pos] if pos < len(buf) else ""
+            fill()
+
+    def expect(ch):
+        nonlocal pos
+        if peek() != ch:
+            raise ValueError(f"expected '{ch}' at offset {pos}")
+        pos += 1
+
+    def value():
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+                # A number at the very end of the buffer may continue in the next chunk
+                if end < len(buf) or eof:
+                    pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            fill()
+
+    expect("{")
+    if peek() == "}":
+        return
+    while True:
+        key = value()
+        expect(":")
+        if key == "devices":
+            expect("[")
+            if peek() == "]":
+                pos += 1
+            else:
+                while True:
+                    yield value()
+                    if peek() == ",":
+                        pos += 1
+                        continue
+                    expect("]")
+                    break
+        else:
+            value()
+        if peek() == ",":
+            pos += 1
+            continue
+        expect("}")
+        return
+
+
+def iter_import_records(file):
+    """Yield device records from an uploaded export (JSON or NDJSON, optionally gzipped).
+
+    NDJSON lines are yielded undecoded so a bad line is reported as a per-record
+    error instead of aborting the import.
+    """
+    stream = file.stream
+    filename = (file.filename or "").lower()
+    if stream.read(2) == b"\x1f\x8b":
+        stream.seek(0)
+        stream = gzip.GzipFile(fileobj=stream, mode="rb")
+        filename = filename[:-3] if filename.endswith(".gz") else filename
+    else:
+        stream.seek(0)
+    text = io.TextIOWrapper(stream, encoding="utf-8")
+    if filename.endswith((".ndjson", ".jsonl")):
+        return (line for line in text if line.strip())
+    return iter_json_devices(text)
+
+
+def import_devices(conn, records, chunk_rows=IMPORT_CHUNK_ROWS, progress=None):
+    """Merge exported device records into the database and return a summary.
+
+    Phone numbers are normalized to E.164 and missing carrier/region filled in.
+    Devices whose IMEI or phone already exists (or appeared earlier in the
+    upload) are skipped. New devices get fresh ids and their history is
+    remapped onto them. Records are decoded and validated without holding a
+    lock; every ``chunk_rows`` rows the write lock is taken just long enough to
+    assign ids and ``executemany`` the chunk. ``progress(summary)`` is called
+    after each commit.
+    """
+    summary = {
+        "records": 0,
+        "devices_added": 0,
+        "devices_skipped": 0,
+        "locations_added": 0,
+        "error_count": 0,
+        "errors": [],
+    }
+    c = conn.cursor()
+    known_imeis = set()
+    known_phones = set()
+    c.execute("SELECT imei, phone FROM devices")
+    for imei, phone in c:
+        if imei:
+            known_imeis.add(imei)
+        if phone:
+            known_phones.add(phone)
+
+    # Validated devices waiting for ids: (device columns after id, [(lat, lng, ts_ms), ...])
+    pending = []
+    pending_rows = 0
+
+    def error(index, message):
+        summary["error_count"] += 1
+        if len(summary["errors"]) < IMPORT_MAX_ERRORS:
+            summary["errors"].append({"record": index, "error": message})
+
+    def flush():
+        nonlocal pending_rows
+        if not pending:
+            return
+        # Ids are handed out under the write lock, so they stay free until the commit
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT COALESCE(MAX(id), 0) FROM devices")
+        first_id = c.fetchone()[0] + 1
+        device_rows = [(first_id + i,) + row for i, (row, _) in enumerate(pending)]
+        loc_rows = [(first_id + i,) + loc for i, (_, locs) in enumerate(pending) for loc in locs]
+        c.executemany(
+            "INSERT INTO devices (id, owner, imei, phone, carrier, region, api_token, last_update, last_lat, last_lng) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            device_rows,
+        )
+        c.execute(
+            """
+            INSERT OR REPLACE INTO device_positions (id, min_lat, max_lat, min_lng, max_lng)
+            SELECT id, last_lat, last_lat, last_lng, last_lng FROM devices
+            WHERE id BETWEEN ? AND ? AND last_lat IS NOT NULL AND last_lng IS NOT NULL
+            """,
+            (device_rows[0][0], device_rows[-1][0]),
+        )
+        # Count only rows that went in; a record may repeat a timestamp
+        if loc_rows and not _location_shards:
+            loc_rows = insert_locations(c, loc_rows)
+            count_fixes_hourly(c, loc_rows)
+        conn.commit()
+        # Shard rows only go in once the devices they belong to are committed
+        if loc_rows and _location_shards:
+            loc_rows = insert_locations(c, loc_rows)
+            count_fixes_hourly(c, loc_rows)
+            conn.commit()
+        for row in device_rows:
+            invalidate_device_auth(row[2], row[3])
+        response_cache.invalidate({row[0] for row in device_rows} | {row[0] for row in loc_rows})
+        summary["devices_added"] += len(device_rows)
+        summary["locations_added"] += len(loc_rows)
+        pending.clear()
+        pending_rows = 0
+        if progress:
+            progress(summary)
+
+    def read_batch(size=1000):
+        """Decode up to ``size`` records, reporting undecodable ones as errors."""
+        batch = []
+        while len(batch) < size:
+            index = summary["records"]
+            try:
+                d = next(records)
+            except StopIteration:
+                break
+            except ValueError as e:
+                # A broken JSON document cannot be resumed; keep what was read before it
+                error(index, f"invalid JSON: {e}")
+                break
+            summary["records"] += 1
+            if isinstance(d, str):
+                try:
+                    d = json.loads(d)
+                except ValueError as e:
+                    error(index, f"invalid JSON: {e}")
+                    continue
+            batch.append((index, d))
+        return batch
+
+    records = iter(records)
+    try:
+        while True:
+            batch = read_batch()
+            if not batch:
+                break
+            # Normalize and describe the batch's phone numbers in one pass
+            phones = enrich_phones(d.get("phone") for _, d in batch if isinstance(d, dict))
+            for index, d in batch:
+                if not isinstance(d, dict):
+                    error(index, "record is not an object")
+                    continue
+                imei = d.get("imei") or None
+                phone = d.get("phone") or None
+                # phone_info is memoized, so an unhashable value would raise rather than fail validation
+                if imei is not None and not isinstance(imei, str):
+                    error(index, "imei is not a string")
+                    continue
+                if phone is not None and not isinstance(phone, str):
+                    error(index, "phone is not a string")
+                    continue
+                info = phones.get(phone) if phone else None
+                if info:
+                    phone = info.e164
+                if not imei and not phone:
+                    error(index, "record has neither imei nor phone")
+                    continue
+                last = d.get("last_location") or {}
+                if not isinstance(last, dict):
+                    error(index, "last_location is not an object")
+                    continue
+                locations = d.get("locations") or []
+                if not isinstance(locations, list):
+                    error(index, "locations is not a list")
+                    continue
+                if (imei and imei in known_imeis) or (phone and phone in known_phones):
+                    summary["devices_skipped"] += 1
+                    continue
+                if imei:
+                    known_imeis.add(imei)
+                if phone:
+                    known_phones.add(phone)
+
+                # Stored as TS_FORMAT like ingest writes it; the fleet summary buckets by its first 13 characters
+                last_update = ts_to_ms(d.get("last_update"))
+                if not fix_ts_valid(last_update):
+                    if d.get("last_update") not in (None, ""):
+                        error(index, "last_update is invalid")
+                    last_update = None
+                # The last position feeds the map, the spatial index and fleet views; same checks as a fix
+                last_coords = None
+                if last.get("lat") is not None or last.get("lng") is not None:
+                    last_coords = parse_coords(last.get("lat"), last.get("lng"))
+                    if last_coords is None:
+                        error(index, "last_location is invalid")
+                locs = []
+                for li, loc in enumerate(locations):
+                    coords = parse_coords(loc.get("lat"), loc.get("lng")) if isinstance(loc, dict) else None
+                    ts = ts_to_ms(loc.get("ts")) if coords else None
+                    if not fix_ts_valid(ts):
+                        error(index, f"location {li} is invalid")
+                        continue
+                    locs.append((coords[0], coords[1], ts))
+                pending.append(((
+                    d.get("owner"),
+                    imei,
+                    phone,
+                    d.get("carrier") if d.get("carrier") is not None else (info.carrier if info else None),
+                    d.get("region") if d.get("region") is not None else (info.region if info else None),
+                    d.get("api_token") or secrets.token_urlsafe(24),
+                    ms_to_ts_text(last_update) if last_update is not None else None,
+                    last_coords[0] if last_coords else None,
+                    last_coords[1] if last_coords else None,
+                ), locs))
+                pending_rows += 1 + len(locs)
+
+                if pending_rows >= chunk_rows:
+                    flush()
+        flush()
+    except Exception:
+        conn.rollback()
+        raise
+    return summary
 
 
 @app.route("/import", methods=["GET", "POST"])
@@ -633,60 +5490,624 @@ def import_data():
     gate = require_role("admin")
     if gate:
         return gate
+    wants_json = request.accept_mimetypes.best == "application/json"
     if request.method == "POST":
         file = request.files.get("file")
         if not file:
             flash("Select a JSON file.", "error")
             return render_template("import.html")
-        try:
-            incoming = json.load(file)
-        except Exception:
-            flash("Invalid JSON.", "error")
-            return render_template("import.html")
+
         conn = db_connect()
         try:
-            c = conn.cursor()
-            inc_devices = incoming.get("devices", [])
-            for d in inc_devices:
-                imei = d.get("imei")
-                phone = d.get("phone")
-                if imei:
-                    c.execute("SELECT 1 FROM devices WHERE imei = ?", (imei,))
-                    if c.fetchone():
-                        continue
-                if phone:
-                    c.execute("SELECT 1 FROM devices WHERE phone = ?", (phone,))
-                    if c.fetchone():
-                        continue
-                c.execute(
-                    "INSERT INTO devices (owner, imei, phone, carrier, region, api_token, last_update, last_lat, last_lng) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                    (
-                        d.get("owner"),
-                        imei,
-                        phone,
-                        d.get("carrier"),
-                        d.get("region"),
-                        d.get("api_token") or secrets.token_urlsafe(24),
-                        d.get("last_update"),
-                        (d.get("last_location") or {}).get("lat"),
-                        (d.get("last_location") or {}).get("lng"),
-                    ),
-                )
-                conn.commit()
-                # Insert locations history if present
-                new_id = c.lastrowid
-                for loc in d.get("locations", []) or []:
-                    c.execute(
-                        "INSERT INTO locations (device_id, lat, lng, ts) VALUES (?, ?, ?, ?)",
-                        (new_id, float(loc.get("lat")), float(loc.get("lng")), loc.get("ts")),
-                    )
-                conn.commit()
+            summary = import_devices(conn, iter_import_records(file))
+        except (OSError, EOFError, UnicodeDecodeError) as e:
+            if wants_json:
+                return jsonify({"ok": False, "error": f"unreadable upload: {e}"}), 400
+            flash("Invalid import file.", "error")
+            return render_template("import.html")
         finally:
             conn.close()
-        flash("Import completed.", "success")
+        if wants_json:
+            return jsonify({"ok": True, **summary})
+        flash(
+            f"Import completed: {summary['devices_added']} devices and {summary['locations_added']} locations added, "
+            f"{summary['devices_skipped']} existing devices skipped.",
+            "success",
+        )
+        if summary["error_count"]:
+            shown = "; ".join(f"record {e['record']}: {e['error']}" for e in summary["errors"][:5])
+            flash(f"{summary['error_count']} problems: {shown}", "warning")
         return redirect(url_for("index"))
     return render_template("import.html")
 
 
+class SlowRequestProfiler:
+    """Sampling profiler for slow requests, enabled with PROFILE_SLOW_MS.
+
+    While a sampled request runs, one background thread reads its stack every
+    ``interval_ms`` via ``sys._current_frames()``. Requests slower than
+    ``slow_ms`` are written to PROFILE_DIR in folded-stack format, ready for
+    flamegraph.pl or speedscope. Nothing is started while it is disabled.
+    """
+
+    def __init__(self, slow_ms, interval_ms, sample_rate):
+        self.slow_ms = slow_ms
+        self.interval = interval_ms / 1000.0
+        self.sample_rate = sample_rate
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def begin(self):
+        if self.sample_rate < 1.0 and secrets.randbelow(10000) >= self.sample_rate * 10000:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+            self._active[threading.get_ident()] = {}
+
+    def end(self, label, elapsed_ms):
+        stacks = self._active.pop(threading.get_ident(), None)
+        if stacks and elapsed_ms >= self.slow_ms:
+            try:
+                self._write(label, elapsed_ms, stacks)
+            except OSError as e:
+                print("ERROR in profiler:", e)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self._active:
+                continue
+            frames = sys._current_frames()
+            for ident, stacks in list(self._active.items()):
+                frame = frames.get(ident)
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                key = ";".join(reversed(names))
+                stacks[key] = stacks.get(key, 0) + 1
+
+    def _write(self, label, elapsed_ms, stacks):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = f"{now_ms()}-{label}-{int(elapsed_ms)}ms.folded"
+        with open(os.path.join(PROFILE_DIR, name), "w", encoding="utf-8") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in stacks.items())
+        METRICS.inc("profiles_captured_total")
+        old = sorted(n for n in os.listdir(PROFILE_DIR) if n.endswith(".folded"))[:-PROFILE_KEEP]
+        for n in old:
+            os.remove(os.path.join(PROFILE_DIR, n))
+
+
+profiler = SlowRequestProfiler(PROFILE_SLOW_MS, PROFILE_INTERVAL_MS, PROFILE_SAMPLE_RATE) if PROFILE_SLOW_MS > 0 else None
+_metrics_published = {"at": 0.0}
+
+
+@app.before_request
+def metrics_before_request():
+    g.metrics_started = time.perf_counter()
+    _metrics_local.sql = [0, 0.0]
+    if profiler is not None:
+        profiler.begin()
+
+
+@app.after_request
+def metrics_after_request(response):
+    started = g.get("metrics_started")
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or "unmatched"
+    METRICS.inc("http_requests_total", (endpoint, request.method, str(response.status_code)))
+    METRICS.observe("http_request_duration_seconds", (endpoint, request.method), elapsed)
+    tally = getattr(_metrics_local, "sql", None) or [0, 0.0]
+    _metrics_local.sql = None
+    METRICS.observe("db_statements_per_request", (endpoint,), tally[0])
+    METRICS.observe("db_time_per_request_seconds", (endpoint,), tally[1])
+    response.headers["Server-Timing"] = (
+        f'app;dur={elapsed * 1000:.1f}, db;dur={tally[1] * 1000:.1f};desc="{tally[0]} statements"'
+    )
+    if profiler is not None:
+        profiler.end(endpoint, elapsed * 1000)
+    if time.monotonic() - _metrics_published["at"] >= METRICS_FLUSH:
+        publish_metrics()
+    return response
+
+
+def collect_process_metrics():
+    """Copy counters kept by caches and background workers into the registry."""
+    METRICS.set("cache_requests_total", ("device_auth", "hit"), _device_auth_cache.hits)
+    METRICS.set("cache_requests_total", ("device_auth", "miss"), _device_auth_cache.misses)
+    info = phone_info.cache_info()
+    METRICS.set("cache_requests_total", ("phone_info", "hit"), info.hits)
+    METRICS.set("cache_requests_total", ("phone_info", "miss"), info.misses)
+    METRICS.set("phonenumbers_parses_total", (), info.misses)
+    METRICS.set("ingest_queue_depth", (), ingest_queue._queue.qsize() if ingest_queue is not None else 0)
+    METRICS.set("sms_queue_depth", (), sms_dispatcher._queue.qsize())
+    METRICS.set("sms_circuit_open", (), int(sms_dispatcher.breaker.is_open()))
+    METRICS.set("live_subscribers", (), live_broker.subscriber_count())
+
+
+def publish_metrics():
+    """Write this process's metrics to METRICS_DIR so any worker can serve the fleet-wide sum."""
+    _metrics_published["at"] = time.monotonic()
+    collect_process_metrics()
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(METRICS.snapshot(), f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print("ERROR in publish_metrics:", e)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus scrape endpoint; sums the snapshots of every live worker.
+
+    With ``METRICS_TOKEN`` set the scraper sends it as a bearer token; without
+    it only a logged-in admin may read the endpoint.
+    """
+    if METRICS_TOKEN:
+        if not token_matches(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+            return Response("unauthorized\n", status=401, mimetype="text/plain")
+    else:
+        gate = require_role("admin")
+        if gate:
+            return gate
+    publish_metrics()
+    snapshots = [METRICS.snapshot()]
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        # publish_metrics could not create it (or it was cleaned up); report this worker alone
+        names = []
+    for name in names:
+        if not name.endswith(".json") or name == f"{os.getpid()}.json":
+            continue
+        path = os.path.join(METRICS_DIR, name)
+        try:
+            if not _process_alive(int(name[:-5])):
+                os.remove(path)
+                continue
+            with open(path, encoding="utf-8") as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    counters, histograms = METRICS.merge(snapshots)
+    return Response(METRICS.render(counters, histograms), mimetype="text/plain; version=0.0.4")
+
+
+# Agent API paths the ASGI front end serves itself, with their Flask endpoint names (used as metric labels)
+ASGI_AGENT_ROUTES = {
+    "/api/location_update": "location_update",
+    "/api/location_update/": "location_update",
+    "/api/validate_device": "validate_device",
+}
+JSON_SEPARATORS = (",", ":")
+
+
+def _timed_agent_call(fn, *args):
+    """Run an agent API core on an executor thread; returns ``(result, [statements, sql_seconds])``."""
+    _metrics_local.sql = [0, 0.0]
+    try:
+        return fn(*args), _metrics_local.sql
+    finally:
+        _metrics_local.sql = None
+        if time.monotonic() - _metrics_published["at"] >= METRICS_FLUSH:
+            publish_metrics()
+
+
+async def read_asgi_body(receive, limit):
+    """Read a request body from ASGI ``receive``; ``(bytes, None)``, ``(None, (error, status))``,
+    or ``(None, None)`` if the client disconnected first."""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None, None
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            return None, ("body too large", 413)
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks), None
+
+
+def wsgi_environ(scope, body):
+    """PEP 3333 environ for an ASGI HTTP ``scope`` whose body was buffered into the file ``body``."""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    root = scope.get("root_path", "")
+    path = scope["path"][len(root):] if scope["path"].startswith(root) else scope["path"]
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": root.encode("utf-8").decode("latin-1"),
+        "PATH_INFO": path.encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        # The whole body is buffered, so chunked uploads can be read to the end
+        "wsgi.input_terminated": True,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        key = name.decode("latin-1").upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        value = value.decode("latin-1")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class AsgiApp:
+    """ASGI front end: the agent API on the event loop, every other route through the Flask app.
+
+    POSTs to /api/location_update and /api/validate_device are read by the
+    event loop, so slow uploads and idle keep-alive connections cost a socket
+    and a coroutine instead of a worker; only their database work takes a
+    thread from a dedicated executor (``ASYNC_DB_THREADS``). Other requests are
+    buffered and handed to the WSGI app on a separate pool
+    (``ASYNC_WSGI_THREADS``), so admin pages, /export and /api/live behave as
+    under gunicorn's threaded workers. Serve with
+    ``gunicorn -c gunicorn.conf.py -k asgi app:asgi_app``.
+    """
+
+    def __init__(self, wsgi_app, db_threads, wsgi_threads):
+        self.wsgi_app = wsgi_app
+        self.db_threads = db_threads
+        self.wsgi_threads = wsgi_threads
+        self._db_executor = None
+        self._wsgi_executor = None
+        self._pid = None
+
+    def _executors(self):
+        # Threads do not survive fork; each worker builds its own pools on first use
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._db_executor = ThreadPoolExecutor(self.db_threads, thread_name_prefix="asgi-db")
+            self._wsgi_executor = ThreadPoolExecutor(self.wsgi_threads, thread_name_prefix="asgi-wsgi")
+        return self._db_executor, self._wsgi_executor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            endpoint = ASGI_AGENT_ROUTES.get(scope["path"])
+            if endpoint is not None and scope["method"] == "POST":
+                await self._agent_call(endpoint, scope, receive, send)
+            else:
+                await self._wsgi_call(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self._executors()
+                # Leave at least half of the WSGI threads for requests other than /api/live
+                live_broker.max_subscribers = min(live_broker.max_subscribers, self.wsgi_threads // 2)
+                # Under WSGI the first request starts it (start_background_jobs)
+                if retention_job is not None:
+                    retention_job.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self._pid == os.getpid():
+                    self._db_executor.shutdown(wait=False)
+                    self._wsgi_executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _agent_call(self, endpoint, scope, receive, send):
+        started = time.perf_counter()
+        headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+        tally = [0, 0.0]
+        result = None
+        try:
+            declared = headers.get("content-length")
+            if declared and declared.isdigit() and int(declared) > INGEST_MAX_BODY:
+                err = ("body too large", 413)
+            else:
+                body, err = await read_asgi_body(receive, INGEST_MAX_BODY)
+                if body is None and err is None:
+                    return
+            if err is None:
+                call, err = self._agent_handler(endpoint, headers, body)
+            if err is not None:
+                result = {"ok": False, "error": err[0]}, err[1]
+            else:
+                db_executor = self._executors()[0]
+                result, tally = await asyncio.get_running_loop().run_in_executor(db_executor, _timed_agent_call, *call)
+        except Exception as e:
+            print("ERROR in ASGI agent call:", e)
+            result = {"ok": False, "error": "internal error"}, 500
+        payload, status = result[0], result[1]
+        elapsed = time.perf_counter() - started
+        data = (json.dumps(payload, separators=JSON_SEPARATORS, sort_keys=True) + "\n").encode()
+        response_headers = [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(data)).encode()),
+            (b"server-timing", f'app;dur={elapsed * 1000:.1f}, db;dur={tally[1] * 1000:.1f};desc="{tally[0]} statements"'.encode()),
+        ]
+        for name, value in (result[2] if len(result) > 2 else {}).items():
+            response_headers.append((name.lower().encode("latin-1"), str(value).encode("latin-1")))
+        await send({"type": "http.response.start", "status": status, "headers": response_headers})
+        await send({"type": "http.response.body", "body": data})
+        METRICS.inc("http_requests_total", (endpoint, "POST", str(status)))
+        METRICS.observe("http_request_duration_seconds", (endpoint, "POST"), elapsed)
+        METRICS.observe("db_statements_per_request", (endpoint,), tally[0])
+        METRICS.observe("db_time_per_request_seconds", (endpoint,), tally[1])
+
+    @staticmethod
+    def _agent_handler(endpoint, headers, body):
+        """Decode an agent request like the Flask views do; ``((fn, *args), None)`` or ``(None, (error, status))``."""
+        mimetype = headers.get("content-type", "").split(";", 1)[0].strip().lower()
+        is_json = mimetype == "application/json" or (mimetype.startswith("application/") and mimetype.endswith("+json"))
+        key_header = headers.get("idempotency-key")
+        if endpoint == "validate_device":
+            payload = None
+            if is_json:
+                try:
+                    payload = json.loads(body)
+                except ValueError:
+                    pass
+            return (check_device, payload or {}), None
+        if mimetype == FIXES_MIMETYPE or is_json:
+            body, err = decode_body(body, headers.get("content-encoding"))
+            if err:
+                return None, err
+        if mimetype == FIXES_MIMETYPE:
+            return (store_fix_frame, body, key_header), None
+        payload = None
+        if is_json:
+            try:
+                payload = json.loads(body)
+            except ValueError:
+                pass
+        return (store_location_update, payload or {}, key_header), None
+
+    async def _wsgi_call(self, scope, receive, send):
+        body = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return
+                body.write(message.get("body", b""))
+                if not message.get("more_body"):
+                    break
+            body.seek(0)
+            disconnected = threading.Event()
+
+            async def watch():
+                while (await receive())["type"] != "http.disconnect":
+                    pass
+                disconnected.set()
+
+            loop = asyncio.get_running_loop()
+            # Servers expect send() from the request's own task, so the pool thread
+            # hands messages over and this coroutine sends them (bounded, for backpressure)
+            messages = asyncio.Queue(8)
+            watcher = asyncio.ensure_future(watch())
+            done = loop.run_in_executor(
+                self._executors()[1], self._run_wsgi, loop, wsgi_environ(scope, body), messages, disconnected
+            )
+            try:
+                while True:
+                    message = await messages.get()
+                    if message is None:
+                        break
+                    try:
+                        await send(message)
+                    except OSError:
+                        disconnected.set()
+                    # Return right away; the pool thread only has cleanup left
+                    if message["type"] == "http.response.body" and not message["more_body"]:
+                        return
+                if await done and not disconnected.is_set():
+                    await send({"type": "http.response.body", "body": b"", "more_body": False})
+            finally:
+                # Cancelled only after the response is complete; some servers treat a
+                # cancelled receive() as the client going away
+                watcher.cancel()
+        finally:
+            body.close()
+
+    def _run_wsgi(self, loop, environ, messages, disconnected):
+        """Run the WSGI app on a pool thread, queueing ASGI messages as chunks are produced.
+
+        The chunk that reaches ``Content-Length`` is sent as the last one: a
+        keep-alive client sends its next request as soon as it has the whole
+        body, and must not find this request still running. Returns True if the
+        caller still has to end the response (streamed or empty bodies).
+        """
+        state = {"start": None, "sent": False, "remaining": None}
+
+        def emit(message):
+            asyncio.run_coroutine_threadsafe(messages.put(message), loop).result()
+
+        def write(data):
+            if not state["sent"]:
+                emit(state["start"])
+                state["sent"] = True
+            if data and state["remaining"] != 0:
+                last = state["remaining"] is not None and len(data) >= state["remaining"]
+                if state["remaining"] is not None:
+                    state["remaining"] = max(0, state["remaining"] - len(data))
+                emit({"type": "http.response.body", "body": data, "more_body": not last})
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and state["sent"]:
+                raise exc_info[1].with_traceback(exc_info[2])
+            state["start"] = {
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+            }
+            length = next((value for name, value in headers if name.lower() == "content-length"), None)
+            state["remaining"] = int(length) if length and length.isdigit() and int(length) > 0 else None
+            return write
+
+        try:
+            result = self.wsgi_app(environ, start_response)
+            try:
+                for chunk in result:
+                    # A closed stream (e.g. /api/live) stops here instead of producing forever
+                    if disconnected.is_set():
+                        return False
+                    if chunk:
+                        write(chunk)
+                write(b"")
+                return state["remaining"] != 0
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+        finally:
+            emit(None)
+
+
+asgi_app = AsgiApp(app, ASYNC_DB_THREADS, ASYNC_WSGI_THREADS)
+
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create/migrate the schema and seed the admin account."""
+    init_app_data()
+    print(format_boot_report())
+
+
+@app.cli.command("boot-report")
+def boot_report_command():
+    """Time each startup phase of this process."""
+    init_app_data()
+    preload_phone_metadata()
+    with boot_phase("first connection"):
+        db_connect()
+    print(format_boot_report())
+
+
+@app.cli.command("retention")
+@click.option("--archive/--no-archive", default=None, help="Archive dropped rows (default: RETENTION_ARCHIVE).")
+@click.option("--convert-vacuum", is_flag=True, help="Switch an existing database to incremental auto-vacuum (runs VACUUM).")
+def retention_command(archive, convert_vacuum):
+    """Compact, archive and expire location history once according to the retention policies."""
+    ensure_db()
+    # Same lock as the workers' background job, so the two never compact the same rows
+    with retention_lock() as locked:
+        if not locked:
+            raise click.ClickException("a retention pass is already running (retention.lock is held)")
+        conn = _open_connection()
+        try:
+            if convert_vacuum:
+                conn.isolation_level = None
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("VACUUM")
+            summary = run_retention(conn, archive=archive)
+        finally:
+            conn.dispose()
+    print(json.dumps(summary))
+
+
+@app.cli.group("shards")
+def shards_group():
+    """Inspect or change how location history is split over shard files."""
+
+
+@shards_group.command("status")
+def shards_status_command():
+    """Show the shard layout and how many rows each file holds."""
+    ensure_db()
+    print(f"location shards: {_location_shards or 'none (history in app.db)'}")
+    paths = [shard_path(i) for i in range(_location_shards)] if _location_shards else [DB_FILE]
+    for path in paths:
+        conn = sqlite3.connect(path)
+        try:
+            rows = conn.execute("SELECT COUNT(*) FROM locations").fetchone()[0]
+        finally:
+            conn.close()
+        print(f"{path}: {rows} locations, {os.path.getsize(path) / 1048576:.1f} MiB")
+
+
+@shards_group.command("rebalance")
+@click.option("--shards", "target", type=click.IntRange(min=0), required=True, help="New shard count (0 = keep history in app.db).")
+@click.option("--batch-rows", type=click.IntRange(min=1), default=50000, help="Rows copied per transaction.")
+def shards_rebalance_command(target, batch_rows):
+    """Move existing history to a new shard count. Run it with the app stopped."""
+    started = time.perf_counter()
+    last = [0.0]
+
+    def progress(summary):
+        if time.perf_counter() - last[0] >= 5:
+            last[0] = time.perf_counter()
+            print(f"copied {summary['rows']}")
+
+    summary = rebalance_locations(target, batch_rows, progress)
+    summary["seconds"] = round(time.perf_counter() - started, 1)
+    print(json.dumps(summary))
+
+
+@app.cli.command("analytics")
+@click.option("--days", type=click.IntRange(min=1), default=2, help="UTC days to refresh, ending today.")
+@click.option("--processes", type=click.IntRange(min=1), default=os.cpu_count() or 1, help="Worker processes.")
+@click.option("--chunk", type=click.IntRange(min=1), default=200, help="Devices per task.")
+def analytics_command(days, processes, chunk):
+    """Refresh stored trip/stop analytics for every device seen in the last --days days."""
+    started = time.perf_counter()
+    ensure_db()
+    last_day = now_ms() // DAY_MS
+    first_day = last_day - days + 1
+    conn = db_connect()
+    ids = [row[0] for row in conn.execute(
+        "SELECT id FROM devices WHERE last_update >= ? ORDER BY id", (ms_to_ts_text(first_day * DAY_MS),)
+    )]
+    # Do not carry open SQLite handles into the worker processes
+    db_dispose()
+    summary = {"devices": len(ids), "days_computed": 0, "days_reused": 0, "days_removed": 0}
+    with ProcessPoolExecutor(processes) as pool:
+        tasks = [
+            pool.submit(analytics_chunk, ids[i:i + chunk], first_day, last_day) for i in range(0, len(ids), chunk)
+        ]
+        # Results are written here, so the workers only read and never wait on the write lock
+        conn = db_connect()
+        for task in as_completed(tasks):
+            rows, stale, reused = task.result()
+            save_daily(conn, rows, stale)
+            summary["days_computed"] += len(rows)
+            summary["days_reused"] += reused
+            summary["days_removed"] += len(stale)
+    summary["seconds"] = round(time.perf_counter() - started, 1)
+    print(json.dumps(summary))
+
+
+BOOT_TIMINGS.append(("module body", (time.perf_counter() - _IMPORTS_DONE) * 1000.0))
+
+
 if __name__ == "__main__":
+    init_app_data()
     app.run(host="0.0.0.0", port=5000)
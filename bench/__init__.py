@@ -0,0 +1 @@
+"""Offline benchmark and load-test suite for the device tracker (see README, "Benchmarks")."""
@@ -0,0 +1,92 @@
+"""Helpers shared by the benchmark scripts: isolated data directories, statistics and result files."""
+import atexit
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def isolated_data_dir(prefix="tracker-bench-"):
+    """Create a throwaway DATA_DIR so benchmarks never touch data/app.db.
+
+    Must run before ``app`` is imported; the app reads DATA_DIR at import time.
+    """
+    path = tempfile.mkdtemp(prefix=prefix)
+    if os.environ.get("BENCH_KEEP_DATA") != "1":
+        atexit.register(shutil.rmtree, path, True)
+    os.environ["DATA_DIR"] = path
+    # Keep side effects local and quiet
+    os.environ.setdefault("SMS_PROVIDER", "log")
+    os.environ.setdefault("RETENTION_INTERVAL", "0")
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    return path
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies_ms, elapsed_s, errors=0):
+    values = sorted(latencies_ms)
+    count = len(values)
+    return {
+        "count": count,
+        "errors": errors,
+        "elapsed_s": round(elapsed_s, 4),
+        "throughput_rps": round(count / elapsed_s, 2) if elapsed_s > 0 else None,
+        "mean_ms": round(sum(values) / count, 4) if count else None,
+        "p50_ms": round(percentile(values, 50), 4) if count else None,
+        "p95_ms": round(percentile(values, 95), 4) if count else None,
+        "p99_ms": round(percentile(values, 99), 4) if count else None,
+        "max_ms": round(values[-1], 4) if count else None,
+    }
+
+
+def metadata(kind, params):
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "kind": kind,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "params": params,
+    }
+
+
+def write_results(path, meta, results):
+    doc = {"meta": meta, "results": results}
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(doc, f, indent=2, sort_keys=True)
+            f.write("\n")
+    return doc
+
+
+def print_table(results):
+    print(f"{'benchmark':<28} {'count':>7} {'rps':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for name in sorted(results):
+        r = results[name]
+        print(
+            f"{name:<28} {r['count']:>7} {r['throughput_rps'] or 0:>10.1f} {r['p50_ms'] or 0:>9.3f} "
+            f"{r['p95_ms'] or 0:>9.3f} {r['p99_ms'] or 0:>9.3f} {r['errors']:>7}"
+        )
@@ -0,0 +1,66 @@
+"""Compare two benchmark result files.
+
+    python -m bench.compare baseline.json candidate.json --threshold 10
+
+Prints the change of throughput and p50/p95/p99 per benchmark. Exits with
+status 1 when any latency percentile got worse (or throughput dropped) by more
+than ``--threshold`` percent, so it can gate a deploy.
+"""
+import argparse
+import json
+import sys
+
+# metric -> True when a larger value is better
+METRICS = {"throughput_rps": True, "p50_ms": False, "p95_ms": False, "p99_ms": False}
+
+
+def change(old, new):
+    if old in (None, 0) or new is None:
+        return None
+    return (new - old) / old * 100.0
+
+
+def compare(base, cand, threshold):
+    """Return ``(rows, regressions)``; rows are ``(name, metric, old, new, pct)``."""
+    rows = []
+    regressions = []
+    for name in sorted(set(base["results"]) & set(cand["results"])):
+        for metric, higher_is_better in METRICS.items():
+            old = base["results"][name].get(metric)
+            new = cand["results"][name].get(metric)
+            pct = change(old, new)
+            rows.append((name, metric, old, new, pct))
+            if pct is not None and (-pct if higher_is_better else pct) > threshold:
+                regressions.append((name, metric, pct))
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent change treated as a regression")
+    args = parser.parse_args(argv)
+    with open(args.baseline, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.candidate, encoding="utf-8") as f:
+        cand = json.load(f)
+    if base["meta"].get("kind") != cand["meta"].get("kind"):
+        print(f"warning: comparing {base['meta'].get('kind')} results with {cand['meta'].get('kind')} results")
+    print(f"baseline  {base['meta'].get('git_commit')} {base['meta'].get('started_at')}")
+    print(f"candidate {cand['meta'].get('git_commit')} {cand['meta'].get('started_at')}")
+    rows, regressions = compare(base, cand, args.threshold)
+    print(f"{'benchmark':<28} {'metric':<15} {'baseline':>12} {'candidate':>12} {'change':>9}")
+    for name, metric, old, new, pct in rows:
+        shown = f"{pct:+8.1f}%" if pct is not None else "      n/a"
+        print(f"{name:<28} {metric:<15} {old if old is not None else 'n/a':>12} {new if new is not None else 'n/a':>12} {shown}")
+    if regressions:
+        print(f"\n{len(regressions)} regressions beyond {args.threshold:.0f}%:")
+        for name, metric, pct in regressions:
+            print(f"  {name} {metric} {pct:+.1f}%")
+        sys.exit(1)
+    print("\nno regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""Concurrent agent connections: sync vs threaded vs ASGI workers.
+
+For each ``--modes`` entry, starts the app under gunicorn on a free port and
+opens ``--connections`` simulated agents. Each agent holds a keep-alive
+connection and posts /api/location_update every ``--interval`` seconds. With
+``--trickle-ms`` the body is sent that long after the headers, like a slow
+mobile link. Reports latency percentiles, errors, the share of expected posts
+that were served, and how much the server's memory (PSS of all its processes)
+grew per open connection.
+
+    python -m bench.connections --modes sync,gthread,asgi --connections 100,1000 --duration 20 --out conn.json
+
+The asgi mode uses gunicorn's own asyncio worker (gunicorn 24+); the uvicorn
+mode needs ``uvicorn`` and ``uvicorn-worker`` installed.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import signal
+import subprocess
+import sys
+import time
+
+from bench.common import ROOT, isolated_data_dir, metadata, print_table, summarize, write_results
+from bench.load import free_port, wait_ready
+
+MODES = {
+    "sync": ["-k", "sync", "--threads", "1", "app:app"],
+    "gthread": ["-k", "gthread", "--threads", "{threads}", "app:app"],
+    "asgi": ["-k", "asgi", "app:asgi_app"],
+    "uvicorn": ["-k", "uvicorn_worker.UvicornWorker", "app:asgi_app"],
+}
+
+
+def process_tree(pid):
+    """``pid`` and all of its descendants (Linux /proc)."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", encoding="ascii") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree = [pid]
+    for p in tree:
+        tree += children.get(p, [])
+    return tree
+
+
+def memory_mb(pid):
+    """Proportional set size of a process tree in MiB (shared pages counted once); None off Linux."""
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/smaps_rollup", encoding="ascii") as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith("Pss:"))
+        except (OSError, StopIteration, ValueError):
+            return None
+    return total / 1024.0
+
+
+async def read_response(reader):
+    """Read one HTTP/1.1 response; returns ``(status, keep_alive)``."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+    version, status = status_line.split(None, 2)[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip().lower()
+    await reader.readexactly(int(headers.get("content-length", "0")))
+    connection = headers.get("connection", "")
+    keep_alive = connection != "close" and (version == b"HTTP/1.1" or connection == "keep-alive")
+    return int(status), keep_alive
+
+
+async def agent(index, port, device, args, stop_at, stats):
+    """One simulated agent: post a fix every ``interval`` seconds over a reused connection."""
+    rng = random.Random(index)
+    reader = writer = None
+    # Spread the first posts over one interval so the load is steady
+    await asyncio.sleep(rng.random() * args.interval)
+    while time.monotonic() < stop_at:
+        next_at = time.monotonic() + args.interval
+        body = json.dumps({
+            "imei": device["imei"], "token": device["token"],
+            "lat": -17.8 + rng.random() / 100, "lng": 31.05 + rng.random() / 100,
+        }).encode()
+        head = (
+            f"POST /api/location_update HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n"
+        ).encode()
+        t0 = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), args.timeout)
+                stats["connects"] += 1
+            writer.write(head)
+            if args.trickle_ms:
+                await writer.drain()
+                await asyncio.sleep(args.trickle_ms / 1000.0)
+            writer.write(body)
+            await writer.drain()
+            status, keep_alive = await asyncio.wait_for(read_response(reader), args.timeout)
+            stats["latencies"].append((time.perf_counter() - t0) * 1000.0)
+            if status >= 400:
+                stats["errors"] += 1
+            if not keep_alive:
+                writer.close()
+                writer = None
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            stats["errors"] += 1
+            if writer is not None:
+                writer.close()
+            writer = None
+        await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+    if writer is not None:
+        writer.close()
+
+
+def client(port, devices, first, args, results):
+    """One driver process running ``len(devices)`` agents on an asyncio loop."""
+    stats = {"latencies": [], "errors": 0, "connects": 0}
+
+    async def run():
+        stop_at = time.monotonic() + args.duration
+        await asyncio.gather(*(agent(first + i, port, d, args, stop_at, stats) for i, d in enumerate(devices)))
+
+    asyncio.run(run())
+    results.put(stats)
+
+
+def raise_fd_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = hard if hard != resource.RLIM_INFINITY else max(soft, needed)
+    if soft < target:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    if target < needed:
+        print(f"warning: open file limit {target} is below {needed}; raise it with ulimit -n")
+
+
+def run_mode(mode, connections, fleet, data_dir, args):
+    port = free_port()
+    cmd = [
+        sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "-w", str(args.workers),
+        "-b", f"127.0.0.1:{port}", "--keep-alive", str(args.keep_alive), "--backlog", str(max(2048, connections)),
+        "--worker-connections", str(max(1000, connections)),
+        "--log-level", "warning",
+    ] + [part.format(threads=args.threads) for part in MODES[mode]]
+    server = subprocess.Popen(cmd, cwd=ROOT, env=dict(os.environ, DATA_DIR=data_dir))
+    try:
+        wait_ready(port, server)
+        time.sleep(1.0)
+        idle = memory_mb(server.pid)
+        results = multiprocessing.Queue()
+        clients = min(args.clients, connections)
+        share = [fleet[(i * 7919) % len(fleet)] for i in range(connections)]
+        procs = []
+        for k in range(clients):
+            lo, hi = k * connections // clients, (k + 1) * connections // clients
+            procs.append(multiprocessing.Process(target=client, args=(port, share[lo:hi], lo, args, results)))
+        started = time.perf_counter()
+        for p in procs:
+            p.start()
+        peak = idle
+        deadline = time.monotonic() + args.duration
+        while time.monotonic() < deadline:
+            time.sleep(1.0)
+            current = memory_mb(server.pid)
+            if current is not None and peak is not None:
+                peak = max(peak, current)
+        collected = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(30)
+
+    latencies = [v for s in collected for v in s["latencies"]]
+    result = summarize(latencies, elapsed, sum(s["errors"] for s in collected))
+    expected = connections * args.duration / args.interval
+    result.update({
+        "connections": connections,
+        "connects": sum(s["connects"] for s in collected),
+        "served_pct": round(100.0 * (len(latencies) - result["errors"]) / expected, 1) if expected else None,
+        "memory_idle_mb": round(idle, 1) if idle is not None else None,
+        "memory_peak_mb": round(peak, 1) if peak is not None else None,
+        "kb_per_connection": round((peak - idle) * 1024.0 / connections, 1) if idle is not None else None,
+    })
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", default="sync,gthread,asgi", help="comma-separated: " + ",".join(MODES))
+    parser.add_argument("--connections", default="100,1000", help="comma-separated connection counts")
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=32, help="threads per worker in gthread mode")
+    parser.add_argument("--keep-alive", type=int, default=75, help="seconds an idle connection stays open")
+    parser.add_argument("--clients", type=int, default=4, help="driver processes")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds per run")
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between posts of one agent")
+    parser.add_argument("--trickle-ms", type=float, default=0.0, help="delay between request headers and body")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds before a post counts as failed")
+    parser.add_argument("--out", help="write results as JSON")
+    args = parser.parse_args(argv)
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    unknown = [m for m in modes if m not in MODES]
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(unknown)}")
+    counts = [int(n) for n in args.connections.split(",")]
+    raise_fd_limit(max(counts) + 256)
+
+    data_dir = isolated_data_dir()
+    import app as app_module
+    from bench.fleet import load_fleet
+
+    app_module.init_app_data()
+    load_fleet(app_module, args.devices, 1, args.seed)
+    conn = app_module.db_connect()
+    try:
+        fleet = [dict(r) for r in conn.execute("SELECT imei, api_token AS token FROM devices")]
+    finally:
+        conn.close()
+    app_module.db_dispose()
+
+    results = {}
+    for mode in modes:
+        for n in counts:
+            name = f"{mode}@{n}"
+            print(f"{name}: {args.workers} workers, {n} agents posting every {args.interval:g} s")
+            results[name] = run_mode(mode, n, fleet, data_dir, args)
+    print_table(results)
+    print(f"\n{'benchmark':<28} {'served %':>9} {'connects':>9} {'idle MiB':>9} {'peak MiB':>9} {'KiB/conn':>9}")
+    for name in sorted(results):
+        r = results[name]
+        print(
+            f"{name:<28} {r['served_pct'] or 0:>9.1f} {r['connects']:>9} {r['memory_idle_mb'] or 0:>9.1f} "
+            f"{r['memory_peak_mb'] or 0:>9.1f} {r['kb_per_connection'] or 0:>9.1f}"
+        )
+    params = {k: v for k, v in vars(args).items() if k != "out"}
+    write_results(args.out, metadata("connections", params), results)
+
+
+if __name__ == "__main__":
+    main()
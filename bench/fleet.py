@@ -0,0 +1,128 @@
+"""Synthetic fleet generator.
+
+Produces device records in the export format (valid Luhn IMEIs, E.164 phone
+numbers, ``history`` fixes each) that ``/import`` and ``app.import_devices``
+accept. Output is deterministic for a given seed.
+
+    python -m bench.fleet --devices 1000 --history 200 --out fleet.ndjson
+"""
+import argparse
+import gzip
+import json
+import math
+import random
+import time
+
+# (E.164 prefix, digits after it, region, carrier); all produce numbers phonenumbers accepts as valid
+PHONE_PLANS = [
+    ("+26377", 7, "Zimbabwe", "Econet"),
+    ("+26378", 7, "Zimbabwe", "Econet"),
+    ("+26371", 7, "Zimbabwe", "Net*One"),
+    ("+2547", 8, "Kenya", None),
+]
+# Starting points the synthetic tracks wander from
+CITIES = [(-17.8292, 31.0522), (-20.1325, 28.6265), (-1.2864, 36.8172), (-18.9707, 32.6709)]
+
+
+def luhn_check_digit(body):
+    """Check digit that makes ``body + digit`` pass the Luhn test."""
+    total = 0
+    for i, ch in enumerate(reversed(body)):
+        d = int(ch)
+        if i % 2 == 0:
+            d *= 2
+            if d > 9:
+                d -= 9
+        total += d
+    return str((10 - total % 10) % 10)
+
+
+def make_imei(rng):
+    body = "35" + "".join(str(rng.randrange(10)) for _ in range(12))
+    return body + luhn_check_digit(body)
+
+
+def make_phone(rng):
+    prefix, digits, region, carrier = rng.choice(PHONE_PLANS)
+    return prefix + "".join(str(rng.randrange(10)) for _ in range(digits)), region, carrier
+
+
+def make_track(rng, history, interval_s, end_ms):
+    """A random walk of ``history`` fixes ending at ``end_ms``, ``interval_s`` apart."""
+    lat, lng = rng.choice(CITIES)
+    lat += rng.uniform(-0.2, 0.2)
+    lng += rng.uniform(-0.2, 0.2)
+    heading = rng.uniform(0, 2 * math.pi)
+    points = []
+    start = end_ms - (history - 1) * interval_s * 1000
+    for i in range(history):
+        heading += rng.gauss(0, 0.3)
+        step = rng.choice((0.0, 0.0002, 0.0005, 0.001))
+        lat += step * math.cos(heading)
+        lng += step * math.sin(heading)
+        points.append({"lat": round(lat, 6), "lng": round(lng, 6), "ts": start + i * interval_s * 1000})
+    return points
+
+
+def generate_fleet(devices, history=100, seed=1, interval_s=60, end_ms=None, stale_fraction=0.1):
+    """Yield ``devices`` export-format records with unique IMEIs and phones."""
+    rng = random.Random(seed)
+    end_ms = end_ms if end_ms is not None else int(time.time() * 1000)
+    imeis = set()
+    phones = set()
+    for n in range(devices):
+        imei = make_imei(rng)
+        while imei in imeis:
+            imei = make_imei(rng)
+        phone, region, carrier = make_phone(rng)
+        while phone in phones:
+            phone, region, carrier = make_phone(rng)
+        imeis.add(imei)
+        phones.add(phone)
+        # Some devices stopped reporting days ago, so stale filters have something to find
+        device_end = end_ms - (rng.randint(2, 30) * 86400000 if rng.random() < stale_fraction else 0)
+        locations = make_track(rng, history, interval_s, device_end) if history else []
+        last = locations[-1] if locations else None
+        yield {
+            "owner": f"owner-{n % 50:02d}",
+            "imei": imei,
+            "phone": phone,
+            "carrier": carrier,
+            "region": region,
+            "api_token": f"bench-token-{n}",
+            "last_update": (
+                time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(last["ts"] / 1000.0)) if last else None
+            ),
+            "last_location": {"lat": last["lat"], "lng": last["lng"]} if last else None,
+            "locations": locations,
+        }
+
+
+def load_fleet(app_module, devices, history=100, seed=1, interval_s=60):
+    """Import a generated fleet into the app's current database; returns the import summary."""
+    conn = app_module.db_connect()
+    try:
+        return app_module.import_devices(conn, generate_fleet(devices, history, seed, interval_s))
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--history", type=int, default=100, help="fixes per device")
+    parser.add_argument("--interval", type=int, default=60, help="seconds between fixes")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", required=True, help="NDJSON file; .gz compresses it")
+    args = parser.parse_args(argv)
+    opener = gzip.open if args.out.endswith(".gz") else open
+    count = 0
+    with opener(args.out, "wt", encoding="utf-8") as f:
+        for record in generate_fleet(args.devices, args.history, args.seed, args.interval):
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            count += 1
+    print(f"wrote {count} devices to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
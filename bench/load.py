@@ -0,0 +1,196 @@
+"""Multi-process HTTP load driver against a local gunicorn.
+
+Starts ``gunicorn -c gunicorn.conf.py app:app`` on a free port with a
+temporary DATA_DIR holding a synthetic fleet, runs ``--clients`` driver
+processes for ``--duration`` seconds with a weighted request mix, and reports
+throughput and p50/p95/p99 latency per request type.
+
+    python -m bench.load --workers 4 --clients 16 --duration 30 --out load.json
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.parse
+
+from bench.common import ROOT, isolated_data_dir, metadata, print_table, summarize, write_results
+
+# Relative weights of each request type in the default mix
+DEFAULT_MIX = "location_update=70,location_batch=10,search=15,history=4,export=1"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(port, proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {proc.returncode}")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/login")
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("gunicorn did not become ready")
+
+
+def login(conn):
+    """Log in as the seeded admin and return the session cookie header."""
+    body = urllib.parse.urlencode({"username": "admin", "password": os.environ.get("ADMIN_PASSWORD", "admin")})
+    conn.request("POST", "/login", body=body, headers={"Content-Type": "application/x-www-form-urlencoded"})
+    resp = conn.getresponse()
+    resp.read()
+    cookie = resp.getheader("Set-Cookie", "")
+    return cookie.split(";", 1)[0]
+
+
+def driver(index, port, fleet, mix, duration, batch, results):
+    """One client process: keep-alive connection, weighted random requests until the deadline."""
+    rng = random.Random(index)
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    cookie = login(conn)
+    names = [name for name, _ in mix]
+    weights = [w for _, w in mix]
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    deadline = time.monotonic() + duration
+    n = 0
+    while time.monotonic() < deadline:
+        name = rng.choices(names, weights)[0]
+        d = fleet[rng.randrange(len(fleet))]
+        n += 1
+        headers = {"Cookie": cookie}
+        if name == "location_update":
+            method, path = "POST", "/api/location_update"
+            body = json.dumps({"imei": d["imei"], "token": d["token"], "lat": -17.8 + rng.random() / 100, "lng": 31.05})
+            headers["Content-Type"] = "application/json"
+        elif name == "location_batch":
+            method, path = "POST", "/api/location_batch"
+            base = int(time.time() * 1000) - 600000 + index
+            fixes = [{"lat": -17.8 + k * 1e-4, "lng": 31.05, "ts": base + k * 1000} for k in range(batch)]
+            body = json.dumps({"imei": d["imei"], "token": d["token"], "fixes": fixes})
+            headers["Content-Type"] = "application/json"
+        elif name == "search":
+            method, path = "POST", "/search"
+            body = urllib.parse.urlencode({"query": d["imei"] if n % 2 else d["phone"]})
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        elif name == "history":
+            method, path, body = "GET", f"/api/devices/{d['id']}/history?zoom=12", None
+        else:
+            method, path, body = "GET", "/export?format=ndjson", None
+        t0 = time.perf_counter()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            ok = resp.status < 400
+        except (OSError, http.client.HTTPException):
+            ok = False
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        latencies[name].append((time.perf_counter() - t0) * 1000.0)
+        if not ok:
+            errors[name] += 1
+    conn.close()
+    results.put((latencies, errors))
+
+
+def parse_mix(text):
+    mix = []
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix.append((name.strip(), float(weight or 1)))
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--history", type=int, default=50, help="fixes per device")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=1, help="gunicorn threads per worker (gthread if > 1)")
+    parser.add_argument("--clients", type=int, default=8, help="driver processes")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds")
+    parser.add_argument("--batch", type=int, default=50, help="fixes per location_batch call")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weighted request mix, name=weight,...")
+    parser.add_argument("--shards", type=int, default=0, help="LOCATION_SHARDS for the benchmark database")
+    parser.add_argument("--out", help="write results as JSON")
+    args = parser.parse_args(argv)
+    mix = parse_mix(args.mix)
+
+    data_dir = isolated_data_dir()
+    # Read by app at import time; the gunicorn workers inherit it too
+    os.environ["LOCATION_SHARDS"] = str(args.shards)
+    import app as app_module
+    from bench.fleet import load_fleet
+
+    app_module.init_app_data()
+    load_fleet(app_module, args.devices, args.history, args.seed)
+    conn = app_module.db_connect()
+    try:
+        fleet = [dict(r) for r in conn.execute("SELECT id, imei, phone, api_token AS token FROM devices")]
+    finally:
+        conn.close()
+    app_module.db_dispose()
+
+    port = free_port()
+    cmd = [
+        sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+        "-w", str(args.workers), "-b", f"127.0.0.1:{port}", "--log-level", "warning",
+    ]
+    if args.threads > 1:
+        cmd += ["-k", "gthread", "--threads", str(args.threads)]
+    else:
+        cmd += ["-k", "sync", "--threads", "1"]
+    server = subprocess.Popen(cmd + ["app:app"], cwd=ROOT, env=dict(os.environ, DATA_DIR=data_dir))
+    try:
+        wait_ready(port, server)
+        print(f"gunicorn ready on port {port} ({args.workers} workers), driving with {args.clients} clients")
+        results = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(
+                target=driver, args=(i, port, fleet, mix, args.duration, args.batch, results)
+            )
+            for i in range(args.clients)
+        ]
+        started = time.perf_counter()
+        for p in procs:
+            p.start()
+        collected = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(30)
+
+    merged = {name: [] for name, _ in mix}
+    errors = {name: 0 for name, _ in mix}
+    for lat, err in collected:
+        for name in merged:
+            merged[name] += lat[name]
+            errors[name] += err[name]
+    results = {name: summarize(values, elapsed, errors[name]) for name, values in merged.items()}
+    results["all"] = summarize([v for values in merged.values() for v in values], elapsed, sum(errors.values()))
+    print_table(results)
+    params = {k: v for k, v in vars(args).items() if k != "out"}
+    write_results(args.out, metadata("load", params), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Per-handler micro-benchmarks through the Flask test client.
+
+Builds a synthetic fleet in a temporary DATA_DIR, then times each handler
+in-process, with no network or server in the way.
+
+    python -m bench.micro --devices 2000 --history 100 --out micro.json
+"""
+import argparse
+import io
+import json
+import os
+import time
+
+from bench.common import isolated_data_dir, metadata, print_table, summarize, write_results
+
+
+def run_case(fn, iterations, warmup):
+    for _ in range(warmup):
+        fn(-1)
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        try:
+            ok = fn(i)
+        except Exception as e:
+            print("ERROR in benchmark:", e)
+            ok = False
+        latencies.append((time.perf_counter() - t0) * 1000.0)
+        if not ok:
+            errors += 1
+    return summarize(latencies, time.perf_counter() - started, errors)
+
+
+def build_cases(app_module, client, fleet, args):
+    """Map of benchmark name -> callable(i) returning True on success."""
+    from bench.fleet import generate_fleet
+
+    n = len(fleet)
+
+    def device(i):
+        return fleet[i % n]
+
+    def location_update(i):
+        d = device(i)
+        r = client.post("/api/location_update", json={
+            "imei": d["imei"], "token": d["api_token"], "lat": -17.8 + (i % 1000) * 1e-4, "lng": 31.05,
+        })
+        return r.status_code in (200, 202)
+
+    def location_batch(i):
+        d = device(i)
+        base = int(time.time() * 1000) - 600000
+        fixes = [{"lat": -17.8 + k * 1e-4, "lng": 31.05, "ts": base + k * 1000 + i} for k in range(args.batch)]
+        r = client.post("/api/location_batch", json={"imei": d["imei"], "token": d["api_token"], "fixes": fixes})
+        return r.status_code == 200
+
+    def search_imei(i):
+        return client.post("/search", data={"query": device(i)["imei"]}).status_code == 200
+
+    def search_phone(i):
+        return client.post("/search", data={"query": device(i)["phone"]}).status_code == 200
+
+    def lookup_device_db(i):
+        return app_module.lookup_device_db(imei=device(i)["imei"]) is not None
+
+    def export_json(i):
+        r = client.get("/export")
+        ok = r.status_code == 200 and len(r.get_data()) > 0
+        r.close()
+        return ok
+
+    def export_ndjson_gzip(i):
+        r = client.get("/export?format=ndjson&gzip=1")
+        ok = r.status_code == 200 and len(r.get_data()) > 0
+        r.close()
+        return ok
+
+    def history(i):
+        d = device(i)
+        return client.get(f"/api/devices/{d['id']}/history?zoom=12").status_code == 200
+
+    def fleet_page(i):
+        return client.get("/api/devices?stale=86400").status_code == 200
+
+    def import_data(i):
+        # A fresh seed per call so every import actually adds devices
+        records = generate_fleet(args.import_devices, args.history, seed=1_000_000 + i + args.warmup)
+        body = "".join(json.dumps(r) + "\n" for r in records).encode()
+        r = client.post(
+            "/import",
+            data={"file": (io.BytesIO(body), "fleet.ndjson")},
+            headers={"Accept": "application/json"},
+        )
+        return r.status_code == 200 and r.get_json()["ok"]
+
+    return {
+        "location_update": (location_update, args.iterations),
+        "location_batch": (location_batch, args.iterations),
+        "search_imei": (search_imei, args.iterations),
+        "search_phone": (search_phone, args.iterations),
+        "lookup_device_db": (lookup_device_db, args.iterations),
+        "history": (history, args.iterations),
+        "fleet_page": (fleet_page, args.iterations),
+        "export_json": (export_json, args.export_iterations),
+        "export_ndjson_gzip": (export_ndjson_gzip, args.export_iterations),
+        "import_data": (import_data, args.export_iterations),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--history", type=int, default=100, help="fixes per device")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--export-iterations", type=int, default=5, help="iterations of export/import")
+    parser.add_argument("--import-devices", type=int, default=100, help="devices per import_data call")
+    parser.add_argument("--batch", type=int, default=50, help="fixes per location_batch call")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--only", action="append", help="run only these benchmarks (repeatable)")
+    parser.add_argument("--shards", type=int, default=0, help="LOCATION_SHARDS for the benchmark database")
+    parser.add_argument("--out", help="write results as JSON")
+    args = parser.parse_args(argv)
+
+    data_dir = isolated_data_dir()
+    # Read by app at import time
+    os.environ["LOCATION_SHARDS"] = str(args.shards)
+    import app as app_module
+    from bench.fleet import generate_fleet
+
+    app_module.init_app_data()
+    t0 = time.perf_counter()
+    fleet = list(generate_fleet(args.devices, args.history, args.seed))
+    conn = app_module.db_connect()
+    try:
+        summary = app_module.import_devices(conn, iter(fleet))
+        ids = dict(conn.execute("SELECT imei, id FROM devices").fetchall())
+    finally:
+        conn.close()
+    for d in fleet:
+        d["id"] = ids[d["imei"]]
+    print(
+        f"fleet: {summary['devices_added']} devices, {summary['locations_added']} locations "
+        f"in {time.perf_counter() - t0:.1f} s ({data_dir})"
+    )
+
+    client = app_module.app.test_client()
+    with client.session_transaction() as s:
+        s["user"] = {"username": "admin", "role": "admin"}
+    results = {}
+    for name, (fn, iterations) in build_cases(app_module, client, fleet, args).items():
+        if args.only and name not in args.only:
+            continue
+        results[name] = run_case(fn, iterations, min(args.warmup, iterations))
+    print_table(results)
+    params = {k: v for k, v in vars(args).items() if k != "out"}
+    write_results(args.out, metadata("micro", params), results)
+
+
+if __name__ == "__main__":
+    main()
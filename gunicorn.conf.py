@@ -0,0 +1,38 @@
+"""Gunicorn settings for the device tracker.
+
+One-time work (schema migrations, admin seeding, loading the phonenumbers
+geocoder/carrier datasets) runs in the master before workers fork, so each
+worker boots with the module already imported and shares those pages.
+"""
+import os
+import time
+
+# Threaded workers, so an open /api/live stream ties up one thread rather than a whole
+# worker; post_worker_init caps streams at half of them. Override with -k/--threads.
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "32"))
+
+
+def on_starting(server):
+    import app
+
+    app.init_app_data()
+    if os.environ.get("PRELOAD_PHONE_METADATA", "1") == "1":
+        app.preload_phone_metadata()
+    server.log.info(app.format_boot_report())
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    import app
+
+    app.db_connect()
+    kind = type(worker).__name__
+    if kind == "SyncWorker":
+        app.live_broker.max_subscribers = 0
+    elif kind == "ThreadWorker":
+        app.live_broker.max_subscribers = min(app.live_broker.max_subscribers, worker.cfg.threads // 2)
+    worker.log.info("worker %s ready %.1f ms after fork", worker.pid, (time.perf_counter() - worker.forked_at) * 1000.0)